@@ -0,0 +1,283 @@
+"""
+Benchmarks de GreenScore (sin servidor Streamlit ni red).
+
+Genera datos sintéticos (portfolios contra config/scoring_config.json, exportaciones de
+facturas, ledgers y textos largos de reporte), mide cada etapa y el import en frío de los
+módulos, y escribe los resultados en JSON para comparar entre versiones.
+
+    python bench.py                              # tamaños por defecto (1k, 10k, 100k)
+    python bench.py --sizes 1000,1000000 --stages scoring_batch,normalize
+    python bench.py --profile --out bench_results/antes.json
+    python bench.py --compare bench_results/antes.json
+"""
+import argparse
+import cProfile
+import io
+import json
+import os
+import platform
+import pstats
+import statistics
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+ROOT = Path(__file__).resolve().parent
+sys.path.insert(0, str(ROOT))
+
+import greenscore_engine as ge  # noqa: E402
+
+# Módulos cuyo import en frío se mide (proceso nuevo): el motor sin UI y el núcleo con Streamlit
+IMPORT_MODULES = {"import_engine": "greenscore_engine", "import_core": "greenscore_core"}
+
+
+# ========================= DATOS SINTÉTICOS =========================
+
+def load_scoring_config() -> dict:
+    path = ROOT / "config" / "scoring_config.json"
+    return json.loads(path.read_text(encoding="utf-8")) if path.exists() else ge.DEFAULT_CFG
+
+def synth_portfolio(n: int, scheme_cfg: dict, rng: np.random.Generator, nan_frac: float = 0.02) -> pd.DataFrame:
+    """Portfolio con project_name, typology y todas las métricas del esquema (algunos NaN)."""
+    data = {
+        "project_name": [f"P{i:07d}" for i in range(n)],
+        "typology": rng.choice(["Oficinas", "Residencial", "Retail", "Educativo", "Sanitario"], n),
+    }
+    for key, meta in scheme_cfg["metrics"].items():
+        if meta.get("type") == "bool":
+            col = rng.integers(0, 2, n).astype("float64")
+        else:
+            col = rng.uniform(0, float(meta.get("target") or 1) * 1.5, n)
+        col[rng.random(n) < nan_frac] = np.nan
+        data[key] = col
+    return pd.DataFrame(data)
+
+def synth_invoice_export(n: int, rng: np.random.Generator) -> pd.DataFrame:
+    """Exportación tipo distribuidora: lecturas cada 15 min con fecha dd/mm/aaaa hh:mm."""
+    ts = pd.date_range("2023-01-01", periods=n, freq="15min")
+    return pd.DataFrame({
+        "Fecha": ts.strftime("%d/%m/%Y %H:%M"),
+        "kWh": rng.uniform(0, 5, n).round(3),
+        "Importe": rng.uniform(0, 2, n).round(2),
+        "Demanda_kW": rng.uniform(5, 50, n).round(2),
+        "Moneda": "ARS",
+    })
+
+def synth_ledger(n: int, rng: np.random.Generator) -> pd.DataFrame:
+    """Ledger normalizado (_year_month, _kwh, …) con varias fuentes por mes."""
+    months = pd.date_range("2015-01-01", periods=120, freq="MS")
+    return pd.DataFrame({
+        "_year_month": rng.choice(months, n),
+        "_kwh": rng.uniform(1e3, 5e4, n),
+        "_cost": rng.uniform(1e2, 5e3, n),
+        "_demand_kw": rng.uniform(10, 200, n),
+        "_currency": "ARS",
+        "_source": [f"f{i % 500}.csv" for i in range(n)],
+    })
+
+def synth_report_dataset(months: int, rng: np.random.Generator) -> dict:
+    """Dataset de sitio como el que arma la página: serie mensual de `months` meses, preview y evidencias."""
+    ym = pd.date_range("2000-01-01", periods=months, freq="MS").strftime("%Y-%m")
+    series = [{"month": m, "kwh": float(rng.uniform(1e4, 5e4)), "cost": float(rng.uniform(1e3, 5e3)),
+               "demand_kw": float(rng.uniform(10, 200)), "currency": "ARS"} for m in ym]
+    return {
+        "site": {"organization": "Org", "site_name": "Bench", "area_m2": 1500.0},
+        "building_uses": [{"use": "Oficinas", "pct": 100.0}],
+        "evidence_files": [f"ev_building:foto_{i}.jpg" for i in range(50)],
+        "invoices": {"preview_rows": series[:100], "summary": {
+            "monthly_series": series, "metrics": {"kwh_total": sum(r["kwh"] for r in series)},
+            "period": {"start": ym[0], "end": ym[-1]}, "notes": []}},
+        "derived": {},
+    }
+
+def synth_report_text(n_sections: int, rng: np.random.Generator) -> str:
+    """Texto 'markdownish' como el que devuelve el LLM: encabezados, párrafos y viñetas."""
+    words = ("energía consumo línea base ahorro kWh medida tablero iluminación climatización "
+             "demanda tarifa eficiencia mantenimiento ocupación").split()
+    out = []
+    for i in range(n_sections):
+        out.append(f"## Sección {i + 1}: Revisión Energética" if i % 5 == 0 else f"## Sección {i + 1}")
+        for j in range(4):
+            out.append(f"### Punto {i + 1}.{j + 1}")
+            out.append(" ".join(rng.choice(words, 60)) + ".")
+            out.extend(f"- **{w}**: {rng.uniform(0, 1000):.1f} kWh" for w in rng.choice(words, 3))
+    return "\n".join(out)
+
+
+# ========================= MEDICIÓN =========================
+
+def time_stage(fn, repeat: int, profile: bool = False, top: int = 15) -> dict:
+    """Corre `fn` `repeat` veces (más un calentamiento) y devuelve min/mediana/media en segundos."""
+    fn()
+    times = []
+    for _ in range(repeat):
+        t = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - t)
+    res = {"repeat": repeat, "min_s": min(times), "median_s": statistics.median(times),
+           "mean_s": statistics.fmean(times)}
+    if profile:
+        prof = cProfile.Profile()
+        prof.runcall(fn)
+        stats = pstats.Stats(prof, stream=io.StringIO()).sort_stats("cumulative")
+        res["profile"] = [
+            {"function": f"{Path(file).name}:{line}({func})", "calls": nc, "tottime_s": tt, "cumtime_s": ct}
+            for (file, line, func), (_cc, nc, tt, ct, _callers) in sorted(
+                stats.stats.items(), key=lambda kv: kv[1][3], reverse=True)[:top]
+        ]
+    return res
+
+def time_import(module: str, repeat: int) -> dict:
+    """Import en frío de `module` en `repeat` procesos nuevos (sin contar el arranque del intérprete)."""
+    code = f"import time; t = time.perf_counter(); import {module}; print(time.perf_counter() - t)"
+    times = []
+    for _ in range(repeat):
+        out = subprocess.run([sys.executable, "-c", code], cwd=ROOT, capture_output=True, text=True, check=True)
+        times.append(float(out.stdout.strip().splitlines()[-1]))
+    return {"repeat": repeat, "min_s": min(times), "median_s": statistics.median(times),
+            "mean_s": statistics.fmean(times)}
+
+def build_stages(sizes: list[int], cfg: dict, scheme_name: str, rng: np.random.Generator) -> list:
+    """Lista de (etapa, tamaño, unidad, función sin argumentos)."""
+    scheme_cfg = cfg["schemes"][scheme_name]
+    scheme = ge.compile_scheme(scheme_cfg)
+    stages = []
+    for n in sizes:
+        pf = synth_portfolio(n, scheme_cfg, rng)
+        rows = pf.head(min(n, 2_000)).to_dict("records")
+        stages.append(("scoring_rowwise", len(rows), "rows", lambda rows=rows: [ge.compute_scores(r, scheme) for r in rows]))
+        stages.append(("scoring_batch", n, "rows", lambda pf=pf: ge.compute_scores_batch(pf, scheme)))
+
+        def cache_cold(pf=pf):
+            ge.ScoreCache().score(pf, scheme)
+        warm = ge.ScoreCache()
+        warm.score(pf, scheme)
+        stages.append(("portfolio_cache_cold", n, "rows", cache_cold))
+        stages.append(("portfolio_cache_warm", n, "rows", lambda pf=pf, warm=warm: warm.score(pf, scheme)))
+
+        exp = synth_invoice_export(n, rng)
+
+        def normalize(exp=exp):
+            ge._INVOICE_MAPPING_CACHE.clear()
+            ge._normalize_invoice_table(exp, "bench.csv")
+        stages.append(("normalize", n, "rows", normalize))
+
+        led = synth_ledger(n, rng)
+        stages.append(("summarize", n, "rows", lambda led=led: ge._em_summarize_invoices(led, 1500.0, 40, None, None)))
+
+        sections = max(1, n // 1_000)
+        text = synth_report_text(sections, rng)
+        stages.append(("markdown", len(text), "chars", lambda text=text: ge._markdownish_to_html_and_toc(text)))
+
+        def markdown_stream(text=text, step=40):
+            # fragmentos del tamaño típico de un delta del stream del modelo
+            r = ge.ReportStreamRenderer()
+            for i in range(0, len(text), step):
+                r.feed(text[i:i + step])
+            r.finish()
+        stages.append(("markdown_stream", len(text), "chars", markdown_stream))
+        # un parseo y los dos HTML (pantalla y A4) del mismo árbol, sin xhtml2pdf
+        stages.append(("report_render", len(text), "chars", lambda text=text: ge._em_build_report(
+            {"site": {"site_name": "Bench"}}, text, "#0B8C6B", "", with_pdf=False)))
+
+        n_sites = max(2, n // 500)
+        items = [({"site": {"site_name": f"Sitio {i}", "organization": "Org"}}, synth_report_text(8, rng))
+                 for i in range(n_sites)]
+        # consolidado: secciones por sitio en el pool de procesos (si hay xhtml2pdf), PDF combinado y ZIP
+        stages.append(("report_batch", n_sites, "sites", lambda items=items: ge.build_batch_report(items)))
+
+        months = max(12, n // 100)
+        dataset = synth_report_dataset(months, rng)
+        stages.append(("report_compact", months, "months", lambda dataset=dataset: ge.compact_report_dataset(dataset)))
+    return stages
+
+
+# ========================= RESULTADOS =========================
+
+def environment() -> dict:
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True,
+                                text=True, timeout=10).stdout.strip() or None
+    except Exception:
+        commit = None
+    return {
+        "timestamp": pd.Timestamp.now().isoformat(timespec="seconds"),
+        "commit": commit,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "numpy": np.__version__,
+        "pandas": pd.__version__,
+    }
+
+def compare(results: list, baseline_path: Path) -> list:
+    """Une con un JSON anterior por (etapa, tamaño) y agrega la razón nueva / anterior de la mediana."""
+    prev = json.loads(Path(baseline_path).read_text(encoding="utf-8"))
+    prev_idx = {(r["stage"], r["size"]): r for r in prev.get("results", [])}
+    out = []
+    for r in results:
+        p = prev_idx.get((r["stage"], r["size"]))
+        if p:
+            out.append({"stage": r["stage"], "size": r["size"], "before_s": p["median_s"],
+                        "after_s": r["median_s"], "ratio": r["median_s"] / p["median_s"] if p["median_s"] else None})
+    return out
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description=__doc__.split("\n\n")[0].strip(),
+                                 formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--sizes", default="1000,10000,100000",
+                    help="tamaños separados por coma (filas de portfolio / exportación / ledger)")
+    ap.add_argument("--stages", default="", help="etapas a correr (por defecto todas)")
+    ap.add_argument("--scheme", default=None, help="esquema de scoring (por defecto el primero del config)")
+    ap.add_argument("--repeat", type=int, default=3)
+    ap.add_argument("--seed", type=int, default=0)
+    ap.add_argument("--profile", action="store_true", help="agrega el top de cProfile de cada etapa")
+    ap.add_argument("--out", default=None, help="JSON de salida (por defecto bench_results/<fecha>.json)")
+    ap.add_argument("--compare", default=None, help="JSON de una corrida anterior para comparar")
+    args = ap.parse_args(argv)
+
+    sizes = [int(float(s)) for s in args.sizes.split(",") if s.strip()]
+    wanted = {s.strip() for s in args.stages.split(",") if s.strip()}
+    cfg = load_scoring_config()
+    scheme_name = args.scheme or next(iter(cfg["schemes"]))
+    rng = np.random.default_rng(args.seed)
+
+    results = []
+    for stage, module in IMPORT_MODULES.items():
+        if wanted and stage not in wanted:
+            continue
+        res = time_import(module, args.repeat)
+        res.update({"stage": stage, "size": 1, "unit": "proc", "throughput_per_s": None})
+        results.append(res)
+        print(f"{stage:<22} {module:>16}  median {res['median_s'] * 1e3:>10.2f} ms", flush=True)
+
+    for stage, size, unit, fn in build_stages(sizes, cfg, scheme_name, rng):
+        if wanted and stage not in wanted:
+            continue
+        res = time_stage(fn, args.repeat, args.profile)
+        res.update({"stage": stage, "size": size, "unit": unit,
+                    "throughput_per_s": size / res["median_s"] if res["median_s"] else None})
+        results.append(res)
+        print(f"{stage:<22} {size:>10,} {unit:<5} median {res['median_s'] * 1e3:>10.2f} ms"
+              f"  ({res['throughput_per_s']:,.0f} {unit}/s)", flush=True)
+
+    report = {"environment": environment(), "scheme": scheme_name, "args": vars(args), "results": results}
+    if args.compare:
+        report["comparison"] = compare(results, Path(args.compare))
+        for c in report["comparison"]:
+            print(f"{c['stage']:<22} {c['size']:>10,}  {c['before_s'] * 1e3:>10.2f} → {c['after_s'] * 1e3:>10.2f} ms"
+                  f"  ×{c['ratio']:.2f}")
+
+    out = Path(args.out) if args.out else ROOT / "bench_results" / (
+        pd.Timestamp.now().strftime("%Y%m%d-%H%M%S") + ".json")
+    out.parent.mkdir(parents=True, exist_ok=True)
+    out.write_text(json.dumps(report, ensure_ascii=False, indent=1), encoding="utf-8")
+    print(f"→ {out}")
+    return report
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,269 @@
+"""
+CLI de GreenScore sin interfaz (no importa Streamlit): scoring de portfolios e ingesta de
+facturas al ledger energético con baselines, usando todos los núcleos.
+
+    python greenscore_cli.py score portfolios/*.csv --schemes LEED,EDGE --out scores.parquet
+    python greenscore_cli.py ingest facturas/ --meta sitios.csv --out ingesta.csv
+    python greenscore_cli.py baseline --degree-days data/degree_days.csv --out baselines.json
+
+`ingest` espera una carpeta por sitio (facturas/<sitio>/*.csv|xlsx|pdf); los archivos de
+medición por intervalos van en facturas/<sitio>/ami/ (CSV o Parquet). Con --site la carpeta
+es la de un único sitio. Los PDF se leen con las plantillas locales; los que no coinciden
+con ninguna quedan como "pending" (el OCR/LLM sigue siendo de la app).
+
+La salida se elige por extensión: .csv, .parquet, .json (lista de registros) o .jsonl;
+"-" escribe CSV por stdout.
+"""
+import argparse
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import pandas as pd
+
+import greenscore_engine as ge
+
+INVOICE_TABLE_SUFFIXES = {".csv", ".xlsx", ".xlsm", ".xls"}
+INTERVAL_SUFFIXES = {".csv", ".parquet", ".pq"}
+
+
+# ========================= ENTRADA / SALIDA =========================
+
+def read_table(path: Path) -> pd.DataFrame:
+    suf = path.suffix.lower()
+    if suf in (".parquet", ".pq"):
+        return pd.read_parquet(path)
+    if suf in (".xlsx", ".xlsm", ".xls"):
+        return pd.read_excel(path)
+    try:
+        return pd.read_csv(path)
+    except UnicodeDecodeError:
+        return pd.read_csv(path, encoding="utf-8", encoding_errors="ignore")
+
+def write_table(df: pd.DataFrame, out: str):
+    if out == "-":
+        df.to_csv(sys.stdout, index=False)
+        return
+    path = Path(out)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    suf = path.suffix.lower()
+    if suf in (".parquet", ".pq"):
+        df.to_parquet(path, index=False)
+    elif suf == ".json":
+        df.to_json(path, orient="records", force_ascii=False, date_format="iso", indent=1)
+    elif suf == ".jsonl":
+        df.to_json(path, orient="records", force_ascii=False, date_format="iso", lines=True)
+    elif suf == ".csv":
+        df.to_csv(path, index=False)
+    else:
+        raise SystemExit(f"Formato de salida no soportado: {path.suffix or out} (usar .csv, .parquet, .json o .jsonl)")
+    log(f"→ {path} ({len(df):,} filas)")
+
+def log(msg: str):
+    print(msg, file=sys.stderr, flush=True)
+
+def _split(value: str | None) -> list[str]:
+    return [s.strip() for s in (value or "").split(",") if s.strip()]
+
+def _workers(n: int | None) -> int:
+    return max(1, n or os.cpu_count() or 1)
+
+
+# ========================= SCORE =========================
+
+def cmd_score(args) -> pd.DataFrame:
+    cfg = ge.read_scoring_config(args.config)
+    wanted = _split(args.schemes)
+    missing = [s for s in wanted if s not in cfg["schemes"]]
+    if missing:
+        raise SystemExit(f"Esquemas inexistentes en la config: {', '.join(missing)}")
+    if wanted:
+        cfg = {**cfg, "schemes": {s: cfg["schemes"][s] for s in wanted}}
+
+    t0 = time.perf_counter()
+    # métricas de todos los esquemas: cada archivo se completa antes de concatenar, así una
+    # columna que falta vale 0 (como en page_portfolio) y no NaN, que puntuaría como máximo
+    metrics = list(dict.fromkeys(k for c in cfg["schemes"].values() for k in c["metrics"]))
+    frames = []
+    for p in map(Path, args.files):
+        df = read_table(p)
+        missing = [m for m in metrics if m not in df.columns]
+        if missing:
+            log(f"aviso: {p.name} no tiene {', '.join(missing)}; se consideran 0")
+            df = df.assign(**{m: 0 for m in missing})
+        df.insert(0, "_file", p.name)
+        frames.append(df)
+    df = pd.concat(frames, ignore_index=True) if frames else pd.DataFrame()
+    if df.empty:
+        raise SystemExit("No hay filas para puntuar.")
+
+    scores = ge.score_all_schemes(df, cfg, max_workers=_workers(args.workers), shard_rows=args.shard_rows)
+    if args.keep_metrics:
+        out = df
+    else:
+        out = df[[c for c in ("_file", "project_name", "typology") if c in df.columns]]
+    out = pd.concat([out, scores], axis=1)
+    for name in cfg["schemes"]:
+        out[f"tier_{name}"] = out[f"score_{name}"].map(ge.label_tier)
+    log(f"{len(out):,} proyectos × {len(cfg['schemes'])} esquema(s) en {time.perf_counter() - t0:.2f} s")
+    write_table(out, args.out)
+    return out
+
+
+# ========================= INGEST =========================
+
+def _ingest_jobs(root: Path, site: str | None, interval_dir: str) -> list[tuple]:
+    """(ruta, sitio, tipo) de cada archivo a ingerir; tipo ∈ {table, pdf, interval}."""
+    sites = [(site, root)] if site else [(d.name, d) for d in sorted(root.iterdir()) if d.is_dir()]
+    jobs = []
+    for name, folder in sites:
+        for p in sorted(folder.iterdir()):
+            suf = p.suffix.lower()
+            if p.is_file() and suf in INVOICE_TABLE_SUFFIXES:
+                jobs.append((p, name, "table"))
+            elif p.is_file() and suf == ".pdf":
+                jobs.append((p, name, "pdf"))
+        ami = folder / interval_dir
+        if ami.is_dir():
+            jobs += [(p, name, "interval") for p in sorted(ami.iterdir())
+                     if p.is_file() and p.suffix.lower() in INTERVAL_SUFFIXES]
+    return jobs
+
+def _ingest_file(path: Path, site: str, kind: str, by_meter: bool = False) -> tuple[pd.DataFrame, dict]:
+    """Normaliza un archivo a filas del ledger (con `_site`). Corre en los workers del pool."""
+    info = {"file": str(path), "site": site, "kind": kind, "rows": 0, "status": "ok", "detail": "",
+            "diagnostics": ""}
+    with ge.collecting_diagnostics() as diags:
+        df = _ingest_file_rows(path, site, kind, by_meter, info)
+    info["rows"] = len(df)
+    info["diagnostics"] = "; ".join(diags.messages())
+    return df, info
+
+def _ingest_file_rows(path: Path, site: str, kind: str, by_meter: bool, info: dict) -> pd.DataFrame:
+    try:
+        if kind == "interval":
+            df, roll_info = ge.rollup_interval_meter(path, site=site, by_meter=by_meter)
+            info["detail"] = f"{roll_info['rows']:,} lecturas cada {roll_info['interval_minutes']:g} min"
+        elif kind == "pdf":
+            with path.open("rb") as fh:
+                raw = ge._extract_text_from_pdf_simple(fh)
+            df, tpl = ge._parse_invoice_text_local(raw, path.name) if raw else (pd.DataFrame(), {})
+            if df.empty:
+                info.update(status="pending", detail="sin texto" if not raw else "sin plantilla local")
+            else:
+                info["detail"] = f"plantilla {tpl['template']}"
+        else:
+            df = ge._normalize_invoice_table(read_table(path), path.name)
+        if not df.empty and kind != "interval":
+            df = df.assign(_site=site)
+    except Exception as e:
+        df = pd.DataFrame()
+        info.update(status="error", detail=str(e))
+    return df
+
+def cmd_ingest(args) -> pd.DataFrame:
+    root = Path(args.root)
+    if not root.is_dir():
+        raise SystemExit(f"No existe la carpeta {root}")
+    jobs = _ingest_jobs(root, args.site, args.interval_dir)
+    if not jobs:
+        raise SystemExit(f"No se encontraron facturas en {root}")
+
+    t0 = time.perf_counter()
+    workers = min(_workers(args.workers), len(jobs))
+    paths, sites, kinds = zip(*jobs)
+    by_meter = [args.by_meter] * len(jobs)
+    if workers <= 1:
+        results = list(map(_ingest_file, paths, sites, kinds, by_meter))
+    else:
+        import multiprocessing as mp
+        with ProcessPoolExecutor(max_workers=workers, mp_context=mp.get_context("spawn")) as pool:
+            results = list(pool.map(_ingest_file, paths, sites, kinds, by_meter))
+
+    ledger = ge.EnergyLedger(args.ledger)
+    frames = [df.reindex(columns=ge.LEDGER_COLUMNS + ["_site"]) for df, _ in results if not df.empty]
+    written = ledger.upsert(pd.concat(frames, ignore_index=True)) if frames else 0
+    if args.meta:
+        meta = read_table(Path(args.meta))
+        ledger.upsert_sites(meta.reindex(columns=ge.SITE_META_COLUMNS))
+    report = pd.DataFrame([info for _, info in results])
+    counts = report["status"].value_counts().to_dict()
+    log(f"{len(jobs):,} archivos de {report['site'].nunique():,} sitio(s) en {time.perf_counter() - t0:.2f} s "
+        f"→ {written:,} claves en {ledger.path} ({', '.join(f'{k}: {v}' for k, v in counts.items())})")
+    if args.out:
+        write_table(report, args.out)
+    return report
+
+
+# ========================= BASELINE =========================
+
+def cmd_baseline(args) -> pd.DataFrame:
+    ledger = ge.EnergyLedger(args.ledger)
+    sites = _split(args.sites) or None
+    dd = ge.load_degree_days(args.degree_days)
+    if args.degree_days and dd is None:
+        raise SystemExit(f"No existe el archivo de grados-día {args.degree_days}")
+    t0 = time.perf_counter()
+    if args.table == "regression":
+        if dd is None:
+            raise SystemExit("La regresión necesita grados-día (--degree-days o $GREENSCORE_DEGREE_DAYS).")
+        out = ge.energy_baselines(ledger, sites=sites, degree_days=dd, min_months=args.min_months)
+    else:
+        out = ge.energy_portfolio(ledger, sites=sites, start=args.start, end=args.end, degree_days=dd)
+        if args.table == "benchmark":
+            out = ge.energy_typology_benchmark(out)
+    log(f"{args.table}: {len(out):,} filas en {time.perf_counter() - t0:.2f} s")
+    write_table(out, args.out)
+    return out
+
+
+# ========================= MAIN =========================
+
+def build_parser() -> argparse.ArgumentParser:
+    ap = argparse.ArgumentParser(prog="greenscore_cli", description=__doc__.split("\n\n")[0].strip(),
+                                 formatter_class=argparse.RawDescriptionHelpFormatter, epilog=__doc__)
+    sub = ap.add_subparsers(dest="command", required=True)
+
+    sc = sub.add_parser("score", help="puntúa portfolios (CSV/Parquet/XLSX) con uno o más esquemas")
+    sc.add_argument("files", nargs="+")
+    sc.add_argument("--config", default=None, help="JSON de esquemas (por defecto config/scoring_config.json)")
+    sc.add_argument("--schemes", default="", help="esquemas separados por coma (por defecto todos)")
+    sc.add_argument("--workers", type=int, default=None, help="procesos (por defecto todos los núcleos)")
+    sc.add_argument("--shard-rows", type=int, default=50_000)
+    sc.add_argument("--keep-metrics", action="store_true", help="incluye las métricas de entrada en la salida")
+    sc.add_argument("--out", required=True)
+    sc.set_defaults(func=cmd_score)
+
+    ing = sub.add_parser("ingest", help="ingiere carpetas de facturas al ledger energético")
+    ing.add_argument("root")
+    ing.add_argument("--site", default=None, help="trata `root` como la carpeta de un único sitio")
+    ing.add_argument("--interval-dir", default="ami", help="subcarpeta con medición por intervalos")
+    ing.add_argument("--by-meter", action="store_true", help="un sitio por medidor en los archivos de intervalos")
+    ing.add_argument("--meta", default=None, help="CSV/Parquet con metadatos de sitios (área, usuarios, baseline…)")
+    ing.add_argument("--ledger", default=None, help="SQLite del ledger (por defecto $GREENSCORE_LEDGER_PATH)")
+    ing.add_argument("--workers", type=int, default=None)
+    ing.add_argument("--out", default=None, help="reporte por archivo (opcional)")
+    ing.set_defaults(func=cmd_ingest)
+
+    bl = sub.add_parser("baseline", help="KPIs y baselines por sitio desde el ledger")
+    bl.add_argument("--table", choices=["portfolio", "regression", "benchmark"], default="portfolio")
+    bl.add_argument("--sites", default="", help="sitios separados por coma (por defecto todos)")
+    bl.add_argument("--start", default=None)
+    bl.add_argument("--end", default=None)
+    bl.add_argument("--degree-days", default=None, help="CSV de grados-día (por defecto $GREENSCORE_DEGREE_DAYS)")
+    bl.add_argument("--min-months", type=int, default=6)
+    bl.add_argument("--ledger", default=None)
+    bl.add_argument("--out", required=True)
+    bl.set_defaults(func=cmd_baseline)
+    return ap
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    if getattr(args, "ledger", None) is None and args.command in ("ingest", "baseline"):
+        args.ledger = os.getenv("GREENSCORE_LEDGER_PATH", "data/energy_ledger.sqlite")
+    return args.func(args)
+
+if __name__ == "__main__":
+    main()
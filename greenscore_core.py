@@ -1,12 +1,35 @@
 import json
-import re
 from io import BytesIO
 from pathlib import Path
 
-import altair as alt
 import pandas as pd
 import streamlit as st
 
+from greenscore_engine import (  # noqa: F401  (motor sin UI, reexportado para las páginas)
+    DEFAULT_CFG, DEFAULT_SAMPLE, SCORING_CONFIG_PATH, read_scoring_config,
+    Trace, trace_span, trace_count, traced, tracing,
+    Diagnostics, diagnose, collecting_diagnostics,
+    MetricSpec, CompiledScheme, compile_scheme, clamp01, normalize,
+    compute_scores, compute_scores_batch, label_tier,
+    ScoreCache, portfolio_fingerprint, score_portfolio_csv_streaming, score_all_schemes,
+    PORTFOLIO_STORE_DIR, list_portfolio_stores, portfolio_store_meta,
+    write_portfolio_store, read_portfolio_store,
+    _slugify, ReportDoc, parse_report_text, _markdownish_to_html_and_toc,
+    _em_render_report_html, _em_render_report_pdf_html,
+    _em_html_to_pdf_bytes, _openai_client, _em_openai_report, _em_openai_report_stream, _em_build_report,
+    REPORT_TOKEN_BUDGET, estimate_tokens, compact_report_dataset,
+    ReportStreamRenderer, ReportCache, report_cache,
+    ReportJob, ReportJobQueue, report_queue, build_batch_report,
+    InvoiceParseCache, invoice_parse_cache, run_ocr_pipeline, _parse_invoice_text_blocks_with_llm,
+    _extract_text_from_pdf_simple, _parse_page_range, _iter_pdf_pages, _pdf_page_count, _pdf_ocr_jobs,
+    INVOICE_TEMPLATES_DIR, load_invoice_templates, _parse_invoice_text_local,
+    _em_summarize_invoices, _em_compute_baseline_from_invoices,
+    LEDGER_COLUMNS, SITE_META_COLUMNS, EnergyLedger, energy_ledger,
+    energy_portfolio, energy_typology_benchmark,
+    DEGREE_DAYS_PATH, parse_degree_days, load_degree_days, fit_energy_baselines, energy_baselines,
+    _normalize_invoice_table, rollup_interval_meter,
+)
+
 # ========================= IDIOMAS SENCILLOS ES / EN =========================
 
 LANG_OPTIONS = {
@@ -61,6 +84,24 @@ TRANSLATIONS = {
         "pf_chart_typology_avg": "Average by typology",
         "pf_chart_typology": "Typology",
         "pf_download_results": "⬇️ Download results (CSV)",
+        "pf_stream_toggle": "Streaming mode (very large CSVs, chunked read)",
+        "pf_stream_path": "…or local CSV path (no upload limit)",
+        "pf_stream_chunk": "Rows per chunk",
+        "pf_stream_need_file": "Upload a CSV or enter a local path for streaming mode.",
+        "pf_stream_running": "Processing CSV in chunks…",
+        "pf_stream_stats": "{rows:,} rows in {chunks:,} chunks.",
+        "pf_store_open": "Open saved portfolio (Parquet)",
+        "pf_store_info": "Saved portfolio: {rows:,} projects · {at}",
+        "pf_store_save_title": "💾 Save to local store (Parquet)",
+        "pf_store_name": "Portfolio name",
+        "pf_store_save_btn": "Save portfolio",
+        "pf_store_saved": "Portfolio saved to {path}.",
+        "pf_store_unavailable": "The Parquet store is unavailable (pyarrow could not be imported: {error}).",
+        "pf_all_schemes_title": "📊 Score with all schemes",
+        "pf_all_schemes_btn": "Score all schemes (multi-core)",
+        "pf_all_schemes_running": "Scoring in parallel…",
+        "pf_all_schemes_download": "⬇️ Download all-scheme scores (CSV)",
+        "pf_cache_stats": "Score cache: {hits:,} reused · {misses:,} recomputed (session: {tot_hits:,} / {tot_misses:,})",
 
         # ------------------- Metodología -------------------
         "me_scheme_label": "Scheme to display",
@@ -75,6 +116,11 @@ TRANSLATIONS = {
         "em_saved_sites_expander": "🏢 Sites saved in this session",
         "em_saved_sites_title": "Saved sites:",
         "em_saved_sites_empty": "No sites have been saved in this session yet.",
+        "em_pf_title": "Energy portfolio (all sites in the ledger)",
+        "em_pf_typologies": "Typologies",
+        "em_pf_sites": "Sites",
+        "em_pf_benchmark": "Benchmark by typology",
+        "em_pf_download": "⬇️ Download energy portfolio (CSV)",
 
         "em_visual_record_title": "Building visual record",
         "em_building_photos": "Building photos (JPG/PNG)",
@@ -119,12 +165,41 @@ TRANSLATIONS = {
         "em_ledger_imported": "Ledger imported and merged.",
         "em_ledger_upload_err": "Could not import ledger:",
         "em_ledger_download": "⬇️ Download current ledger (CSV)",
+        "em_debug_expander": "🐞 Timings of the last save (debug)",
+        "em_debug_caption": "Total {total:,.0f} ms · API calls {calls} · retries {retries} · sent {mb:.2f} MB · cache hits {hits}",
+        "em_debug_json": "⬇️ Export JSON",
+        "em_debug_chrome": "⬇️ Export Chrome trace",
+        "em_dd_expander": "🌡️ Degree-days (regression baseline)",
+        "em_dd_caption": "Monthly or daily CSV with month/date, HDD and/or CDD and, optionally, a location (matched to the site's climate zone).",
+        "em_dd_upload": "Degree-day file (CSV)",
+        "em_dd_err": "Could not read the degree-day file:",
+        "em_dd_loaded": "{path}: {locs} location(s), {start} → {end}",
+        "em_dd_missing": "No degree-days: the baseline is annualized (12 / months).",
+        "em_regression_caption": "Regression baseline ({model}, {months} months): R² {r2} · CV(RMSE) {cv} · normalized kWh/year {norm}",
+        "em_ami_expander": "⚡ Interval metering (AMI 15-min / hourly)",
+        "em_ami_caption": "CSV/Parquet with timestamp, kWh and/or kW (and optionally meter). Read in chunks; only monthly totals are stored in the ledger.",
+        "em_ami_upload": "Interval files (CSV/Parquet)",
+        "em_ami_path": "…or local path (no upload limit)",
+        "em_ami_interval": "Interval (min)",
+        "em_ami_by_meter": "One site per meter",
+        "em_ami_btn": "Consolidate into ledger",
+        "em_ami_need_file": "Upload a file or enter a local path.",
+        "em_ami_running": "Rolling up intervals by month…",
+        "em_ami_done": "{source}: {rows:,} readings from {meters} meter(s) every {step:g} min → {months} monthly rows.",
+        "em_ami_err": "Could not read the interval file:",
 
         "em_ocr_options": "Invoice reading options",
         "em_ocr_toggle": "Use OCR with OpenAI (images and scanned PDFs)",
         "em_ocr_model": "Model for OCR/parse",
         "em_ocr_dpi": "DPI to rasterize PDF",
 
+        "em_ocr_pages": "PDF pages for OCR (e.g. 2-4,6; empty = all)",
+        "em_ocr_concurrency": "Parallel OCR requests",
+        "em_ocr_timeout": "Timeout per request (s)",
+        "em_ocr_progress": "OCR {done}/{total}",
+        "em_ocr_cache_stats": "Invoice cache: {entries:,} entries · {mb:.1f} MB · {hits:,} hits / {misses:,} misses",
+        "em_ocr_cache_clear": "Clear cache",
+
         "em_evidence_title": "Additional evidence",
         "em_evidence_types_label": "What type of evidence do you want to upload?",
         "em_evidence_building_extra": "Building photos (additional)",
@@ -140,6 +215,7 @@ TRANSLATIONS = {
         "em_btn_save_dataset": "Save site dataset (session memory)",
         "em_dataset_saved": "Dataset saved in session memory.",
         "em_ledger_view_title": "Normalized ledger (historical consolidated):",
+        "em_parse_paths": "Rows by source: {paths} · API calls avoided in this save: {avoided}",
         "em_baseline_title": "Baseline and EnPIs:",
         "em_kpi_kwh_year": "kWh/year (equiv.)",
         "em_kpi_unit_cost": "$/kWh",
@@ -162,6 +238,30 @@ TRANSLATIONS = {
         "em_pdf_download": "⬇️ Download PDF (A4)",
         "em_pdf_fallback": "You can export the PDF directly from your browser.",
         "em_pdf_print_label": "🖨️ Print / Save as PDF (A4)",
+        "em_report_sites": "Sites to report",
+        "em_report_job_caption": "{site} · {status} · {secs:.0f} s · {chars:,} characters",
+        "em_report_status_queued": "queued",
+        "em_report_status_running": "generating",
+        "em_report_status_done": "ready",
+        "em_report_status_error": "error",
+        "em_report_status_cancelled": "cancelled",
+        "em_report_cancel": "Cancel",
+        "em_report_first_content": " · first content after {secs:.1f} s",
+        "em_report_from_cache": " · from cache",
+        "em_report_force": "Force regeneration (ignore cache)",
+        "em_report_cancelled": "Report cancelled.",
+        "em_report_budget": "Dataset token budget (0 = send uncompacted)",
+        "em_report_budget_help": "The site dataset is summarized (monthly stats, anomalies, evidence counts) to fit this budget before calling the model.",
+        "em_report_tokens": "{site}: ≈{tokens:,} dataset tokens (of {full:,} uncompacted)",
+        "em_report_tokens_over": " · does not fit the budget even at maximum compaction",
+        "em_report_prompt_tokens": " · ≈{tokens:,} prompt tokens",
+        "em_btn_batch_report": "Consolidated report for all sites",
+        "em_batch_progress": "Consolidated report: {done}/{total} sites generated",
+        "em_batch_building": "Building consolidated PDF and per-site files…",
+        "em_batch_caption": "Consolidated report · {sites} sites · {failed} without text · generated {generated_at}",
+        "em_batch_pdf_download": "⬇️ Download consolidated PDF",
+        "em_batch_html_download": "⬇️ Download consolidated report (HTML A4)",
+        "em_batch_zip_download": "⬇️ Download per-site reports (ZIP)",
     }
 }
 
@@ -237,145 +337,36 @@ def language_selector():
     st.session_state["lang"] = options[choice]
 
 
-# ========================= CONFIG / DEFAULTS =========================
-
-DEFAULT_CFG = {
-    "schemes": {
-        "LEED": {
-            "weights": {
-                "Energy": 0.30, "Water": 0.20, "Materials": 0.15,
-                "IEQ": 0.15, "Transport": 0.10, "Site": 0.05, "Innovation": 0.05
-            },
-            "metrics": {
-                "energy_saving_pct": {"label":"Ahorro energético (%) vs. baseline","category":"Energy","type":"pct","target":30},
-                "renewables_pct": {"label":"Energía renovable on-site (%)","category":"Energy","type":"pct","target":10},
-                "water_saving_pct": {"label":"Ahorro de agua (%) vs. baseline","category":"Water","type":"pct","target":30},
-                "recycled_content_pct": {"label":"Contenido reciclado de materiales (%)","category":"Materials","type":"pct","target":20},
-                "daylight_areas_pct": {"label":"Áreas con luz natural (%)","category":"IEQ","type":"pct","target":75},
-                "low_voc_pct": {"label":"Materiales de bajo VOC (%)","category":"IEQ","type":"pct","target":100},
-                "near_transit": {"label":"Cercanía a transporte público (sí/no)","category":"Transport","type":"bool","target":1},
-                "bike_parking": {"label":"Bicicleteros / duchas (sí/no)","category":"Transport","type":"bool","target":1},
-                "green_roof_pct": {"label":"Cubierta verde / reflectiva (%)","category":"Site","type":"pct","target":50},
-                "waste_recycled_pct": {"label":"Residuos de obra reciclados (%)","category":"Site","type":"pct","target":75},
-                "innovation_points": {"label":"Puntos de innovación (0–5)","category":"Innovation","type":"number","min":0,"max":5,"target":5}
-            }
-        },
-        "EDGE": {
-            "weights": {"Energy": 0.45, "Water": 0.35, "Materials": 0.20},
-            "metrics": {
-                "energy_saving_pct": {"label":"Ahorro energético (%) vs. baseline","category":"Energy","type":"pct","target":20},
-                "solar_ready": {"label":"Preparado para fotovoltaica (sí/no)","category":"Energy","type":"bool","target":1},
-                "water_saving_pct": {"label":"Ahorro de agua (%) vs. baseline","category":"Water","type":"pct","target":20},
-                "fixtures_efficiency_score": {"label":"Eficiencia de artefactos sanitarios (0–1)","category":"Water","type":"number","min":0,"max":1,"target":1},
-                "embodied_carbon_reduction_pct": {"label":"Reducción de carbono incorporado (%)","category":"Materials","type":"pct","target":20},
-                "local_materials_pct": {"label":"Materiales locales (%)","category":"Materials","type":"pct","target":25}
-            }
-        }
-    }
-}
-
-DEFAULT_SAMPLE = pd.DataFrame([
-    {"project_name":"Edificio A – Oficinas","typology":"Oficinas",
-     "energy_saving_pct":25,"renewables_pct":5,"water_saving_pct":22,"recycled_content_pct":18,
-     "daylight_areas_pct":70,"low_voc_pct":100,"near_transit":1,"bike_parking":1,
-     "green_roof_pct":20,"waste_recycled_pct":60,"innovation_points":2.0,"solar_ready":1,
-     "fixtures_efficiency_score":0.8,"embodied_carbon_reduction_pct":10,"local_materials_pct":30},
-    {"project_name":"Torre C – Residencial","typology":"Residencial",
-     "energy_saving_pct":35,"renewables_pct":12,"water_saving_pct":28,"recycled_content_pct":10,
-     "daylight_areas_pct":50,"low_voc_pct":80,"near_transit":0,"bike_parking":0,
-     "green_roof_pct":0,"waste_recycled_pct":40,"innovation_points":1.0,"solar_ready":0,
-     "fixtures_efficiency_score":0.6,"embodied_carbon_reduction_pct":15,"local_materials_pct":20},
-])
+# ========================= CONFIG (CACHÉS DE STREAMLIT) =========================
 
 @st.cache_data
 def load_config():
-    cfg_path = Path("config/scoring_config.json")
-    if cfg_path.exists():
-        return json.loads(cfg_path.read_text(encoding="utf-8"))
-    return DEFAULT_CFG
-
-def clamp01(x: float) -> float:
-    if x is None: return 0.0
-    try: x = float(x)
-    except: x = 0.0
-    return max(0.0, min(1.0, x))
-
-def normalize(value, meta):
-    target = meta.get("target", 1)
-    typ = meta.get("type", "number")
-    if typ == "bool":
-        v = 1.0 if bool(value) else 0.0
-        return clamp01(v / target if target else v)
+    return read_scoring_config()
+
+@st.cache_resource
+def load_compiled_scheme(scheme: str) -> CompiledScheme:
+    """CompiledScheme cacheado por nombre de esquema (se compila una vez por proceso)."""
+    return compile_scheme(load_config()["schemes"][scheme])
+
+@st.cache_data(show_spinner=False)
+def _read_portfolio_csv(data: bytes) -> pd.DataFrame:
     try:
-        v = float(value)
-    except:
-        v = 0.0
-    if typ in ("pct", "number"):
-        return clamp01(v / float(target)) if float(target) != 0 else 0.0
-    return clamp01(v)
-
-def compute_scores(inputs: dict, scheme_cfg: dict):
-    weights = scheme_cfg["weights"]
-    metrics = scheme_cfg["metrics"]
-    cat_vals = {cat: [] for cat in weights.keys()}
-    metric_rows = []
-    for key, meta in metrics.items():
-        cat = meta["category"]
-        val = inputs.get(key, 0)
-        norm = normalize(val, meta)
-        cat_vals.setdefault(cat, []).append(norm)
-        metric_rows.append({"metric": key, "label": meta.get("label", key), "category": cat, "value": val, "normalized": norm})
-    cat_scores = {cat: (sum(vals)/len(vals) if vals else 0.0) for cat, vals in cat_vals.items()}
-    total = sum(cat_scores.get(cat, 0.0) * w for cat, w in weights.items()) * 100.0
-    contribs = [{"Category": c, "Contribution": cat_scores.get(c,0.0)*w*100.0} for c, w in weights.items()]
-    return total, pd.DataFrame(contribs), pd.DataFrame(metric_rows)
-
-def label_tier(score: float):
-    return ("Platinum (demo)" if score>=85 else
-            "Gold (demo)" if score>=75 else
-            "Silver (demo)" if score>=65 else
-            "Bronze (demo)" if score>=50 else
-            "Starter (demo)")
-
-# ========================= UTILIDADES REPORTE / PDF =========================
-
-def _slugify(text: str) -> str:
-    t = re.sub(r"[^a-zA-Z0-9\s\-_/]", "", text or "")
-    t = re.sub(r"\s+", "-", t.strip())
-    return t.lower()[:80] or "sec"
-
-def _markdownish_to_html_and_toc(llm_text: str):
-    lines = (llm_text or "").splitlines()
-    body_parts, toc = [], []
-    section_keys = [
-        "Resumen Ejecutivo", "Alcance", "Contexto", "Revisión Energética",
-        "Línea de Base", "EnPIs", "Oportunidades", "Medidas", "Ahorros",
-        "Plan de Implementación", "Monitoreo", "Verificación", "M&V",
-        "Riesgos", "Recomendaciones", "Conclusiones"
-    ]
-    for raw in lines:
-        line = raw.strip()
-        if not line:
-            continue
-        if line.startswith("### "):
-            title = line[4:].strip()
-            sid = _slugify(title)
-            toc.append(("h3", title, sid))
-            body_parts.append(f'<h3 id="{sid}">{title}</h3>')
-        elif line.startswith("## "):
-            title = line[3:].strip()
-            sid = _slugify(title)
-            toc.append(("h2", title, sid))
-            body_parts.append(f'<h2 id="{sid}">{title}</h2>')
-        elif any(k.lower() in line.lower() for k in section_keys) and len(line) < 80:
-            title = line
-            sid = _slugify(title)
-            toc.append(("h2", title, sid))
-            body_parts.append(f'<h2 id="{sid}">{title}</h2>')
-        else:
-            body_parts.append(f"<p>{line}</p>")
-    html_body = "\n".join(body_parts) if body_parts else f"<p>{llm_text or ''}</p>"
-    return html_body, toc
+        return pd.read_csv(BytesIO(data))
+    except Exception:
+        return pd.read_csv(BytesIO(data), encoding="utf-8", encoding_errors="ignore")
+
+# ========================= AVISOS DEL MOTOR =========================
+
+def _show_diagnostics(diags: Diagnostics):
+    """Muestra los Diagnostics del motor como avisos de Streamlit (sin repetir mensajes)."""
+    show = {"error": st.error, "warning": st.warning, "info": st.info}
+    seen = set()
+    for d in diags:
+        if d["message"] not in seen:
+            seen.add(d["message"])
+            show.get(d["level"], st.warning)(d["message"])
+
+# ========================= REPORTE (DESCARGA / IMPRESIÓN) =========================
 
 def _em_download_button_html(html: str, filename: str, label: str = "Descargar reporte (HTML)"):
     import base64
@@ -383,122 +374,6 @@ def _em_download_button_html(html: str, filename: str, label: str = "Descargar r
     href = f'<a download="{filename}" href="data:text/html;base64,{b64}">{label}</a>'
     st.markdown(href, unsafe_allow_html=True)
 
-def _em_render_report_html(org: str, site: str, generated_at: str, llm_text: str,
-                           brand_color: str, logo_url: str) -> str:
-    body_html, _ = _markdownish_to_html_and_toc(llm_text)
-    style = f"""
-    <style>
-      :root {{ --brand: {brand_color or '#0B8C6B'}; }}
-      html, body {{ background:#fff !important; color:#1b1f24; margin:0; padding:0; }}
-      body {{ font-family: Inter, system-ui, Segoe UI, Roboto, Arial, sans-serif; }}
-      .page {{ background:#fff; padding:24px; }}
-      .header {{ display:flex; align-items:center; gap:16px; border-bottom:3px solid var(--brand); padding-bottom:12px; margin-bottom:24px; }}
-      .badge {{ background: var(--brand); color:#fff; padding:4px 10px; border-radius:999px; font-size:12px; margin-left:auto; }}
-      .meta {{ color:#667085; font-size:12px; }}
-      .section h2 {{ color: var(--brand); border-bottom:1px solid #eaecef; padding-bottom:6px; }}
-      .prose p {{ line-height:1.6; }}
-    </style>
-    """
-    logo_html = f'<img src="{logo_url}" alt="Logo" height="42"/>' if logo_url else ""
-    body = f"""
-    <div class="page">
-      <div class="header">
-        {logo_html}
-        <div>
-          <h1>Reporte de Gestión de la Energía (ISO 50001)</h1>
-          <div class="meta">{org} – {site} · Generado: {generated_at}</div>
-        </div>
-        <span class="badge">Green&nbsp;Score</span>
-      </div>
-      <div class="section prose">
-        {body_html}
-      </div>
-    </div>
-    """
-    return f"<!doctype html><html lang='es'><head><meta charset='utf-8'/><meta name='viewport' content='width=device-width,initial-scale=1'/><title>Reporte Energético – {org} / {site}</title>{style}</head><body>{body}</body></html>"
-
-def _em_render_report_pdf_html(org: str, site: str, generated_at: str, llm_text: str,
-                               brand_color: str, logo_url: str) -> str:
-    body_html, toc = _markdownish_to_html_and_toc(llm_text)
-    if toc:
-        toc_items = []
-        for level, title, sid in toc:
-            indent = "0" if level == "h2" else "12"
-            toc_items.append(f'<div style="margin-left:{indent}pt;">• <a href="#{sid}">{title}</a></div>')
-        toc_html = "<h2>Índice</h2>" + "\n".join(toc_items)
-    else:
-        toc_html = "<h2>Índice</h2><p>(No se detectaron encabezados en el texto del informe)</p>"
-
-    logo_img = f"<img src='{logo_url}' alt='Logo' style='height:64pt;vertical-align:middle;margin-right:10pt;'/>" if logo_url else ""
-    style = f"""
-    <style>
-      @page {{
-        size: A4;
-        margin: 2cm;
-        @bottom-right {{
-          content: "Página " counter(page) " de " counter(pages);
-          font-size: 9pt; color: #555;
-        }}
-      }}
-      body {{ background:#fff; color:#111; font-family: DejaVu Sans, Arial, sans-serif; font-size:12pt; }}
-      h1 {{ color:{brand_color or '#0B8C6B'}; font-size:22pt; margin:0 0 6pt 0; }}
-      h2 {{ color:{brand_color or '#0B8C6B'}; font-size:15pt; border-bottom:1px solid #ccc; padding-bottom:2pt; margin-top:14pt; }}
-      h3 {{ color:#222; font-size:12.5pt; margin-top:10pt; }}
-      p  {{ line-height:1.4; margin:0 0 8pt 0; }}
-      a  {{ color:{brand_color or '#0B8C6B'}; text-decoration:none; }}
-      .cover {{ text-align:center; padding-top:120pt; }}
-      .cover .title {{ font-size:28pt; color:{brand_color or '#0B8C6B'}; margin-top:10pt; }}
-      .meta {{ color:#555; font-size:11pt; margin-top:6pt; }}
-      .watermark {{
-        position: fixed; top: 35%; left: 10%;
-        transform: rotate(-20deg);
-        font-size: 72pt; color: #e6f2ef;
-        z-index: 0;
-      }}
-      .section {{ position: relative; z-index: 1; }}
-      .badge {{ float:right; background:{brand_color or '#0B8C6B'}; color:#fff; padding:2pt 6pt; border-radius:12pt; font-size:9pt; }}
-      .headerline {{ border-bottom:2pt solid {brand_color or '#0B8C6B'}; padding-bottom:6pt; margin-bottom:12pt; }}
-      @media print {{ .no-print {{ display:none; }} }}
-    </style>
-    """
-    cover = f"""
-    <div class="watermark">GreenScore</div>
-    <div class="cover">
-      {logo_img}
-      <div class="title">Reporte de Gestión de la Energía (ISO 50001)</div>
-      <div class="meta" style="margin-top:18pt;">{org} – {site}</div>
-      <div class="meta">Generado: {generated_at}</div>
-      <div class="meta" style="margin-top:24pt;"><span class="badge">Green&nbsp;Score</span></div>
-    </div>
-    <pdf:nextpage/>
-    """
-    toc_page = f"""
-    <div class="section">
-      <div class="headerline"><h1>Contenido</h1></div>
-      {toc_html}
-    </div>
-    <pdf:nextpage/>
-    """
-    body = f"""
-    <div class="section">
-      <div class="headerline"><h1>Informe</h1></div>
-      {body_html}
-    </div>
-    """
-    return f"<!doctype html><html><head><meta charset='utf-8'/>{style}</head><body>{cover}{toc_page}{body}</body></html>"
-
-def _em_html_to_pdf_bytes(html: str) -> bytes | None:
-    try:
-        from io import BytesIO
-        from xhtml2pdf import pisa
-        out = BytesIO()
-        if not html.lower().strip().startswith("<!doctype"):
-            html = "<!doctype html><html><head><meta charset='utf-8'></head><body>" + html + "</body></html>"
-        pisa.CreatePDF(src=html, dest=out, encoding="utf-8")
-        return out.getvalue()
-    except Exception:
-        return None
-
 def _em_show_print_button(html: str, label: str = "🖨️ Imprimir / Guardar como PDF (A4)"):
     import html as _html
     _ = _html.escape(html)
@@ -523,377 +398,10 @@ def _em_show_print_button(html: str, label: str = "🖨️ Imprimir / Guardar co
     """
     st.components.v1.html(payload, height=60)
 
-# ========================= OPENAI (reporte y OCR/parse) =========================
-
-def _openai_client():
-    import os
-    from openai import OpenAI
-    api_key = os.getenv("OPENAI_API_KEY")
-    if not api_key:
-        raise RuntimeError("Falta OPENAI_API_KEY en Secrets/entorno.")
-    return OpenAI(api_key=api_key)
-
-def _em_openai_report(dataset: dict, brand_color: str, logo_url: str,
-                      model: str = "gpt-4o-mini", detail_level: int = 3,
-                      temperature: float = 0.2) -> str:
-    import json as _json
-    try:
-        client = _openai_client()
-        depth_map = {
-            1: "Resumen ejecutivo muy sintético, no exceder 300 palabras.",
-            2: "Resumen breve + hallazgos clave (≈500 palabras).",
-            3: "Informe estándar con secciones completas y cifras básicas (≈900 palabras).",
-            4: "Informe amplio con justificación técnica y tablas en texto (≈1400 palabras).",
-            5: "Informe técnico exhaustivo, supuestos, riesgos, fórmulas simples y M&V detallada (≈2000 palabras)."
-        }
-        guidance = depth_map.get(int(detail_level), depth_map[3])
-        system = (
-            "Eres consultor sénior en gestión de la energía bajo ISO 50001. "
-            "Redacta un informe institucional en español con tono profesional y claro. "
-            "DEBES usar los valores de línea de base y EnPIs provistos en dataset.derived "
-            "(kWh/año equivalente, $/kWh, kWh/m²·año, kWh/usuario·año) como referencia numérica. "
-            "Cita explícitamente la línea de base con su período (dataset.derived.baseline.period_start → period_end) "
-            "y construye EnPIs a partir de esos valores. Si faltan, indícalo como limitación de datos. "
-            "Incluye estas secciones (con encabezados explícitos): "
-            "Resumen Ejecutivo; Alcance y Contexto; Revisión Energética; "
-            "Línea de Base y EnPIs; Oportunidades y Medidas; "
-            "Estimación de Ahorros (kWh/año, %, costo, payback simple); "
-            "Plan de Implementación; Monitoreo y Verificación (M&V); "
-            "Riesgos y Recomendaciones."
-        )
-        user = (
-            f"PARÁMETROS DE REDACCIÓN: {guidance}\n\n"
-            f"DATOS (JSON):\n{_json.dumps(dataset, ensure_ascii=False)}"
-        )
-        out = client.chat.completions.create(
-            model=model,
-            temperature=float(temperature),
-            messages=[{"role":"system","content":system},{"role":"user","content":user}]
-        )
-        return out.choices[0].message.content
-    except Exception as e:
-        return (f"AVISO: No fue posible llamar a OpenAI ({e}). "
-                "Revisá el modelo, la versión del SDK y la clave.")
-
-# --------- OCR IMAGEN (ROBUSTO) ---------
-
-def _ocr_image_invoice_with_openai(file_bytes: bytes, filename: str, model: str = "gpt-4o-mini"):
-    """
-    OCR de una imagen (PNG/JPG) con OpenAI Vision → filas mensuales.
-    Preprocesa (resize<=1200px, grises, contraste/umbral), fuerza JSON estricto y hace retries.
-    Guarda /tmp/last_ocr_raw.json si falla el parseo.
-    """
-    import base64, time, json as _json
-    from PIL import Image, ImageOps
-
-    def _preprocess(img_bytes: bytes) -> bytes:
-        with Image.open(BytesIO(img_bytes)) as im:
-            im = im.convert("L")
-            max_side = 1200
-            w, h = im.size
-            scale = min(max_side / max(w, h), 1.0)
-            if scale < 1.0:
-                im = im.resize((int(w*scale), int(h*scale)), Image.LANCZOS)
-            im = ImageOps.autocontrast(im)
-            # umbral suave: mejora contraste pero evita blanco/negro agresivo
-            im = ImageOps.invert(ImageOps.invert(im).point(lambda p: 255 if p > 200 else (0 if p < 30 else p)))
-            buf = BytesIO()
-            im.save(buf, format="PNG", optimize=True)
-            return buf.getvalue()
-
-    try:
-        client = _openai_client()
-    except Exception as e:
-        st.warning(f"OCR no disponible: {e}")
-        return pd.DataFrame()
-
-    pre = _preprocess(file_bytes)
-    b64 = base64.b64encode(pre).decode("utf-8")
-    image_url = f"data:image/png;base64,{b64}"
-
-    prompt = (
-        "Extrae datos de la factura de energía. Devuelve JSON con la clave 'rows' (lista). "
-        "Cada elemento debe tener: year_month (YYYY-MM), kwh (número), cost (número), "
-        "demand_kw (número o null), currency (texto breve, p.ej. ARS/USD). "
-        "Si ves varias facturas o meses en la imagen, devolvé varias filas. "
-        "No incluyas comentarios fuera del JSON."
-    )
-
-    delays = [0.5, 1.0, 2.0]
-    last_raw = ""
-    for delay in [0.0] + delays:
-        if delay:
-            time.sleep(delay)
-        try:
-            out = client.chat.completions.create(
-                model=model,
-                temperature=0.0,
-                response_format={"type": "json_object"},
-                messages=[
-                    {"role": "system", "content": "Sos un extractor de datos que siempre responde JSON válido."},
-                    {"role": "user", "content": [
-                        {"type": "text", "text": prompt},
-                        {"type": "image_url", "image_url": {"url": image_url}}
-                    ]}
-                ]
-            )
-            raw = out.choices[0].message.content or "{}"
-            last_raw = raw
-            data = json.loads(raw)
-            rows = data.get("rows", [])
-            recs = []
-            for r in rows:
-                ym = str(r.get("year_month") or "").strip()
-                dt = pd.to_datetime(ym + "-01", errors="coerce")
-                recs.append({
-                    "_year_month": dt if pd.notna(dt) else pd.NaT,
-                    "_kwh": float(r.get("kwh") or 0),
-                    "_cost": float(r.get("cost") or 0),
-                    "_demand_kw": float(r.get("demand_kw")) if r.get("demand_kw") not in (None, "") else None,
-                    "_currency": (str(r.get("currency") or "").strip() or None),
-                    "_source": filename
-                })
-            if recs:
-                return pd.DataFrame(recs)
-        except Exception:
-            continue
-
-    try:
-        Path("/tmp/last_ocr_raw.json").write_text(last_raw, encoding="utf-8")
-    except Exception:
-        pass
-    st.warning(f"No se pudo OCR {filename}: respuesta no JSON. Se guardó /tmp/last_ocr_raw.json para depurar.")
-    return pd.DataFrame()
-
-# --------- PDF: TEXTO + RENDER A IMAGEN (pypdfium2) ---------
-
-def _extract_text_from_pdf_simple(file_obj) -> str:
-    try:
-        import PyPDF2
-    except Exception:
-        return ""
-    try:
-        reader = PyPDF2.PdfReader(file_obj)
-        chunks = []
-        for page in reader.pages:
-            try:
-                chunks.append(page.extract_text() or "")
-            except Exception:
-                continue
-        return "\n".join(chunks).strip()
-    except Exception:
-        return ""
-
-def _pdf_to_images(file_bytes: bytes, dpi: int = 200):
-    """
-    Convierte PDF a lista de imágenes PNG (bytes) usando pypdfium2.
-    """
-    try:
-        import pypdfium2 as pdfium
-        from PIL import Image  # noqa: F401
-    except Exception:
-        return []
-    imgs = []
-    try:
-        pdf = pdfium.PdfDocument(BytesIO(file_bytes))
-        n_pages = len(pdf)
-        for i in range(n_pages):
-            page = pdf.get_page(i)
-            pil = page.render(scale=dpi/72).to_pil()
-            buf = BytesIO()
-            pil.save(buf, format="PNG")
-            imgs.append(buf.getvalue())
-            page.close()
-        pdf.close()
-    except Exception:
-        return []
-    return imgs
-
-def _parse_invoice_text_blocks_with_llm(raw_text: str, filename: str, model: str = "gpt-4o-mini") -> pd.DataFrame:
-    """
-    Convierte texto crudo (PDF con texto) a filas mensuales. JSON estricto + retries.
-    """
-    if not (raw_text or "").strip():
-        return pd.DataFrame()
-    import json as _json, time
-    try:
-        client = _openai_client()
-    except Exception as e:
-        st.warning(f"Parser LLM deshabilitado: {e}")
-        return pd.DataFrame()
-
-    instruction = (
-        "A partir del texto de una factura(s) de energía, devolvé JSON válido con una lista 'rows' "
-        "de registros mensuales: year_month (YYYY-MM), kwh (número), cost (número), "
-        "demand_kw (número o null), currency (texto). No incluyas comentarios fuera del JSON."
-    )
-
-    delays = [0.5, 1.0, 2.0]
-    last_raw = ""
-    for delay in [0.0] + delays:
-        if delay:
-            time.sleep(delay)
-        try:
-            out = client.chat.completions.create(
-                model=model,
-                temperature=0.0,
-                response_format={"type": "json_object"},
-                messages=[
-                    {"role": "system", "content": "Sos un extractor de datos de facturas que siempre responde JSON válido."},
-                    {"role": "user", "content": f"{instruction}\n\nTEXTO (truncado):\n{raw_text[:16000]}"}  # trunc seguridad
-                ]
-            )
-            raw = out.choices[0].message.content or "{}"
-            last_raw = raw
-            data = _json.loads(raw)
-            rows = data.get("rows", [])
-            recs = []
-            for r in rows:
-                ym = str(r.get("year_month") or "").strip()
-                dt = pd.to_datetime(ym + "-01", errors="coerce")
-                recs.append({
-                    "_year_month": dt if pd.notna(dt) else pd.NaT,
-                    "_kwh": float(r.get("kwh") or 0),
-                    "_cost": float(r.get("cost") or 0),
-                    "_demand_kw": float(r.get("demand_kw")) if r.get("demand_kw") not in (None, "") else None,
-                    "_currency": (str(r.get("currency") or "").strip() or None),
-                    "_source": filename
-                })
-            if recs:
-                return pd.DataFrame(recs)
-        except Exception:
-            continue
-
-    try:
-        Path("/tmp/last_ocr_raw.json").write_text(last_raw, encoding="utf-8")
-    except Exception:
-        pass
-    st.warning(f"No se pudo interpretar texto de PDF {filename}: respuesta no JSON. Se guardó /tmp/last_ocr_raw.json.")
-    return pd.DataFrame()
-
-# ========================= RESUMEN / BASELINE / ENPI =========================
-
-def _em_summarize_invoices(inv_df: pd.DataFrame, total_area_m2: float, users_count: int,
-                           baseline_start: str | None, baseline_end: str | None):
-    result = {"monthly_series": [], "metrics": {}, "period": {"start": None, "end": None}, "notes": []}
-    if inv_df is None or inv_df.empty or "_year_month" not in inv_df.columns:
-        result["notes"].append("No hay datos tabulares de facturas (o no se detectó período).")
-        return result
-
-    df = inv_df.copy()
-    df = df.dropna(subset=["_year_month"])
-    if df.empty:
-        result["notes"].append("No se pudo interpretar el período de facturación.")
-        return result
-
-    grp = df.groupby("_year_month", as_index=False).agg(
-        kwh=("_kwh","sum"),
-        cost=("_cost","sum"),
-        demand_kw=("_demand_kw","max")
-    ).sort_values("_year_month")
-
-    result["monthly_series"] = [
-        {"month": d.strftime("%Y-%m"), "kwh": float(k or 0), "cost": float(c or 0), "demand_kw": float(dk or 0) if pd.notna(dk) else None}
-        for d,k,c,dk in zip(grp["_year_month"], grp["kwh"], grp["cost"], grp["demand_kw"])
-    ]
-
-    total_kwh = float(grp["kwh"].fillna(0).sum())
-    total_cost = float(grp["cost"].fillna(0).sum())
-    months = int(grp.shape[0])
-    unit_cost = (total_cost / total_kwh) if total_kwh > 0 else None
-
-    factor = 12 / months if months and months < 12 else 1.0
-    kwh_year_equiv = total_kwh * factor
-    kwh_per_m2_yr = (kwh_year_equiv / total_area_m2) if total_area_m2 and total_area_m2 > 0 else None
-    kwh_per_user_yr = (kwh_year_equiv / users_count) if users_count and users_count > 0 else None
-
-    result["metrics"] = {
-        "total_kwh": total_kwh, "total_cost": total_cost, "unit_cost": unit_cost,
-        "months": months, "kwh_year_equiv": kwh_year_equiv,
-        "kwh_per_m2_yr": kwh_per_m2_yr, "kwh_per_user_yr": kwh_per_user_yr
-    }
-
-    start = grp["_year_month"].min()
-    end = grp["_year_month"].max()
-    result["period"] = {
-        "start": start.strftime("%Y-%m") if pd.notna(start) else None,
-        "end": end.strftime("%Y-%m") if pd.notna(end) else None,
-        "baseline_start": str(baseline_start) if baseline_start else None,
-        "baseline_end": str(baseline_end) if baseline_end else None
-    }
-
-    if months < 6:
-        result["notes"].append("Menos de 6 meses de datos: la anualización puede ser poco representativa.")
-    if total_kwh == 0:
-        result["notes"].append("kWh total = 0 (revisar extracción/columnas).")
-    return result
-
-def _em_compute_baseline_from_invoices(invoices_summary: dict, total_area_m2: float, users_count: int):
-    res = {"baseline": {}, "enpi": {}, "notas": []}
-    if not invoices_summary or "metrics" not in invoices_summary:
-        res["notas"].append("No hay métricas de facturas para baseline/EnPI.")
-        return res
-    m = invoices_summary.get("metrics", {})
-    p = invoices_summary.get("period", {})
-    total_kwh = m.get("total_kwh") or 0.0
-    kwh_year_equiv = m.get("kwh_year_equiv") or total_kwh
-    unit_cost = m.get("unit_cost")
-    kwh_per_m2_yr = m.get("kwh_per_m2_yr")
-    kwh_per_user_yr = m.get("kwh_per_user_yr")
-    if (not kwh_per_m2_yr) and total_area_m2:
-        kwh_per_m2_yr = (kwh_year_equiv / total_area_m2) if total_area_m2 > 0 else None
-    if (not kwh_per_user_yr) and users_count:
-        kwh_per_user_yr = (kwh_year_equiv / users_count) if users_count > 0 else None
-    res["baseline"] = {
-        "period_start": p.get("start"),
-        "period_end": p.get("end"),
-        "kwh_year_equiv": kwh_year_equiv,
-        "unit_cost": unit_cost
-    }
-    res["enpi"] = {
-        "kwh_per_m2_yr": kwh_per_m2_yr,
-        "kwh_per_user_yr": kwh_per_user_yr,
-        "cost_per_kwh": unit_cost
-    }
-    notes = invoices_summary.get("notes", []) or invoices_summary.get("notas", [])
-    res["notas"].extend(notes)
-    return res
-
-# ========================= HELPERS DE CARGA =========================
-
-def _normalize_invoice_table(df: pd.DataFrame, source_name: str) -> pd.DataFrame:
-    cols = {c.lower().strip(): c for c in df.columns}
-    def pick(cands):
-        for k in cands:
-            if k in cols: return cols[k]
-        return None
-    c_date  = pick(["fecha","date","periodo","period","billing_period","mes","month"])
-    c_kwh   = pick(["kwh","consumo_kwh","consumption_kwh","energy_kwh","active_energy_kwh"])
-    c_cost  = pick(["costo","cost","importe","monto","amount","total"])
-    c_dem   = pick(["demanda_kw","kw","peak_kw","dem_kw"])
-    c_curr  = pick(["moneda","currency"])
-
-    if c_date:
-        try: df["_date"] = pd.to_datetime(df[c_date], dayfirst=True, errors="coerce")
-        except Exception: df["_date"] = pd.to_datetime(df[c_date], errors="coerce")
-        m = df["_date"].isna() & df[c_date].astype(str).str.match(r"^\d{4}-\d{2}$")
-        if m.any():
-            df.loc[m, "_date"] = pd.to_datetime(df.loc[m, c_date] + "-01", errors="coerce")
-        df["_year_month"] = df["_date"].dt.to_period("M").dt.to_timestamp()
-    else:
-        df["_year_month"] = pd.NaT
-
-    for src, dst in [(c_kwh, "_kwh"), (c_cost, "_cost"), (c_dem, "_demand_kw")]:
-        if src: df[dst] = pd.to_numeric(df[src], errors="coerce")
-        else:   df[dst] = None
-
-    df["_currency"] = df[c_curr].astype(str) if c_curr else None
-    df["_source"] = source_name
-    return df
-
 # ========================= PÁGINAS (UI) =========================
 
 def page_proyecto_individual():
+    import altair as alt  # diferido: solo lo pagan las páginas con gráficos
     cfg = load_config()
     SCHEMES = list(cfg["schemes"].keys())
 
@@ -929,8 +437,12 @@ def page_proyecto_individual():
         submitted = st.form_submit_button(_t("pi_btn_calc", "Calcular score"), use_container_width=True)
 
     if submitted:
-        scheme_cfg = cfg["schemes"][st.session_state.get("pi_scheme", SCHEMES[0])]
-        total, contrib_df, metric_df = compute_scores(inputs, scheme_cfg)
+        try:
+            scheme_c = load_compiled_scheme(st.session_state.get("pi_scheme", SCHEMES[0]))
+        except ValueError as e:
+            st.error(str(e))
+            return
+        total, contrib_df, metric_df = compute_scores(inputs, scheme_c)
         st.metric(_t("pi_score_metric", "Score total (0–100)"), f"{total:.1f}")
         st.success(f"{_t('pi_class_demo', 'Clasificación demo')}: **{label_tier(total)}**")
         st.altair_chart(
@@ -956,6 +468,11 @@ def page_portfolio():
         key="pf_scheme"
     )
     scheme_cfg = cfg["schemes"][scheme]
+    try:
+        scheme_c = load_compiled_scheme(scheme)
+    except ValueError as e:
+        st.error(str(e))
+        return
 
     st.write(_t(
         "pf_upload_help",
@@ -977,12 +494,21 @@ def page_portfolio():
             file_name="sample_portfolio_with_typologies.csv"
         )
 
+    stores = list_portfolio_stores()
+    if stores:
+        store = st.selectbox(_t("pf_store_open", "Abrir portfolio guardado (Parquet)"), ["—"] + stores,
+                             index=0, key="pf_store")
+        if store != "—":
+            _page_portfolio_store(scheme, scheme_c, store)
+            return
+
     file = st.file_uploader(_t("pf_upload_csv", "Subir CSV"), type=["csv"])
+    if st.toggle(_t("pf_stream_toggle", "Modo streaming (CSV muy grandes, lectura por bloques)"),
+                 value=False, key="pf_stream"):
+        _page_portfolio_streaming(scheme_c, file)
+        return
     if file:
-        try:
-            df = pd.read_csv(file)
-        except Exception:
-            df = pd.read_csv(file, encoding="utf-8", errors="ignore")
+        df = _read_portfolio_csv(file.getvalue())
     else:
         df = DEFAULT_SAMPLE.copy()
 
@@ -1003,11 +529,15 @@ def page_portfolio():
         for m in missing:
             df[m] = 0
 
-    def score_row(r):
-        inputs = {k: r.get(k, 0) for k in metrics}
-        return compute_scores(inputs, scheme_cfg)[0]
-
-    df["score"] = df.apply(score_row, axis=1)
+    if "pf_score_cache" not in st.session_state:
+        st.session_state["pf_score_cache"] = ScoreCache()
+    score_cache = st.session_state["pf_score_cache"]
+    df["score"] = score_cache.score(df, scheme_c)
+    st.caption(_t(
+        "pf_cache_stats",
+        "Caché de scores: {hits:,} reutilizados · {misses:,} recalculados (sesión: {tot_hits:,} / {tot_misses:,})"
+    ).format(hits=score_cache.last_hits, misses=score_cache.last_misses,
+             tot_hits=score_cache.hits, tot_misses=score_cache.misses))
 
     with st.expander(_t("pf_filters", "Filtros"), expanded=True):
         tps = sorted(df["typology"].astype(str).unique().tolist())
@@ -1030,20 +560,60 @@ def page_portfolio():
                  hide_index=True, use_container_width=True)
 
     if len(view):
-        st.altair_chart(
-            alt.Chart(view).mark_bar().encode(
-                x=alt.X("score:Q", title=_t("pf_chart_score_title", "Score")),
-                y=alt.Y("project_name:N", sort="-x", title=_t("pf_chart_score_y", "Proyecto")),
-                color=alt.Color("typology:N", title=_t("pf_chart_typology", "Tipología")),
-                tooltip=[
-                    alt.Tooltip("project_name:N"),
-                    alt.Tooltip("typology:N", title=_t("pf_chart_typology", "Tipología")),
-                    alt.Tooltip("score:Q", format=".1f")
-                ]
-            ).properties(height=420),
-            use_container_width=True
-        )
         by_tp = view.groupby("typology", as_index=False)["score"].mean().sort_values("score", ascending=False)
+        _portfolio_charts(view, by_tp)
+
+    with st.expander(_t("pf_all_schemes_title", "📊 Puntuar con todos los esquemas"), expanded=False):
+        # el resultado vale solo para el mismo archivo y la misma config (no alcanza con el largo)
+        pf_key = portfolio_fingerprint(df.drop(columns=["score"]), cfg)
+        if st.button(_t("pf_all_schemes_btn", "Calcular todos los esquemas (multi-núcleo)"), key="pf_all_schemes"):
+            with st.spinner(_t("pf_all_schemes_running", "Puntuando en paralelo…")):
+                wide = score_all_schemes(df, cfg)
+            st.session_state["pf_all_scores"] = (
+                pf_key, pd.concat([df[["project_name", "typology"]], wide], axis=1))
+        cached_key, wide = st.session_state.get("pf_all_scores") or (None, None)
+        if wide is not None and cached_key == pf_key:
+            st.dataframe(wide, hide_index=True, use_container_width=True)
+            st.download_button(
+                _t("pf_all_schemes_download", "⬇️ Descargar scores de todos los esquemas (CSV)"),
+                data=wide.to_csv(index=False),
+                file_name="portfolio_scores_all_schemes.csv"
+            )
+
+    with st.expander(_t("pf_store_save_title", "💾 Guardar en almacén local (Parquet)"), expanded=False):
+        store_name = st.text_input(_t("pf_store_name", "Nombre del portfolio"), getattr(file, "name", "demo").rsplit(".", 1)[0],
+                                   key="pf_store_name")
+        if st.button(_t("pf_store_save_btn", "Guardar portfolio"), key="pf_store_save"):
+            try:
+                path = write_portfolio_store(df.drop(columns=["score"]), store_name, cfg)
+                st.success(_t("pf_store_saved", "Portfolio guardado en {path}.").format(path=path))
+            except ImportError as e:
+                st.info(_t("pf_store_unavailable",
+                           "El almacén Parquet no está disponible (no se pudo importar pyarrow: {error}).").format(error=e))
+
+    st.download_button(
+        _t("pf_download_results", "⬇️ Descargar resultados (CSV)"),
+        data=view.to_csv(index=False),
+        file_name="portfolio_scores.csv"
+    )
+
+def _portfolio_charts(bars: pd.DataFrame, by_tp: pd.DataFrame):
+    """Gráficos del portfolio: score por proyecto (`bars`) y promedio por tipología (`by_tp`)."""
+    import altair as alt
+    st.altair_chart(
+        alt.Chart(bars).mark_bar().encode(
+            x=alt.X("score:Q", title=_t("pf_chart_score_title", "Score")),
+            y=alt.Y("project_name:N", sort="-x", title=_t("pf_chart_score_y", "Proyecto")),
+            color=alt.Color("typology:N", title=_t("pf_chart_typology", "Tipología")),
+            tooltip=[
+                alt.Tooltip("project_name:N"),
+                alt.Tooltip("typology:N", title=_t("pf_chart_typology", "Tipología")),
+                alt.Tooltip("score:Q", format=".1f")
+            ]
+        ).properties(height=420),
+        use_container_width=True
+    )
+    if len(by_tp):
         st.altair_chart(
             alt.Chart(by_tp).mark_bar().encode(
                 x=alt.X("score:Q", title=_t("pf_chart_typology_avg", "Promedio por tipología")),
@@ -1056,6 +626,118 @@ def page_portfolio():
             use_container_width=True
         )
 
+def _page_portfolio_store(scheme: str, scheme_c: CompiledScheme, store_name: str):
+    """Vista de un portfolio guardado en Parquet: los filtros se aplican como pushdown."""
+    try:
+        meta = portfolio_store_meta(store_name)
+    except Exception as e:
+        st.error(f"No se pudo abrir el portfolio {store_name}: {e}")
+        return
+    st.caption(_t("pf_store_info", "Portfolio guardado: {rows:,} proyectos · {at}").format(
+        rows=meta.get("rows", 0), at=meta.get("written_at", "")))
+
+    with st.expander(_t("pf_filters", "Filtros"), expanded=True):
+        tps = meta.get("typologies", [])
+        filt_tp = st.multiselect(_t("pf_typologies", "Tipologías"), options=tps, default=tps, key="pf_tps")
+        q = st.text_input(_t("pf_search", "Buscar proyecto"), "", key="pf_q")
+        min_score = st.slider(_t("pf_min_score", "Score mínimo"), 0, 100, 0, 1, key="pf_minsc")
+
+    try:
+        view = read_portfolio_store(store_name, scheme, scheme_c,
+                                    typologies=filt_tp or None, min_score=min_score or None)
+    except ImportError as e:
+        st.info(_t("pf_store_unavailable",
+                   "El almacén Parquet no está disponible (no se pudo importar pyarrow: {error}).").format(error=e))
+        return
+    if q.strip(): view = view[view["project_name"].astype(str).str.contains(q, case=False, na=False)]
+    metrics = [k for k in scheme_c.keys if k in view.columns]
+
+    c1, c2, c3, c4 = st.columns(4)
+    with c1: st.metric(_t("pf_metric_projects", "Proyectos"), f"{len(view):,}")
+    with c2: st.metric(_t("pf_metric_avg", "Promedio"), f"{view['score'].mean():.1f}" if len(view) else "–")
+    with c3: st.metric(_t("pf_metric_max", "Máximo"), f"{view['score'].max():.1f}" if len(view) else "–")
+    with c4: st.metric(_t("pf_metric_typologies", "Tipologías"), f"{view['typology'].nunique():,}")
+
+    st.dataframe(view[["project_name", "typology", "score"] + metrics].nlargest(1000, "score"),
+                 hide_index=True, use_container_width=True)
+    if len(view):
+        by_tp = view.groupby("typology", as_index=False)["score"].mean().sort_values("score", ascending=False)
+        _portfolio_charts(view.nlargest(50, "score"), by_tp)
+
+    st.download_button(
+        _t("pf_download_results", "⬇️ Descargar resultados (CSV)"),
+        data=view.to_csv(index=False),
+        file_name="portfolio_scores.csv"
+    )
+
+def _page_portfolio_streaming(scheme_c: CompiledScheme, file):
+    """Vista de portfolio para CSV grandes: scores por bloques + agregados acumulados."""
+    local_path = st.text_input(
+        _t("pf_stream_path", "…o ruta local del CSV (sin límite de upload)"), "", key="pf_stream_path"
+    ).strip()
+    chunksize = st.number_input(_t("pf_stream_chunk", "Filas por bloque"), 10_000, 2_000_000, 200_000,
+                                10_000, key="pf_stream_chunk")
+    if local_path:
+        p = Path(local_path)
+        if not p.exists():
+            st.error(f"No existe el archivo: {local_path}")
+            return
+        stt = p.stat()
+        key = ("path", str(p), stt.st_mtime, stt.st_size, scheme_c.fingerprint, int(chunksize))
+        source = str(p)
+    elif file:
+        key = ("upload", file.name, file.size, scheme_c.fingerprint, int(chunksize))
+        source = file
+    else:
+        st.info(_t("pf_stream_need_file", "Subí un CSV o indicá una ruta local para el modo streaming."))
+        return
+
+    # el resultado se guarda en sesión: los filtros no vuelven a leer ni a puntuar el archivo
+    cached = st.session_state.get("pf_stream_result")
+    if not cached or cached[0] != key:
+        try:
+            with st.spinner(_t("pf_stream_running", "Procesando CSV por bloques…")):
+                res = score_portfolio_csv_streaming(source, scheme_c, chunksize=int(chunksize))
+        except ValueError as e:
+            st.error(str(e))
+            return
+        st.session_state["pf_stream_result"] = (key, res)
+    else:
+        res = cached[1]
+
+    if res["missing"]:
+        msg = ", ".join(res["missing"])
+        st.warning(_t("pf_warn_missing", f"Faltan métricas: {msg}. Se consideran 0.").format(missing=msg))
+    st.caption(_t("pf_stream_stats", "{rows:,} filas en {chunks:,} bloques.").format(
+        rows=res["rows"], chunks=res["chunks"]))
+
+    scores, by_tp = res["scores"], res["by_typology"]
+    with st.expander(_t("pf_filters", "Filtros"), expanded=True):
+        tps = sorted(by_tp["typology"].astype(str).tolist())
+        filt_tp = st.multiselect(_t("pf_typologies", "Tipologías"), options=tps, default=tps, key="pf_tps")
+        q = st.text_input(_t("pf_search", "Buscar proyecto"), "", key="pf_q")
+        min_score = st.slider(_t("pf_min_score", "Score mínimo"), 0, 100, 0, 1, key="pf_minsc")
+
+    # métricas y tipologías desde los agregados acumulados (solo filtro de tipología)
+    agg = by_tp[by_tp["typology"].isin(filt_tp)] if filt_tp else by_tp
+    n = int(agg["count"].sum())
+    c1, c2, c3, c4 = st.columns(4)
+    with c1: st.metric(_t("pf_metric_projects", "Proyectos"), f"{n:,}")
+    with c2: st.metric(_t("pf_metric_avg", "Promedio"), f"{agg['sum'].sum() / n:.1f}" if n else "–")
+    with c3: st.metric(_t("pf_metric_max", "Máximo"), f"{agg['max'].max():.1f}" if n else "–")
+    with c4: st.metric(_t("pf_metric_typologies", "Tipologías"), f"{len(agg):,}")
+
+    view = scores
+    if filt_tp: view = view[view["typology"].isin(filt_tp)]
+    if q.strip(): view = view[view["project_name"].str.contains(q, case=False, na=False)]
+    view = view[view["score"] >= min_score]
+    st.dataframe(view.nlargest(1000, "score"), hide_index=True, use_container_width=True)
+
+    top = res["top"]
+    if filt_tp: top = top[top["typology"].astype(str).isin(filt_tp)]
+    if len(top):
+        _portfolio_charts(top.astype({"typology": str}), agg.rename(columns={"mean": "score"})[["typology", "score"]])
+
     st.download_button(
         _t("pf_download_results", "⬇️ Descargar resultados (CSV)"),
         data=view.to_csv(index=False),
@@ -1092,7 +774,86 @@ def page_metodologia():
                  hide_index=True, use_container_width=True)
 
 
+def _page_energy_portfolio():
+    """Vista de portfolio energético: todos los sitios del ledger en una pasada vectorizada."""
+    import altair as alt
+    ledger = energy_ledger()
+    pf = energy_portfolio(ledger)
+    if pf.empty:
+        return
+    st.markdown("**" + _t("em_pf_title", "Portfolio energético (todos los sitios del ledger)") + "**")
+    tps = sorted(pf["building_type"].unique())
+    sel = st.multiselect(_t("em_pf_typologies", "Tipologías"), tps, default=tps, key="em_pf_tps")
+    view = pf[pf["building_type"].isin(sel)]
+    if view.empty:
+        return
+
+    area = view["area_m2"].where(view["area_m2"] > 0)
+    k1, k2, k3, k4 = st.columns(4)
+    k1.metric(_t("em_pf_sites", "Sitios"), f"{len(view):,}")
+    k2.metric(_t("em_kpi_kwh_year", "kWh/año (equiv.)"), f"{view['kwh_year_equiv'].sum():,.0f}")
+    eui = view["kwh_year_equiv"].where(area.notna()).sum() / area.sum() if area.sum() > 0 else None
+    k3.metric(_t("em_kpi_kwh_m2", "kWh/m²·año"), f"{eui:,.1f}" if eui else "–")
+    tot_kwh = view["total_kwh"].sum()
+    k4.metric(_t("em_kpi_unit_cost", "$/kWh"), f"{view['total_cost'].sum() / tot_kwh:,.4f}" if tot_kwh > 0 else "–")
+
+    st.dataframe(
+        view[["eui_rank", "site", "building_type", "area_m2", "users_count", "months", "kwh_year_equiv",
+              "kwh_per_m2_yr", "kwh_per_user_yr", "unit_cost", "baseline_kwh_year_equiv",
+              "kwh_change_pct", "typology_median_eui", "eui_vs_typology"]
+             + [c for c in ("regression_model", "cv_rmse", "kwh_per_m2_yr_normalized", "performance_ratio")
+                if c in view.columns]],
+        use_container_width=True, hide_index=True,
+    )
+    st.markdown("**" + _t("em_pf_benchmark", "Benchmark por tipología") + "**")
+    st.dataframe(energy_typology_benchmark(view), use_container_width=True, hide_index=True)
+
+    monthly = ledger.monthly(sites=view["site"].tolist())
+    if not monthly.empty:
+        st.altair_chart(
+            alt.Chart(monthly).mark_line(point=True).encode(
+                x=alt.X("_year_month:T", title=_t("em_trends_x", "Mes")),
+                y=alt.Y("kwh:Q", title=_t("em_trends_kwh", "kWh")),
+                tooltip=[alt.Tooltip("_year_month:T", title=_t("em_trends_x", "Mes"), format="%Y-%m"),
+                         alt.Tooltip("kwh:Q", title=_t("em_trends_kwh", "kWh"), format=",.0f"),
+                         alt.Tooltip("cost:Q", title=_t("em_trends_cost", "Costo"), format=",.2f")],
+            ).properties(height=260),
+            use_container_width=True,
+        )
+    st.download_button(
+        _t("em_pf_download", "⬇️ Descargar portfolio energético (CSV)"),
+        data=view.to_csv(index=False).encode("utf-8"),
+        file_name="energy_portfolio.csv", mime="text/csv",
+    )
+
+def _em_debug_panel(trace: Trace | None):
+    """Panel plegable con los tiempos del último guardado y exportación JSON / Chrome trace."""
+    if trace is None:
+        return
+    with st.expander(_t("em_debug_expander", "🐞 Tiempos del último guardado (debug)"), expanded=False):
+        c = trace.counters
+        st.caption(_t(
+            "em_debug_caption",
+            "Total {total:,.0f} ms · llamadas API {calls} · reintentos {retries} · enviados {mb:.2f} MB · aciertos de caché {hits}"
+        ).format(total=trace.total_ms, calls=c.get("api.calls", 0), retries=c.get("api.retries", 0),
+                 mb=c.get("api.bytes_sent", 0) / 1e6, hits=c.get("cache.hits", 0)))
+        st.dataframe(trace.summary(), use_container_width=True, hide_index=True)
+        d1, d2 = st.columns(2)
+        stamp = trace.started_at.replace(":", "").replace("-", "")
+        d1.download_button(
+            _t("em_debug_json", "⬇️ Exportar JSON"),
+            data=json.dumps(trace.to_dict(), ensure_ascii=False, indent=1).encode("utf-8"),
+            file_name=f"em_save_trace_{stamp}.json", mime="application/json", key="em_debug_json",
+        )
+        d2.download_button(
+            _t("em_debug_chrome", "⬇️ Exportar Chrome trace"),
+            data=json.dumps(trace.to_chrome_trace()).encode("utf-8"),
+            file_name=f"em_save_trace_{stamp}.trace.json", mime="application/json", key="em_debug_chrome",
+        )
+
 def page_energy_management():
+    import altair as alt
+
     # Idioma (simple: es/en)
     lang = st.session_state.get("lang", "es")
 
@@ -1104,11 +865,11 @@ def page_energy_management():
 
     with st.expander(_t("em_saved_sites_expander", "🏢 Sitios guardados en esta sesión"), expanded=False):
         if st.session_state["em_sites"]:
-            st.write(_t("em_saved_sites_title", "Sitios guardados:"))
-            for name in st.session_state["em_sites"].keys():
-                st.markdown(f"- **{name}**")
+            st.caption(_t("em_saved_sites_title", "Sitios guardados:") + " "
+                       + " · ".join(f"**{name}**" for name in st.session_state["em_sites"].keys()))
         else:
             st.caption(_t("em_saved_sites_empty", "Todavía no hay sitios guardados en esta sesión."))
+        _page_energy_portfolio()
 
     # ------------------------------------------------------------------
     # 1) Registro visual inicial (FOTOS / VIDEOS + CÁMARA)
@@ -1288,10 +1049,8 @@ def page_energy_management():
 
     with st.expander(_t("em_ledger_expander", "📒 Registro histórico de facturas (CSV)"), expanded=False):
         st.caption(_t("em_ledger_caption", "Importá un ledger previo o descargá el actual normalizado."))
-        if "em_ledger" not in st.session_state:
-            st.session_state["em_ledger"] = pd.DataFrame(
-                columns=["_year_month", "_kwh", "_cost", "_demand_kw", "_currency", "_source"]
-            )
+        ledger = energy_ledger()
+        site_key = site or "Site"
         up = st.file_uploader(
             _t(
                 "em_ledger_upload",
@@ -1302,25 +1061,82 @@ def page_energy_management():
         )
         if up:
             try:
-                new = pd.read_csv(
-                    up,
-                    parse_dates=["_year_month"],
-                    dayfirst=True,
-                    infer_datetime_format=True,
-                )
-                st.session_state["em_ledger"] = (
-                    pd.concat([st.session_state["em_ledger"], new], ignore_index=True)
-                    .drop_duplicates()
-                )
+                new = pd.read_csv(up, parse_dates=["_year_month"], dayfirst=True)
+                ledger.upsert(new, site_key)  # idempotente: reruns con el mismo archivo no duplican
                 st.success(_t("em_ledger_imported", "Ledger importado y fusionado."))
             except Exception as e:
                 st.error(f"{_t('em_ledger_upload_err', 'No se pudo importar el ledger:')} {e}")
         st.download_button(
             _t("em_ledger_download", "⬇️ Descargar ledger actual (CSV)"),
-            data=st.session_state["em_ledger"].to_csv(index=False),
+            data=ledger.query(site_key).to_csv(index=False),
             file_name="energy_invoices_ledger.csv",
         )
 
+    with st.expander(_t("em_ami_expander", "⚡ Medición por intervalos (AMI 15 min / horaria)"), expanded=False):
+        st.caption(_t(
+            "em_ami_caption",
+            "CSV/Parquet con fecha-hora, kWh y/o kW (y opcionalmente medidor). Se lee por bloques y "
+            "sólo se guardan los totales mensuales en el ledger."
+        ))
+        ami_files = st.file_uploader(
+            _t("em_ami_upload", "Archivos de intervalos (CSV/Parquet)"),
+            type=["csv", "parquet"], accept_multiple_files=True, key="em_ami_files",
+        )
+        ami_path = st.text_input(_t("em_ami_path", "…o ruta local (sin límite de upload)"), "", key="em_ami_path")
+        a1, a2, a3 = st.columns(3)
+        ami_interval = a1.selectbox(
+            _t("em_ami_interval", "Intervalo (min)"), ["auto", 5, 15, 30, 60], index=0, key="em_ami_interval")
+        ami_by_meter = a2.toggle(_t("em_ami_by_meter", "Un sitio por medidor"), value=False, key="em_ami_by_meter")
+        ami_chunk = a3.number_input(_t("pf_stream_chunk", "Filas por bloque"), 50_000, 5_000_000, 500_000,
+                                    50_000, key="em_ami_chunk")
+        if st.button(_t("em_ami_btn", "Consolidar en el ledger"), key="em_ami_go"):
+            sources = list(ami_files or []) + ([ami_path.strip()] if ami_path.strip() else [])
+            if not sources:
+                st.warning(_t("em_ami_need_file", "Subí un archivo o indicá una ruta local."))
+            for src in sources:
+                try:
+                    with st.spinner(_t("em_ami_running", "Agregando intervalos por mes…")):
+                        roll, info = rollup_interval_meter(
+                            src, site=site or "Site", by_meter=ami_by_meter, chunksize=int(ami_chunk),
+                            interval_minutes=None if ami_interval == "auto" else float(ami_interval),
+                        )
+                    energy_ledger().upsert(roll[LEDGER_COLUMNS + ["_site"]])
+                    st.success(_t(
+                        "em_ami_done",
+                        "{source}: {rows:,} lecturas de {meters} medidor(es) cada {step:g} min → {months} filas mensuales."
+                    ).format(source=info["source"], rows=info["rows"], meters=info["meters"],
+                             step=info["interval_minutes"], months=len(roll)))
+                    st.dataframe(
+                        roll[["_site", "_year_month", "_kwh", "_demand_kw", "_load_factor", "_hours"]].rename(columns={
+                            "_site": "sitio", "_year_month": "mes", "_kwh": "kWh", "_demand_kw": "demanda_kw",
+                            "_load_factor": "factor_carga", "_hours": "horas"}),
+                        use_container_width=True, hide_index=True,
+                    )
+                except Exception as e:
+                    st.error(f"{_t('em_ami_err', 'No se pudo leer el archivo de intervalos:')} {e}")
+
+    with st.expander(_t("em_dd_expander", "🌡️ Grados-día (baseline por regresión)"), expanded=False):
+        st.caption(_t(
+            "em_dd_caption",
+            "CSV mensual o diario con mes/fecha, HDD y/o CDD y, opcionalmente, la ubicación "
+            "(se asocia con la zona climática del sitio)."
+        ))
+        dd_up = st.file_uploader(_t("em_dd_upload", "Archivo de grados-día (CSV)"), type=["csv"], key="em_dd_up")
+        if dd_up:
+            try:
+                parse_degree_days(pd.read_csv(BytesIO(dd_up.getvalue())))
+                DEGREE_DAYS_PATH.parent.mkdir(parents=True, exist_ok=True)
+                DEGREE_DAYS_PATH.write_bytes(dd_up.getvalue())
+            except Exception as e:
+                st.error(f"{_t('em_dd_err', 'No se pudo leer el archivo de grados-día:')} {e}")
+        dd = load_degree_days()
+        if dd is not None and not dd.empty:
+            st.caption(_t("em_dd_loaded", "{path}: {locs} ubicación(es), {start} → {end}").format(
+                path=DEGREE_DAYS_PATH, locs=dd["location"].nunique(),
+                start=dd["_year_month"].min().strftime("%Y-%m"), end=dd["_year_month"].max().strftime("%Y-%m")))
+        else:
+            st.caption(_t("em_dd_missing", "Sin grados-día: el baseline se anualiza (12 / meses)."))
+
     with st.expander(_t("em_ocr_options", "Opciones de lectura de facturas"), expanded=True):
         use_ocr = st.toggle(
             _t("em_ocr_toggle", "Usar OCR con OpenAI (imágenes y PDFs escaneados)"),
@@ -1339,6 +1155,26 @@ def page_energy_management():
             10,
             help="Menor DPI = archivos más livianos",
         )
+        ocr_pages = st.text_input(
+            _t("em_ocr_pages", "Páginas de PDF para OCR (ej. 2-4,6; vacío = todas)"), "", key="em_ocr_pages"
+        )
+        oc1, oc2 = st.columns(2)
+        ocr_concurrency = oc1.slider(
+            _t("em_ocr_concurrency", "Solicitudes OCR en paralelo"), 1, 8, 4, 1, key="em_ocr_conc"
+        )
+        ocr_timeout = oc2.number_input(
+            _t("em_ocr_timeout", "Timeout por solicitud (s)"), 10, 300, 60, 10, key="em_ocr_timeout"
+        )
+        cache = invoice_parse_cache()
+        cst = cache.stats()
+        cc1, cc2 = st.columns([3, 1])
+        cc1.caption(_t(
+            "em_ocr_cache_stats",
+            "Caché de facturas: {entries:,} entradas · {mb:.1f} MB · {hits:,} aciertos / {misses:,} fallos"
+        ).format(entries=cst["entries"], mb=cst["bytes"] / 1e6, hits=cst["hits"], misses=cst["misses"]))
+        if cc2.button(_t("em_ocr_cache_clear", "Vaciar caché"), key="em_ocr_cache_clear"):
+            cache.clear()
+            st.rerun()
 
     # ------------------------------------------------------------------
     # 5) Evidencias específicas (edificio, equipos, etiquetas, vegetación)
@@ -1406,158 +1242,204 @@ def page_energy_management():
     # 7) Guardar dataset del sitio (incluye TODO lo anterior)
     # ------------------------------------------------------------------
     if st.button(_t("em_btn_save_dataset", "Guardar dataset del sitio (memoria de sesión)"), key="em_save"):
-        inv_tables = []
-        evidence_files = []
-
-        # ---- Evidencias (nombres, para el informe / trazabilidad) ----
-        for f in (building_photos or []):
-            evidence_files.append(f"building_photo:{getattr(f, 'name', '')}")
-        for f in (building_videos or []):
-            evidence_files.append(f"building_video:{getattr(f, 'name', '')}")
-        if cam_building is not None:
-            evidence_files.append("cam_building:cam_fachada")
-        if cam_equip is not None:
-            evidence_files.append("cam_equipment:cam_equipos")
-        if cam_labels is not None:
-            evidence_files.append("cam_labels:cam_etiquetas")
-
-        for f in (ev_building or []):
-            evidence_files.append(f"ev_building:{getattr(f, 'name', '')}")
-        for f in (ev_equipment or []):
-            evidence_files.append(f"ev_equipment:{getattr(f, 'name', '')}")
-        for f in (ev_labels or []):
-            evidence_files.append(f"ev_labels:{getattr(f, 'name', '')}")
-        for f in (ev_vegetation or []):
-            evidence_files.append(f"ev_vegetation:{getattr(f, 'name', '')}")
-
-        # ---- Facturas CSV/XLSX/PDF ----
-        for f in (invoices or []):
-            name = getattr(f, "name", "file")
-            suf = name.lower().split(".")[-1]
-            try:
-                if suf == "csv":
-                    df = pd.read_csv(f)
-                    inv_tables.append(_normalize_invoice_table(df, name))
-                elif suf in ("xlsx", "xlsm", "xls"):
-                    df = pd.read_excel(f)
-                    inv_tables.append(_normalize_invoice_table(df, name))
-                elif suf == "pdf":
-                    b = f.read()
-                    raw = _extract_text_from_pdf_simple(BytesIO(b))
-                    parsed = pd.DataFrame()
-                    if raw and use_ocr:
-                        parsed = _parse_invoice_text_blocks_with_llm(
-                            raw, name, model=ocr_model
-                        )
-                    if parsed.empty and use_ocr:
-                        pages = _pdf_to_images(b, dpi=int(ocr_dpi))
-                        for j, pbytes in enumerate(pages):
-                            dfo = _ocr_image_invoice_with_openai(
-                                pbytes, f"{name}#p{j+1}.png", model=ocr_model
+        # Traza del guardado (spans de cada etapa: lectura, PDF, OCR, normalización, resumen) y
+        # avisos del motor (LLM deshabilitado, respuestas no JSON, dependencias faltantes); los
+        # context managers los desactivan aunque falle alguna etapa
+        with tracing("em_save") as trace, collecting_diagnostics() as diags:
+            st.session_state["em_last_trace"] = trace  # visible en el panel de depuración aunque falle
+            inv_tables = []
+            evidence_files = []
+            ocr_sources, ocr_total = [], 0  # (lugar en inv_tables, iterable de (imagen, nombre))
+            api_calls_avoided = 0
+
+            # ---- Evidencias (nombres, para el informe / trazabilidad) ----
+            for f in (building_photos or []):
+                evidence_files.append(f"building_photo:{getattr(f, 'name', '')}")
+            for f in (building_videos or []):
+                evidence_files.append(f"building_video:{getattr(f, 'name', '')}")
+            if cam_building is not None:
+                evidence_files.append("cam_building:cam_fachada")
+            if cam_equip is not None:
+                evidence_files.append("cam_equipment:cam_equipos")
+            if cam_labels is not None:
+                evidence_files.append("cam_labels:cam_etiquetas")
+
+            for f in (ev_building or []):
+                evidence_files.append(f"ev_building:{getattr(f, 'name', '')}")
+            for f in (ev_equipment or []):
+                evidence_files.append(f"ev_equipment:{getattr(f, 'name', '')}")
+            for f in (ev_labels or []):
+                evidence_files.append(f"ev_labels:{getattr(f, 'name', '')}")
+            for f in (ev_vegetation or []):
+                evidence_files.append(f"ev_vegetation:{getattr(f, 'name', '')}")
+
+            # ---- Facturas CSV/XLSX/PDF ----
+            for f in (invoices or []):
+                name = getattr(f, "name", "file")
+                suf = name.lower().split(".")[-1]
+                try:
+                    if suf == "csv":
+                        with trace_span("read_file", file=name):
+                            df = pd.read_csv(f)
+                        inv_tables.append(_normalize_invoice_table(df, name))
+                    elif suf in ("xlsx", "xlsm", "xls"):
+                        with trace_span("read_file", file=name):
+                            df = pd.read_excel(f)
+                        inv_tables.append(_normalize_invoice_table(df, name))
+                    elif suf == "pdf":
+                        b = f.read()
+                        raw = _extract_text_from_pdf_simple(BytesIO(b))
+                        parsed = pd.DataFrame()
+                        if raw:
+                            # primero plantillas locales (ms, sin API); el LLM solo si la confianza es baja
+                            parsed, _info = _parse_invoice_text_local(raw, name)
+                            if not parsed.empty:
+                                api_calls_avoided += 1
+                        if raw and parsed.empty and use_ocr:
+                            parsed = _parse_invoice_text_blocks_with_llm(
+                                raw, name, model=ocr_model
                             )
-                            if not dfo.empty:
-                                inv_tables.append(dfo)
-                        if not pages:
-                            st.info(
-                                f"No se pudo rasterizar {name}. ¿Agregaste pypdfium2 y Pillow al requirements?"
-                            )
-                    elif not parsed.empty:
-                        inv_tables.append(parsed)
-                else:
-                    st.info(f"Formato no soportado en 'Facturas': {name}")
-            except Exception as e:
-                st.warning(f"No se pudo leer {name}: {e}")
-
-        # ---- Imágenes de facturas (OCR) ----
-        for p in (invoice_images or []):
+                        if parsed.empty and use_ocr:
+                            n_pages = len(_parse_page_range(ocr_pages, _pdf_page_count(b)))
+                            if n_pages:
+                                # se reserva el lugar del archivo; las páginas se rasterizan recién al hacer OCR
+                                ocr_sources.append((len(inv_tables), _pdf_ocr_jobs(b, name, int(ocr_dpi), ocr_pages)))
+                                inv_tables.append(None)
+                                ocr_total += n_pages
+                            else:
+                                st.info(
+                                    f"No se pudo rasterizar {name}. ¿Agregaste pypdfium2 y Pillow al requirements?"
+                                )
+                        elif not parsed.empty:
+                            inv_tables.append(parsed)
+                    else:
+                        st.info(f"Formato no soportado en 'Facturas': {name}")
+                except Exception as e:
+                    st.warning(f"No se pudo leer {name}: {e}")
+
+            # ---- Imágenes de facturas (OCR) ----
+            if use_ocr:
+                for p in (invoice_images or []):
+                    ocr_sources.append((len(inv_tables), [(p.read(), p.name)]))
+                    inv_tables.append(None)
+                    ocr_total += 1
+
+            # ---- OCR en paralelo (concurrencia acotada, páginas bajo demanda) ----
+            if ocr_sources:
+                ocr_slots = []
+
+                def _ocr_jobs():
+                    for slot, src in ocr_sources:
+                        for job in src:
+                            ocr_slots.append(slot)
+                            yield job
+
+                bar = st.progress(0.0, text=_t("em_ocr_progress", "OCR {done}/{total}").format(done=0, total=ocr_total))
+                ocr_results, ocr_warnings = run_ocr_pipeline(
+                    _ocr_jobs(), model=ocr_model, max_concurrency=int(ocr_concurrency),
+                    timeout=float(ocr_timeout), total=ocr_total,
+                    progress=lambda done, total, _name: bar.progress(
+                        min(done / total, 1.0) if total else 0.0,
+                        text=_t("em_ocr_progress", "OCR {done}/{total}").format(done=done, total=total)),
+                )
+                bar.empty()
+                per_slot = {}
+                for slot, dfo in zip(ocr_slots, ocr_results):
+                    if not dfo.empty:
+                        per_slot.setdefault(slot, []).append(dfo)
+                for slot, dfs in per_slot.items():
+                    inv_tables[slot] = pd.concat(dfs, ignore_index=True)
+                for w in ocr_warnings:
+                    st.warning(w)
+            inv_tables = [t for t in inv_tables if t is not None]
+
+            # ---- Consolidación + upsert en el ledger persistente ----
+            with trace_span("consolidate", tables=len(inv_tables)):
+                inv_df = pd.concat(inv_tables, ignore_index=True) if inv_tables else pd.DataFrame()
+            if not inv_df.empty:
+                inv_df = inv_df[[c for c in LEDGER_COLUMNS if c in inv_df.columns]]
+                energy_ledger().upsert(inv_df, site or "Site")
+
+            # Área total y usuarios
             try:
-                if use_ocr:
-                    df = _ocr_image_invoice_with_openai(p.read(), p.name, model=ocr_model)
-                    if not df.empty:
-                        inv_tables.append(df)
-            except Exception as e:
-                st.warning(f"No se pudo OCR {p.name}: {e}")
-
-        # ---- Consolidación + merge con ledger histórico ----
-        inv_df = pd.concat(inv_tables, ignore_index=True) if inv_tables else pd.DataFrame()
-        if not inv_df.empty:
-            if "_year_month" in inv_df.columns:
-                inv_df["_year_month"] = pd.to_datetime(inv_df["_year_month"])
-            cols = ["_year_month", "_kwh", "_cost", "_demand_kw", "_currency", "_source"]
-            inv_df = inv_df[[c for c in cols if c in inv_df.columns]]
-            st.session_state["em_ledger"] = pd.concat(
-                [st.session_state.get("em_ledger", pd.DataFrame(columns=cols)), inv_df],
-                ignore_index=True,
-            ).drop_duplicates()
-
-        # Área total y usuarios
-        try:
-            total_area_m2 = float(
-                pd.DataFrame(st.session_state.get("em_uses_df", []))
-                .get("area_m2", pd.Series([0]))
-                .sum()
+                total_area_m2 = float(
+                    pd.DataFrame(st.session_state.get("em_uses_df", []))
+                    .get("area_m2", pd.Series([0]))
+                    .sum()
+                )
+            except Exception:
+                total_area_m2 = 0.0
+
+            energy_ledger().upsert_sites(pd.DataFrame([{
+                "site": site or "Site", "organization": org or "Org", "building_type": building_type,
+                "area_m2": total_area_m2, "users_count": int(st.session_state.get("em_users", 0)),
+                "baseline_start": baseline_start, "baseline_end": baseline_end,
+                "climate_zone": climate_zone, "visitors_per_day": visitors_per_day,
+            }]))
+            use_df = energy_ledger().query(site or "Site")
+            invoices_summary = energy_ledger().summarize(
+                site or "Site",
+                total_area_m2=total_area_m2,
+                users_count=int(st.session_state.get("em_users", 0)),
+                baseline_start=st.session_state.get("em_bstart"),
+                baseline_end=st.session_state.get("em_bend"),
+            )
+            regression = None
+            if load_degree_days() is not None:
+                fits = energy_baselines(sites=[site or "Site"])
+                regression = fits.iloc[0].to_dict() if not fits.empty else None
+            derived = _em_compute_baseline_from_invoices(
+                invoices_summary=invoices_summary,
+                total_area_m2=total_area_m2,
+                users_count=int(st.session_state.get("em_users", 0)),
+                regression=regression,
             )
-        except Exception:
-            total_area_m2 = 0.0
-
-        use_df = st.session_state["em_ledger"].copy()
-        invoices_summary = _em_summarize_invoices(
-            inv_df=use_df,
-            total_area_m2=total_area_m2,
-            users_count=int(st.session_state.get("em_users", 0)),
-            baseline_start=st.session_state.get("em_bstart"),
-            baseline_end=st.session_state.get("em_bend"),
-        )
-        derived = _em_compute_baseline_from_invoices(
-            invoices_summary=invoices_summary,
-            total_area_m2=total_area_m2,
-            users_count=int(st.session_state.get("em_users", 0)),
-        )
 
-        # SEUs consolidados (lista que el LLM va a usar)
-        seus_list = list(seus_selected) + [
-            s.strip() for s in (seus_extra or "").splitlines() if s.strip()
-        ]
-
-        dataset = {
-            "site": {
-                "organization": org or "Org",
-                "site_name": site or "Site",
-                "address": address,
-                "climate_zone": climate_zone,
-                "baseline_start": str(baseline_start) if baseline_start else None,
-                "baseline_end": str(baseline_end) if baseline_end else None,
-                "building_type": building_type,
-                "visitors_per_day": visitors_per_day,
-                "energy_policy": energy_policy,
-                "significant_energy_uses": seus_list,
-                "enpis": [s.strip() for s in (enpis or "").splitlines() if s.strip()],
-                "objectives": [s.strip() for s in (objectives or "").splitlines() if s.strip()],
-                "action_plan": [s.strip() for s in (action_plan or "").splitlines() if s.strip()],
-                "equipment": equipment_selected,
-            },
-            "users_profile": {
-                "users_count": users_count,
-                "peak_occupancy": peak_occupancy,
-                "occupancy_pattern": occupancy_pattern,
-            },
-            "building_uses": uses_df.to_dict("records"),
-            "evidence_files": evidence_files,
-            "invoices": {
-                "preview_rows": use_df.head(100).to_dict(orient="records")
-                if (not use_df.empty)
-                else [],
-                "summary": invoices_summary,
-            },
-            "derived": derived,
-        }
+            # SEUs consolidados (lista que el LLM va a usar)
+            seus_list = list(seus_selected) + [
+                s.strip() for s in (seus_extra or "").splitlines() if s.strip()
+            ]
+
+            dataset = {
+                "site": {
+                    "organization": org or "Org",
+                    "site_name": site or "Site",
+                    "address": address,
+                    "climate_zone": climate_zone,
+                    "baseline_start": str(baseline_start) if baseline_start else None,
+                    "baseline_end": str(baseline_end) if baseline_end else None,
+                    "building_type": building_type,
+                    "visitors_per_day": visitors_per_day,
+                    "energy_policy": energy_policy,
+                    "significant_energy_uses": seus_list,
+                    "enpis": [s.strip() for s in (enpis or "").splitlines() if s.strip()],
+                    "objectives": [s.strip() for s in (objectives or "").splitlines() if s.strip()],
+                    "action_plan": [s.strip() for s in (action_plan or "").splitlines() if s.strip()],
+                    "equipment": equipment_selected,
+                },
+                "users_profile": {
+                    "users_count": users_count,
+                    "peak_occupancy": peak_occupancy,
+                    "occupancy_pattern": occupancy_pattern,
+                },
+                "building_uses": uses_df.to_dict("records"),
+                "evidence_files": evidence_files,
+                "invoices": {
+                    "preview_rows": use_df.head(100).to_dict(orient="records")
+                    if (not use_df.empty)
+                    else [],
+                    "summary": invoices_summary,
+                },
+                "derived": derived,
+            }
 
-        st.session_state["em_last_dataset"] = dataset
+            st.session_state["em_last_dataset"] = dataset
 
-        # guardamos el dataset por sitio para tener varios edificios en la misma sesión
-        if site:
-            st.session_state["em_sites"][site] = dataset
+            # guardamos el dataset por sitio para tener varios edificios en la misma sesión
+            if site:
+                st.session_state["em_sites"][site] = dataset
 
+        _show_diagnostics(diags)
         st.success(_t("em_dataset_saved", "Dataset guardado en memoria de sesión."))
 
         # ---- Vista + KPIs + gráficos (si hay datos) ----
@@ -1565,11 +1447,11 @@ def page_energy_management():
             st.markdown("**" + _t("em_ledger_view_title", "Ledger normalizado (histórico consolidado):") + "**")
             show_cols = [
                 c
-                for c in ["_year_month", "_kwh", "_cost", "_demand_kw", "_currency", "_source"]
+                for c in ["_year_month", "_kwh", "_cost", "_demand_kw", "_currency", "_source", "_parse_path"]
                 if c in use_df.columns
             ]
             if show_cols:
-                dfshow = use_df.copy().sort_values("_year_month")
+                dfshow = use_df.sort_values("_year_month")
                 st.dataframe(
                     dfshow[show_cols].rename(
                         columns={
@@ -1579,10 +1461,17 @@ def page_energy_management():
                             "_demand_kw": "demanda_kw",
                             "_currency": "moneda",
                             "_source": "archivo",
+                            "_parse_path": "origen",
                         }
                     ),
                     use_container_width=True,
                 )
+            if "_parse_path" in use_df.columns:
+                by_path = use_df["_parse_path"].fillna("importado").value_counts()
+                st.caption(_t(
+                    "em_parse_paths",
+                    "Filas por origen: {paths} · llamadas a la API evitadas en este guardado: {avoided}"
+                ).format(paths=" · ".join(f"{k} {v:,}" for k, v in by_path.items()), avoided=api_calls_avoided))
 
             st.markdown("**" + _t("em_baseline_title", "Baseline y EnPIs:") + "**")
             c1, c2, c3, c4 = st.columns(4)
@@ -1610,6 +1499,19 @@ def page_energy_management():
                     else "–",
                 )
 
+            reg = derived.get("regression")
+            if reg:
+                st.caption(_t(
+                    "em_regression_caption",
+                    "Baseline por regresión ({model}, {months} meses): R² {r2} · CV(RMSE) {cv} · "
+                    "kWh/año normalizado {norm}"
+                ).format(
+                    model=reg["model"], months=reg["months"],
+                    r2=f"{reg['r2']:.2f}" if reg["r2"] is not None else "–",
+                    cv=f"{reg['cv_rmse']:.1%}" if reg["cv_rmse"] is not None else "–",
+                    norm=f"{b['kwh_year_normalized']:,.0f}" if b.get("kwh_year_normalized") else "–",
+                ))
+
             ms = invoices_summary.get("monthly_series", [])
             if ms:
                 sdf = pd.DataFrame(ms)
@@ -1647,6 +1549,8 @@ def page_energy_management():
                         use_container_width=True,
                     )
 
+    _em_debug_panel(st.session_state.get("em_last_trace"))
+
     # ------------------------------------------------------------------
     # 8) Generación del reporte con OpenAI (igual que antes)
     # ------------------------------------------------------------------
@@ -1668,52 +1572,179 @@ def page_energy_management():
     brand_color = st.color_picker(_t("em_brand_color", "Color institucional"), "#0B8C6B", key="em_color")
     logo_url = st.text_input(_t("em_logo_url", "Logo (URL pública opcional)"), key="em_logo")
 
+    # Sitios guardados en la sesión (más el último dataset aunque no tenga nombre de sitio)
+    report_datasets = dict(st.session_state.get("em_sites") or {})
+    last_dataset = st.session_state.get("em_last_dataset")
+    if last_dataset:
+        report_datasets.setdefault(last_dataset["site"]["site_name"], last_dataset)
+    report_sites = st.multiselect(
+        _t("em_report_sites", "Sitios a reportar"), list(report_datasets),
+        default=[last_dataset["site"]["site_name"]] if last_dataset else [], key="em_report_sites",
+    )
+    # Un reporte ya generado para el mismo dataset y parámetros sale de la caché en disco
+    force_report = st.toggle(_t("em_report_force", "Forzar regeneración (ignorar caché)"), value=False,
+                             key="em_report_force")
+    # El dataset se resume antes de mandarlo al modelo: el prompt no crece con el tamaño del ledger
+    token_budget = int(st.number_input(
+        _t("em_report_budget", "Presupuesto de tokens del dataset (0 = enviar sin compactar)"),
+        min_value=0, max_value=50_000, value=REPORT_TOKEN_BUDGET, step=500, key="em_report_budget",
+        help=_t("em_report_budget_help", "El dataset del sitio se resume (estadísticas mensuales, anomalías, "
+                "conteo de evidencias) para entrar en este presupuesto antes de llamar al modelo."),
+    ))
+    if token_budget:
+        for name in report_sites:
+            _compact, info = compact_report_dataset(report_datasets[name], token_budget)
+            st.caption(_t("em_report_tokens", "{site}: ≈{tokens:,} tokens de dataset (de {full:,} sin compactar)")
+                       .format(site=name, tokens=info["tokens"], full=info["tokens_full"])
+                       + ("" if info["fits"] else _t("em_report_tokens_over",
+                                                     " · no entra en el presupuesto ni con la compactación máxima")))
+
     if st.button(_t("em_btn_generate_report", "Generar reporte ISO 50001"), key="em_report"):
-        dataset = st.session_state.get("em_last_dataset")
-        if not dataset:
+        if not report_sites:
             st.error(_t("em_no_dataset", "No hay dataset guardado para generar el reporte."))
         else:
+            # Un job por sitio en la cola de fondo: el script sigue y el panel hace polling
+            jobs = st.session_state.setdefault("em_report_jobs", {})
+            for name in report_sites:
+                jobs[name] = report_queue().submit(
+                    report_datasets[name], model=model, detail_level=detail_level,
+                    temperature=temperature, brand_color=brand_color, logo_url=logo_url,
+                    force=force_report, token_budget=token_budget,
+                )
             st.info(_t(
                 "em_generating_report_info",
-                f"Generando reporte con **{model}** · detalle **{detail_level}/5** · temp **{temperature:.1f}**…"
+                "Generando reporte con **{model}** · detalle **{detail}/5** · temp **{temp:.1f}**…"
             ).format(model=model, detail=detail_level, temp=temperature))
-            llm_text = _em_openai_report(
-                dataset=dataset,
-                brand_color=brand_color,
-                logo_url=logo_url,
-                model=model,
-                detail_level=detail_level,
-                temperature=temperature,
-            )
-            html = _em_render_report_html(
-                org=dataset["site"]["organization"],
-                site=dataset["site"]["site_name"],
-                generated_at=pd.Timestamp.now().strftime("%Y-%m-%d %H:%M"),
-                llm_text=llm_text,
-                brand_color=brand_color,
-                logo_url=logo_url,
-            )
-            _em_download_button_html(html, "energy_report.html")
-            st.markdown("Vista previa:")
-            st.components.v1.html(html, height=800, scrolling=True)
-
-            pdf_html = _em_render_report_pdf_html(
-                org=dataset["site"]["organization"],
-                site=dataset["site"]["site_name"],
-                generated_at=pd.Timestamp.now().strftime("%Y-%m-%d %H:%M"),
-                llm_text=llm_text,
-                brand_color=brand_color,
-                logo_url=logo_url,
+
+    _em_report_jobs_panel()
+
+    # Reporte consolidado de todos los sitios: un job por sitio (con la misma caché) y, cuando
+    # terminan todos, un único PDF con índice global más un ZIP con un archivo por sitio
+    if len(report_datasets) > 1 and st.button(
+        _t("em_btn_batch_report", "Reporte consolidado de todos los sitios"), key="em_batch_report"
+    ):
+        st.session_state["em_batch_jobs"] = {
+            name: report_queue().submit(
+                ds, model=model, detail_level=detail_level, temperature=temperature,
+                brand_color=brand_color, logo_url=logo_url, with_pdf=False,
+                force=force_report, token_budget=token_budget,
             )
-            pdf_bytes = _em_html_to_pdf_bytes(pdf_html)
-            if pdf_bytes:
-                st.download_button(
-                    _t("em_pdf_download", "⬇️ Descargar PDF (A4)"),
-                    data=pdf_bytes,
-                    file_name="energy_report.pdf",
-                    mime="application/pdf",
-                    use_container_width=True,
-                )
-            else:
-                st.info(_t("em_pdf_fallback", "Podés exportar el PDF directamente desde tu navegador."))
-                _em_show_print_button(pdf_html, label=_t("em_pdf_print_label", "🖨️ Imprimir / Guardar como PDF (A4)"))
+            for name, ds in report_datasets.items()
+        }
+        st.session_state.pop("em_batch_result", None)
+    _em_batch_report_panel(report_datasets, brand_color, logo_url)
+
+
+_REPORT_STATUS_ES = {"queued": "en cola", "running": "generando", "done": "listo",
+                     "error": "error", "cancelled": "cancelado"}
+
+def _em_session_report_jobs() -> list:
+    ids = st.session_state.get("em_report_jobs") or {}
+    return [j for j in (report_queue().get(i) for i in ids.values()) if j is not None]
+
+def _em_report_jobs_panel():
+    """
+    Reportes en segundo plano de la sesión. Mientras alguno corre, el panel es un fragmento
+    con run_every (polling cada 0,5 s sin re-ejecutar la página); al terminar todos se hace un
+    rerun completo para apagar el temporizador.
+    """
+    jobs = _em_session_report_jobs()
+    if not jobs:
+        return
+    polling = not all(j.done for j in jobs)
+    st.fragment(_em_report_jobs_fragment, run_every=0.5 if polling else None)(polling)
+
+def _em_report_jobs_fragment(polling: bool):
+    jobs = _em_session_report_jobs()
+    tabs = st.tabs([j.site for j in jobs]) if len(jobs) > 1 else [st.container()]
+    for tab, job in zip(tabs, jobs):
+        with tab:
+            _em_report_job_view(job)
+    if polling and all(j.done for j in jobs):
+        st.rerun()
+
+def _em_batch_jobs() -> list:
+    ids = st.session_state.get("em_batch_jobs") or {}
+    return [(name, report_queue().get(i)) for name, i in ids.items()]
+
+def _em_batch_progress_fragment():
+    jobs = _em_batch_jobs()
+    done = sum(1 for _, j in jobs if j is None or j.done)
+    st.progress(done / max(len(jobs), 1), text=_t(
+        "em_batch_progress", "Reporte consolidado: {done}/{total} sitios generados").format(done=done, total=len(jobs)))
+    if done == len(jobs):
+        st.rerun()
+
+def _em_batch_report_panel(report_datasets: dict, brand_color: str, logo_url: str):
+    """Progreso del consolidado (fragmento con polling) y, al terminar, sus descargas."""
+    jobs = _em_batch_jobs()
+    if not jobs:
+        return
+    if not all(j is None or j.done for _, j in jobs):
+        st.fragment(_em_batch_progress_fragment, run_every=0.5)()
+        return
+    res = st.session_state.get("em_batch_result")
+    if res is None:
+        items = [(report_datasets[name], j.text) for name, j in jobs
+                 if j is not None and j.status == "done" and name in report_datasets]
+        if not items:
+            return
+        with st.spinner(_t("em_batch_building", "Armando el PDF consolidado y los archivos por sitio…")):
+            res = build_batch_report(items, brand_color=brand_color, logo_url=logo_url)
+        res["failed"] = len(jobs) - len(items)
+        st.session_state["em_batch_result"] = res
+
+    st.caption(_t("em_batch_caption", "Reporte consolidado · {sites} sitios · {failed} sin texto · generado {generated_at}")
+               .format(sites=len(res["sites"]), failed=res["failed"], generated_at=res["generated_at"]))
+    c1, c2 = st.columns(2)
+    if res["pdf_bytes"]:
+        c1.download_button(_t("em_batch_pdf_download", "⬇️ Descargar PDF consolidado"), data=res["pdf_bytes"],
+                           file_name="energy_report_portfolio.pdf", mime="application/pdf",
+                           use_container_width=True, key="em_batch_pdf")
+    else:
+        c1.download_button(_t("em_batch_html_download", "⬇️ Descargar reporte consolidado (HTML A4)"),
+                           data=res["pdf_html"].encode("utf-8"), file_name="energy_report_portfolio.html",
+                           mime="text/html", use_container_width=True, key="em_batch_html")
+    c2.download_button(_t("em_batch_zip_download", "⬇️ Descargar reportes por sitio (ZIP)"), data=res["zip_bytes"],
+                       file_name="energy_reports_by_site.zip", mime="application/zip",
+                       use_container_width=True, key="em_batch_zip")
+
+def _em_report_job_view(job):
+    status = _t(f"em_report_status_{job.status}", _REPORT_STATUS_ES.get(job.status, job.status))
+    st.caption(_t("em_report_job_caption", "{site} · {status} · {secs:.0f} s · {chars:,} caracteres").format(
+        site=job.site, status=status, secs=job.elapsed_s, chars=len(job.text))
+        + (_t("em_report_from_cache", " · desde caché") if job.cached else
+           _t("em_report_first_content", " · primer contenido en {secs:.1f} s").format(secs=job.first_content_s)
+           if job.first_content_s is not None else "")
+        + (_t("em_report_prompt_tokens", " · ≈{tokens:,} tokens de prompt").format(tokens=job.prompt["tokens"])
+           if job.prompt.get("tokens") else ""))
+    if not job.done:
+        if st.button(_t("em_report_cancel", "Cancelar"), key=f"em_report_cancel_{job.id}"):
+            report_queue().cancel(job.id)
+        if job.text:
+            # vista previa en vivo: las líneas ya terminadas llegan convertidas a HTML
+            st.components.v1.html(job.preview_page(), height=800, scrolling=True)
+        return
+    if job.status == "error":
+        st.error(job.error)
+        return
+    if job.status == "cancelled":
+        st.info(_t("em_report_cancelled", "Reporte cancelado."))
+        return
+
+    res = job.result
+    _em_download_button_html(res["html"], f"energy_report_{_slugify(job.site) or 'site'}.html")
+    st.markdown("Vista previa:")
+    st.components.v1.html(res["html"], height=800, scrolling=True)
+    if res["pdf_bytes"]:
+        st.download_button(
+            _t("em_pdf_download", "⬇️ Descargar PDF (A4)"),
+            data=res["pdf_bytes"],
+            file_name=f"energy_report_{_slugify(job.site) or 'site'}.pdf",
+            mime="application/pdf",
+            use_container_width=True,
+            key=f"em_pdf_{job.id}",
+        )
+    else:
+        st.info(_t("em_pdf_fallback", "Podés exportar el PDF directamente desde tu navegador."))
+        _em_show_print_button(res["pdf_html"], label=_t("em_pdf_print_label", "🖨️ Imprimir / Guardar como PDF (A4)"))
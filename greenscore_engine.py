@@ -0,0 +1,3258 @@
+"""
+Motor de cálculo de GreenScore sin interfaz: scoring, almacén de portfolios, ledger
+energético, baselines y normalización de facturas. No importa Streamlit, así que sirve
+para la CLI (`greenscore_cli.py`), los benchmarks y los workers de procesos;
+`greenscore_core` reexporta todo para las páginas.
+"""
+import contextvars
+import functools
+import hashlib
+import json
+import logging
+import os
+import re
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+from html import escape as _html_escape
+from io import BytesIO
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+# ========================= CONFIG / DEFAULTS =========================
+
+DEFAULT_CFG = {
+    "schemes": {
+        "LEED": {
+            "weights": {
+                "Energy": 0.30, "Water": 0.20, "Materials": 0.15,
+                "IEQ": 0.15, "Transport": 0.10, "Site": 0.05, "Innovation": 0.05
+            },
+            "metrics": {
+                "energy_saving_pct": {"label":"Ahorro energético (%) vs. baseline","category":"Energy","type":"pct","target":30},
+                "renewables_pct": {"label":"Energía renovable on-site (%)","category":"Energy","type":"pct","target":10},
+                "water_saving_pct": {"label":"Ahorro de agua (%) vs. baseline","category":"Water","type":"pct","target":30},
+                "recycled_content_pct": {"label":"Contenido reciclado de materiales (%)","category":"Materials","type":"pct","target":20},
+                "daylight_areas_pct": {"label":"Áreas con luz natural (%)","category":"IEQ","type":"pct","target":75},
+                "low_voc_pct": {"label":"Materiales de bajo VOC (%)","category":"IEQ","type":"pct","target":100},
+                "near_transit": {"label":"Cercanía a transporte público (sí/no)","category":"Transport","type":"bool","target":1},
+                "bike_parking": {"label":"Bicicleteros / duchas (sí/no)","category":"Transport","type":"bool","target":1},
+                "green_roof_pct": {"label":"Cubierta verde / reflectiva (%)","category":"Site","type":"pct","target":50},
+                "waste_recycled_pct": {"label":"Residuos de obra reciclados (%)","category":"Site","type":"pct","target":75},
+                "innovation_points": {"label":"Puntos de innovación (0–5)","category":"Innovation","type":"number","min":0,"max":5,"target":5}
+            }
+        },
+        "EDGE": {
+            "weights": {"Energy": 0.45, "Water": 0.35, "Materials": 0.20},
+            "metrics": {
+                "energy_saving_pct": {"label":"Ahorro energético (%) vs. baseline","category":"Energy","type":"pct","target":20},
+                "solar_ready": {"label":"Preparado para fotovoltaica (sí/no)","category":"Energy","type":"bool","target":1},
+                "water_saving_pct": {"label":"Ahorro de agua (%) vs. baseline","category":"Water","type":"pct","target":20},
+                "fixtures_efficiency_score": {"label":"Eficiencia de artefactos sanitarios (0–1)","category":"Water","type":"number","min":0,"max":1,"target":1},
+                "embodied_carbon_reduction_pct": {"label":"Reducción de carbono incorporado (%)","category":"Materials","type":"pct","target":20},
+                "local_materials_pct": {"label":"Materiales locales (%)","category":"Materials","type":"pct","target":25}
+            }
+        }
+    }
+}
+
+DEFAULT_SAMPLE = pd.DataFrame([
+    {"project_name":"Edificio A – Oficinas","typology":"Oficinas",
+     "energy_saving_pct":25,"renewables_pct":5,"water_saving_pct":22,"recycled_content_pct":18,
+     "daylight_areas_pct":70,"low_voc_pct":100,"near_transit":1,"bike_parking":1,
+     "green_roof_pct":20,"waste_recycled_pct":60,"innovation_points":2.0,"solar_ready":1,
+     "fixtures_efficiency_score":0.8,"embodied_carbon_reduction_pct":10,"local_materials_pct":30},
+    {"project_name":"Torre C – Residencial","typology":"Residencial",
+     "energy_saving_pct":35,"renewables_pct":12,"water_saving_pct":28,"recycled_content_pct":10,
+     "daylight_areas_pct":50,"low_voc_pct":80,"near_transit":0,"bike_parking":0,
+     "green_roof_pct":0,"waste_recycled_pct":40,"innovation_points":1.0,"solar_ready":0,
+     "fixtures_efficiency_score":0.6,"embodied_carbon_reduction_pct":15,"local_materials_pct":20},
+])
+
+SCORING_CONFIG_PATH = Path("config/scoring_config.json")
+
+def read_scoring_config(path=None) -> dict:
+    """Config de esquemas desde JSON (por defecto config/scoring_config.json) o DEFAULT_CFG."""
+    cfg_path = Path(path or SCORING_CONFIG_PATH)
+    if cfg_path.exists():
+        return json.loads(cfg_path.read_text(encoding="utf-8"))
+    return DEFAULT_CFG
+
+# ========================= INSTRUMENTACIÓN (TIEMPOS) =========================
+
+class Trace:
+    """
+    Spans cronometrados (perf_counter) y contadores de una operación (p. ej. el guardado del
+    sitio). Es thread-safe: los hilos del OCR registran en la misma traza si heredan el contexto.
+    Se exporta como JSON o como Chrome trace (chrome://tracing, Perfetto).
+    """
+
+    def __init__(self, name: str = ""):
+        self.name = name
+        self.started_at = pd.Timestamp.now().isoformat(timespec="seconds")
+        self.spans = []  # (nombre, inicio_ns, duración_ns, hilo, args)
+        self.counters = {}
+        self.closed = False
+        self._t0 = time.perf_counter_ns()
+        self._t1 = None
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def span(self, name: str, **args):
+        t = time.perf_counter_ns()
+        try:
+            yield
+        finally:
+            if not self.closed:
+                rec = (name, t - self._t0, time.perf_counter_ns() - t, threading.get_ident(), args or None)
+                with self._lock:
+                    self.spans.append(rec)
+
+    def count(self, name: str, n: int = 1):
+        if not self.closed:
+            with self._lock:
+                self.counters[name] = self.counters.get(name, 0) + n
+
+    def activate(self):
+        """Hace de esta la traza activa del contexto; devuelve el token para deactivate()."""
+        return _ACTIVE_TRACE.set(self)
+
+    def deactivate(self, token=None):
+        self.closed = True
+        self._t1 = time.perf_counter_ns()
+        if token is not None:
+            _ACTIVE_TRACE.reset(token)
+
+    @property
+    def total_ms(self) -> float:
+        return ((self._t1 or time.perf_counter_ns()) - self._t0) / 1e6
+
+    def summary(self) -> pd.DataFrame:
+        """Totales por span: llamadas, ms totales / promedio / máximo (ordenado por total)."""
+        df = pd.DataFrame([(n, d / 1e6) for n, _, d, _, _ in self.spans], columns=["span", "ms"])
+        if df.empty:
+            return pd.DataFrame(columns=["span", "calls", "total_ms", "mean_ms", "max_ms"])
+        out = df.groupby("span")["ms"].agg(calls="size", total_ms="sum", mean_ms="mean", max_ms="max")
+        return out.sort_values("total_ms", ascending=False).reset_index()
+
+    def to_dict(self) -> dict:
+        return {
+            "name": self.name, "started_at": self.started_at, "total_ms": self.total_ms,
+            "counters": dict(self.counters),
+            "spans": [{"name": n, "start_ms": t / 1e6, "dur_ms": d / 1e6, "thread": tid, "args": a or {}}
+                      for n, t, d, tid, a in sorted(self.spans, key=lambda r: r[1])],
+        }
+
+    def to_chrome_trace(self) -> dict:
+        """Formato Trace Event (eventos completos "X" en µs, un tid por hilo, contadores "C")."""
+        tids = {}
+        events = []
+        for n, t, d, tid, a in sorted(self.spans, key=lambda r: r[1]):
+            events.append({"name": n, "cat": n.split(".")[0], "ph": "X", "ts": t / 1e3, "dur": d / 1e3,
+                           "pid": 1, "tid": tids.setdefault(tid, len(tids)), "args": a or {}})
+        for tid, i in tids.items():
+            events.append({"name": "thread_name", "ph": "M", "pid": 1, "tid": i,
+                           "args": {"name": "main" if i == 0 else f"worker-{i}"}})
+        if self.counters:
+            events.append({"name": "counters", "ph": "C", "ts": self.total_ms * 1e3, "pid": 1, "tid": 0,
+                           "args": dict(self.counters)})
+        return {"traceEvents": events, "displayTimeUnit": "ms", "otherData": {"name": self.name,
+                                                                              "started_at": self.started_at}}
+
+_ACTIVE_TRACE = contextvars.ContextVar("greenscore_trace", default=None)
+_NO_SPAN = nullcontext()
+
+def trace_span(name: str, **args):
+    """Span en la traza activa; sin traza es un nullcontext compartido (costo ~nulo)."""
+    tr = _ACTIVE_TRACE.get()
+    return tr.span(name, **args) if tr is not None else _NO_SPAN
+
+def trace_count(name: str, n: int = 1):
+    tr = _ACTIVE_TRACE.get()
+    if tr is not None:
+        tr.count(name, n)
+
+def traced(name: str):
+    """Decorador: la llamada completa queda como span `name` cuando hay una traza activa."""
+    def deco(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            tr = _ACTIVE_TRACE.get()
+            if tr is None:
+                return fn(*args, **kwargs)
+            with tr.span(name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return deco
+
+@contextmanager
+def tracing(name: str = ""):
+    """Activa una Trace nueva durante el bloque y la devuelve (cerrada al salir)."""
+    tr = Trace(name)
+    token = tr.activate()
+    try:
+        yield tr
+    finally:
+        tr.deactivate(token)
+
+# ========================= DIAGNÓSTICOS =========================
+
+class Diagnostics:
+    """
+    Avisos del motor (dependencia faltante, respuesta no JSON, parser deshabilitado, …) como
+    registros {level, code, message, context} en lugar de st.warning: la UI los muestra, la CLI
+    los escribe en su reporte. Igual que Trace, se activa por contexto y los hilos que heredan
+    el contexto registran en la misma lista.
+    """
+
+    def __init__(self):
+        self.items = []
+        self._lock = threading.Lock()
+
+    def add(self, level: str, code: str, message: str, **context) -> dict:
+        rec = {"level": level, "code": code, "message": message, "context": context}
+        with self._lock:
+            self.items.append(rec)
+        return rec
+
+    def activate(self):
+        return _ACTIVE_DIAGNOSTICS.set(self)
+
+    def deactivate(self, token=None):
+        if token is not None:
+            _ACTIVE_DIAGNOSTICS.reset(token)
+
+    def messages(self, level: str | None = None) -> list[str]:
+        """Mensajes sin repetir (en orden), opcionalmente de un solo nivel."""
+        return list(dict.fromkeys(d["message"] for d in self.items if level is None or d["level"] == level))
+
+    def __len__(self):
+        return len(self.items)
+
+    def __iter__(self):
+        return iter(list(self.items))
+
+_ACTIVE_DIAGNOSTICS = contextvars.ContextVar("greenscore_diagnostics", default=None)
+_LOG = logging.getLogger("greenscore")
+
+def diagnose(code: str, message: str, level: str = "warning", **context) -> dict:
+    """Registra un aviso en los Diagnostics activos; sin colector activo va al logger `greenscore`."""
+    diags = _ACTIVE_DIAGNOSTICS.get()
+    if diags is not None:
+        return diags.add(level, code, message, **context)
+    _LOG.log(logging.INFO if level == "info" else logging.WARNING, "%s: %s", code, message)
+    return {"level": level, "code": code, "message": message, "context": context}
+
+@contextmanager
+def collecting_diagnostics():
+    """Activa un Diagnostics nuevo durante el bloque y lo devuelve."""
+    diags = Diagnostics()
+    token = diags.activate()
+    try:
+        yield diags
+    finally:
+        diags.deactivate(token)
+
+# ========================= ESQUEMAS COMPILADOS =========================
+
+class MetricSpec:
+    """Métrica de un esquema ya resuelta (tipo, target y categoría como índice)."""
+    __slots__ = ("key", "label", "category", "cat_idx", "typ", "target")
+
+    def __init__(self, key, label, category, cat_idx, typ, target):
+        self.key = key
+        self.label = label
+        self.category = category
+        self.cat_idx = cat_idx
+        self.typ = typ
+        self.target = target
+
+    def __repr__(self):
+        return f"MetricSpec({self.key!r}, {self.category!r}, {self.typ!r}, target={self.target!r})"
+
+class CompiledScheme:
+    """
+    Esquema de scoring precompilado: se arma una vez a partir del dict de read_scoring_config()
+    y deja listas las tablas de normalización para el scoring individual y de portfolio.
+
+    - categories / weights: categorías del esquema (orden de `weights`) y sus pesos.
+    - cat_index: índice de categoría de cada métrica (orden de `metrics`).
+    - targets: target de cada métrica; divisors: divisor efectivo de `valor / target`.
+    - is_bool / zero_mask: máscaras por tipo (bool) y métricas con target 0 (normalizan a 0).
+    - fingerprint: hash estable del dict del esquema (clave de cachés de scores).
+    """
+    __slots__ = ("metrics", "keys", "categories", "weights", "cat_index", "cat_counts",
+                 "targets", "divisors", "is_bool", "zero_mask", "fingerprint")
+
+    def __init__(self, scheme_cfg: dict, validate: bool = True):
+        self.fingerprint = hashlib.sha1(
+            json.dumps(scheme_cfg, sort_keys=True, ensure_ascii=False, default=str).encode("utf-8")
+        ).hexdigest()[:16]
+        weights = scheme_cfg["weights"]
+        categories = list(weights.keys())
+        specs = []
+        for key, meta in scheme_cfg["metrics"].items():
+            cat = meta["category"]
+            if cat not in categories:
+                # categoría sin peso: se promedia pero no aporta al total (igual que compute_scores)
+                categories.append(cat)
+            specs.append(MetricSpec(key, meta.get("label", key), cat, categories.index(cat),
+                                    meta.get("type", "number"), meta.get("target", 1)))
+        self.metrics = tuple(specs)
+        self.keys = tuple(s.key for s in specs)
+        self.categories = tuple(categories)
+        self.weights = np.array([float(w) for w in weights.values()])
+        self.cat_index = np.array([s.cat_idx for s in specs], dtype=np.intp)
+        self.cat_counts = np.bincount(self.cat_index, minlength=len(categories))
+        self.targets = np.array([float(s.target) for s in specs])
+        self.is_bool = np.array([s.typ == "bool" for s in specs], dtype=bool)
+        divisors, zero = [], []
+        for s in specs:
+            t = float(s.target)
+            if s.typ == "bool":
+                divisors.append(t if s.target else 1.0); zero.append(False)
+            elif s.typ in ("pct", "number"):
+                divisors.append(t if t != 0 else 1.0); zero.append(t == 0)
+            else:
+                divisors.append(1.0); zero.append(False)
+        self.divisors = np.array(divisors)
+        self.zero_mask = np.array(zero, dtype=bool)
+        if validate:
+            total_w = float(sum(weights.values()))
+            if abs(total_w - 1.0) > 1e-6:
+                raise ValueError(f"Los pesos de las categorías deben sumar 1 (suman {total_w:.4f}).")
+
+def compile_scheme(scheme_cfg, validate: bool = True) -> CompiledScheme:
+    if isinstance(scheme_cfg, CompiledScheme):
+        return scheme_cfg
+    return CompiledScheme(scheme_cfg, validate=validate)
+
+# ========================= SCORING =========================
+
+def clamp01(x: float) -> float:
+    if x is None: return 0.0
+    try: x = float(x)
+    except: x = 0.0
+    return max(0.0, min(1.0, x))
+
+def normalize(value, meta):
+    target = meta.get("target", 1)
+    typ = meta.get("type", "number")
+    if typ == "bool":
+        v = 1.0 if bool(value) else 0.0
+        return clamp01(v / target if target else v)
+    try:
+        v = float(value)
+    except:
+        v = 0.0
+    if typ in ("pct", "number"):
+        return clamp01(v / float(target)) if float(target) != 0 else 0.0
+    return clamp01(v)
+
+def _to_float(v) -> float:
+    try: return float(v)
+    except: return 0.0
+
+def _clamp01_array(x: np.ndarray) -> np.ndarray:
+    # mismo resultado que clamp01: max(0, min(1, NaN)) == 1.0
+    return np.where(np.isnan(x), 1.0, np.clip(x, 0.0, 1.0))
+
+def _normalize_matrix(values: np.ndarray, scheme: CompiledScheme) -> np.ndarray:
+    """Normaliza una matriz (filas × métricas) ya convertida a float con las tablas del esquema."""
+    norm = _clamp01_array(values / scheme.divisors)
+    if scheme.zero_mask.any():
+        norm[..., scheme.zero_mask] = 0.0
+    return norm
+
+def compute_scores(inputs: dict, scheme_cfg):
+    scheme = compile_scheme(scheme_cfg, validate=False)
+    raw = [inputs.get(s.key, 0) for s in scheme.metrics]
+    vals = np.array([(1.0 if bool(v) else 0.0) if s.typ == "bool" else _to_float(v)
+                     for s, v in zip(scheme.metrics, raw)])
+    norm = _normalize_matrix(vals, scheme)
+    # bincount suma en orden de métricas, igual que sum(lista) por categoría
+    sums = np.bincount(scheme.cat_index, weights=norm, minlength=len(scheme.categories))
+    cat_scores = np.divide(sums, scheme.cat_counts, out=np.zeros_like(sums), where=scheme.cat_counts > 0)
+    n_w = len(scheme.weights)
+    contrib = cat_scores[:n_w] * scheme.weights
+    total = sum(contrib.tolist()) * 100.0
+    contribs = [{"Category": c, "Contribution": float(v) * 100.0}
+                for c, v in zip(scheme.categories[:n_w], contrib)]
+    metric_rows = [{"metric": s.key, "label": s.label, "category": s.category, "value": v, "normalized": float(nv)}
+                   for s, v, nv in zip(scheme.metrics, raw, norm)]
+    return total, pd.DataFrame(contribs), pd.DataFrame(metric_rows)
+
+def _batch_metric_values(col: pd.Series, is_bool: bool) -> np.ndarray:
+    """Convierte una columna de métrica a float64 con el mismo criterio que `normalize`."""
+    numeric = pd.api.types.is_numeric_dtype(col.dtype) or pd.api.types.is_bool_dtype(col.dtype)
+    if is_bool:
+        if numeric:
+            # bool(x) en Python: NaN es True, 0 es False
+            return (col.to_numpy(dtype="float64", na_value=np.nan) != 0).astype("float64")
+        return col.map(lambda v: 1.0 if bool(v) else 0.0).to_numpy(dtype="float64")
+    if numeric:
+        return col.to_numpy(dtype="float64", na_value=np.nan)
+    return col.map(_to_float).to_numpy(dtype="float64")
+
+def compute_scores_batch(df: pd.DataFrame, scheme_cfg) -> pd.DataFrame:
+    """
+    Versión vectorizada de compute_scores para un DataFrame completo (una fila por proyecto).
+    Acepta el dict del esquema o un CompiledScheme. Devuelve un DataFrame con el mismo índice
+    que `df`: columna `score` (0–100) y una columna `contrib_<Categoría>` por cada peso del
+    esquema. Los resultados coinciden exactamente con compute_scores fila a fila.
+    """
+    scheme = compile_scheme(scheme_cfg, validate=False)
+    n = len(df)
+    values = np.zeros((n, len(scheme.metrics)))
+    for j, s in enumerate(scheme.metrics):
+        if s.key in df.columns:
+            values[:, j] = _batch_metric_values(df[s.key], bool(scheme.is_bool[j]))
+    norm = _normalize_matrix(values, scheme)
+    out = {}
+    total = np.zeros(n)
+    for ci, (cat, w) in enumerate(zip(scheme.categories, scheme.weights)):
+        cols = np.flatnonzero(scheme.cat_index == ci)
+        acc = np.zeros(n)
+        for j in cols:  # mismo orden de suma que compute_scores
+            acc = acc + norm[:, j]
+        cat_score = acc / len(cols) if len(cols) else acc
+        total = total + cat_score * w
+        out[f"contrib_{cat}"] = cat_score * w * 100.0
+    return pd.DataFrame({"score": total * 100.0, **out}, index=df.index)
+
+# ========================= CACHE INCREMENTAL DE SCORES =========================
+
+def _portfolio_row_hashes(df: pd.DataFrame, scheme: CompiledScheme) -> np.ndarray:
+    """Hash (uint64) por fila sobre las métricas del esquema presentes en `df`."""
+    cols = [k for k in scheme.keys if k in df.columns]
+    if not cols:
+        return np.zeros(len(df), dtype="uint64")
+    return pd.util.hash_pandas_object(df[cols], index=False).to_numpy()
+
+def portfolio_fingerprint(df: pd.DataFrame, cfg: dict | None = None) -> str:
+    """Huella estable de un portfolio completo (filas, columnas y orden) más la config de esquemas."""
+    h = hashlib.sha1(pd.util.hash_pandas_object(df, index=False).to_numpy().tobytes())
+    h.update(json.dumps([list(map(str, df.columns)), cfg], sort_keys=True, ensure_ascii=False,
+                        default=str).encode("utf-8"))
+    return h.hexdigest()[:16]
+
+class ScoreCache:
+    """
+    Cache incremental de scores de portfolio, clave (huella del esquema, hash de fila).
+    Solo las filas nuevas o modificadas pasan por compute_scores_batch; el resto se
+    resuelve con un reindex sobre lo ya calculado. Al superar `max_rows` se descartan
+    los esquemas usados hace más tiempo.
+    """
+
+    def __init__(self, max_rows: int = 2_000_000):
+        self.max_rows = max_rows
+        self._store: dict[str, pd.Series] = {}
+        self.hits = self.misses = 0
+        self.last_hits = self.last_misses = 0
+
+    def __len__(self):
+        return sum(len(s) for s in self._store.values())
+
+    def score(self, df: pd.DataFrame, scheme) -> pd.Series:
+        scheme = compile_scheme(scheme, validate=False)
+        fp = scheme.fingerprint
+        hashes = _portfolio_row_hashes(df, scheme)
+        store = self._store.pop(fp, None)
+        if store is None:
+            vals = np.full(len(df), np.nan)
+        else:
+            vals = store.reindex(hashes).to_numpy(dtype="float64", copy=True)
+        # el score nunca es NaN (clamp01 lleva NaN a 1), así que NaN = no cacheado
+        miss = np.isnan(vals)
+        if miss.any():
+            new = compute_scores_batch(df.iloc[np.flatnonzero(miss)], scheme)["score"].to_numpy()
+            vals[miss] = new
+            new_s = pd.Series(new, index=hashes[miss])
+            new_s = new_s[~new_s.index.duplicated()]
+            store = new_s if store is None else pd.concat([store, new_s])
+        if store is not None:
+            self._store[fp] = store  # reinsertado al final = usado recientemente
+        self._evict()
+        self.last_misses = int(miss.sum())
+        self.last_hits = len(df) - self.last_misses
+        self.hits += self.last_hits
+        self.misses += self.last_misses
+        return pd.Series(vals, index=df.index, name="score")
+
+    def _evict(self):
+        while len(self._store) > 1 and len(self) > self.max_rows:
+            self._store.pop(next(iter(self._store)))
+
+    def clear(self):
+        self._store.clear()
+        self.hits = self.misses = self.last_hits = self.last_misses = 0
+
+# ========================= PORTFOLIO EN STREAMING (CSV GRANDES) =========================
+
+def score_portfolio_csv_streaming(source, scheme_cfg, chunksize: int = 100_000, top_n: int = 50) -> dict:
+    """
+    Lee un CSV de portfolio por bloques (solo `project_name`, `typology` y las métricas del
+    esquema), puntúa cada bloque con compute_scores_batch y conserva únicamente
+    project_name / typology (category) / score (float32) más agregados acumulados.
+    Las métricas viven solo dentro del bloque, así que el score es idéntico al del modo normal.
+
+    Devuelve {"scores", "by_typology", "top", "rows", "chunks", "missing", "score_sum", "score_max"}.
+    """
+    scheme = compile_scheme(scheme_cfg, validate=False)
+    if hasattr(source, "seek"):
+        source.seek(0)
+    header = list(pd.read_csv(source, nrows=0).columns)
+    if hasattr(source, "seek"):
+        source.seek(0)
+    if "project_name" not in header:
+        raise ValueError("El CSV debe incluir la columna `project_name`.")
+    wanted = set(scheme.keys) | {"project_name", "typology"}
+    usecols = [c for c in header if c in wanted]
+    missing = [k for k in scheme.keys if k not in header]
+
+    names, typologies, scores = [], [], []
+    agg = None
+    top = None
+    rows = chunks = 0
+    reader = pd.read_csv(source, usecols=usecols, chunksize=chunksize,
+                         dtype={"project_name": "string", "typology": "category"})
+    for chunk in reader:
+        chunks += 1
+        rows += len(chunk)
+        score = compute_scores_batch(chunk, scheme)["score"]
+        if "typology" in chunk.columns:
+            tp = chunk["typology"]
+            if "Sin tipología" not in tp.cat.categories:
+                tp = tp.cat.add_categories("Sin tipología")
+            tp = tp.fillna("Sin tipología")
+        else:
+            tp = pd.Categorical(["Sin tipología"] * len(chunk))
+        part = pd.DataFrame({"project_name": chunk["project_name"], "typology": tp, "score": score})
+
+        g = part.groupby("typology", observed=True)["score"].agg(["count", "sum", "max"])
+        if agg is None:
+            agg = g
+        else:
+            agg = agg.reindex(agg.index.union(g.index))
+            g = g.reindex(agg.index)
+            agg["count"] = agg["count"].fillna(0) + g["count"].fillna(0)
+            agg["sum"] = agg["sum"].fillna(0) + g["sum"].fillna(0)
+            agg["max"] = np.fmax(agg["max"], g["max"])
+
+        best = part.nlargest(top_n, "score")
+        top = best if top is None else pd.concat([top, best], ignore_index=True).nlargest(top_n, "score")
+
+        names.append(part["project_name"])
+        typologies.append(part["typology"])
+        scores.append(part["score"].to_numpy(dtype="float32"))
+
+    if rows:
+        out = pd.DataFrame({
+            "project_name": pd.concat(names, ignore_index=True),
+            "typology": pd.api.types.union_categoricals(typologies),
+            "score": np.concatenate(scores),
+        })
+        by_tp = agg.reset_index().rename(columns={"index": "typology"})
+        by_tp["typology"] = by_tp["typology"].astype(str)
+        by_tp["count"] = by_tp["count"].astype("int64")
+        by_tp["mean"] = by_tp["sum"] / by_tp["count"]
+    else:
+        out = pd.DataFrame({"project_name": pd.Series(dtype="string"),
+                            "typology": pd.Categorical([]), "score": np.array([], dtype="float32")})
+        by_tp = pd.DataFrame(columns=["typology", "count", "sum", "max", "mean"])
+        top = out.copy()
+    return {
+        "scores": out,
+        "by_typology": by_tp,
+        "top": top.reset_index(drop=True),
+        "rows": rows,
+        "chunks": chunks,
+        "missing": missing,
+        "score_sum": float(by_tp["sum"].sum()) if rows else 0.0,
+        "score_max": float(by_tp["max"].max()) if rows else None,
+    }
+
+# ========================= SCORING MULTI-ESQUEMA EN PARALELO =========================
+
+_PROCESS_POOL = None
+_PROCESS_POOL_LOCK = threading.Lock()
+
+def _process_pool():
+    """
+    Pool de procesos del proceso (spawn, os.cpu_count() workers), creado una vez bajo lock y
+    compartido entre sesiones y reruns: nunca se redimensiona ni se cierra, así un llamador
+    no cancela las tareas de otro. Cada llamada acota su concurrencia con _pool_map.
+    """
+    global _PROCESS_POOL
+    with _PROCESS_POOL_LOCK:
+        if _PROCESS_POOL is None:
+            import multiprocessing as mp
+            from concurrent.futures import ProcessPoolExecutor
+            # spawn: no se hace fork del servidor de Streamlit (hilos, sockets)
+            _PROCESS_POOL = ProcessPoolExecutor(max_workers=os.cpu_count() or 1,
+                                                mp_context=mp.get_context("spawn"))
+        return _PROCESS_POOL
+
+def _pool_map(fn, *iterables, max_workers: int) -> list:
+    """map ordenado en el pool compartido con a lo sumo `max_workers` tareas propias en vuelo."""
+    from concurrent.futures import FIRST_COMPLETED, wait
+    pool = _process_pool()
+    args = list(zip(*iterables))
+    results = [None] * len(args)
+    pending = {}
+    try:
+        for i, a in enumerate(args):
+            if len(pending) >= max_workers:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for fut in done:
+                    results[pending.pop(fut)] = fut.result()
+            pending[pool.submit(fn, *a)] = i
+        for fut in list(pending):
+            results[pending.pop(fut)] = fut.result()
+    finally:
+        for fut in pending:  # solo las tareas de esta llamada
+            fut.cancel()
+    return results
+
+def _score_shard_all_schemes(shard: pd.DataFrame, schemes: dict) -> pd.DataFrame:
+    return pd.DataFrame(
+        {f"score_{name}": compute_scores_batch(shard, s)["score"].to_numpy() for name, s in schemes.items()},
+        index=shard.index,
+    )
+
+def score_all_schemes(df: pd.DataFrame, cfg: dict | None = None, max_workers: int | None = None,
+                      shard_rows: int = 50_000) -> pd.DataFrame:
+    """
+    Puntúa `df` con todos los esquemas de la config y devuelve un DataFrame ancho con el
+    mismo índice: `score_LEED`, `score_EDGE`, … El portfolio se parte en shards de
+    `shard_rows` filas que se reparten en un pool de procesos; cada worker puntúa todos
+    los esquemas de su shard. Portfolios chicos (un solo shard) se puntúan en el proceso.
+    """
+    cfg = cfg or read_scoring_config()
+    schemes = {n: compile_scheme(c, validate=False) for n, c in cfg["schemes"].items()}
+    keys = sorted({k for s in schemes.values() for k in s.keys if k in df.columns})
+    data = df[keys]  # solo las métricas viajan a los workers
+    n_shards = max(1, -(-len(df) // shard_rows))
+    workers = min(max_workers or os.cpu_count() or 1, n_shards)
+    if workers <= 1:
+        return _score_shard_all_schemes(data, schemes)
+    shards = [data.iloc[i:i + shard_rows] for i in range(0, len(data), shard_rows)]
+    parts = _pool_map(_score_shard_all_schemes, shards, [schemes] * len(shards), max_workers=workers)
+    return pd.concat(parts)
+
+# ========================= ALMACÉN LOCAL DE PORTFOLIOS (PARQUET) =========================
+
+PORTFOLIO_STORE_DIR = Path("data/portfolio_store")
+
+def _portfolio_store_path(name: str) -> Path:
+    safe = re.sub(r"[^a-zA-Z0-9_\-]+", "_", (name or "").strip()).strip("_")
+    return PORTFOLIO_STORE_DIR / (safe or "portfolio")
+
+def _typology_partitioning():
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+    return ds.partitioning(pa.schema([("typology", pa.string())]), flavor="hive")
+
+def list_portfolio_stores() -> list[str]:
+    if not PORTFOLIO_STORE_DIR.exists():
+        return []
+    return sorted(p.name for p in PORTFOLIO_STORE_DIR.iterdir() if (p / "_meta.json").exists())
+
+def portfolio_store_meta(name: str) -> dict:
+    return json.loads((_portfolio_store_path(name) / "_meta.json").read_text(encoding="utf-8"))
+
+def write_portfolio_store(df: pd.DataFrame, name: str, cfg: dict | None = None,
+                          row_group_size: int = 64_000) -> Path:
+    """
+    Guarda un portfolio como dataset Parquet particionado por `typology` (hive), con una
+    columna `score_<ESQUEMA>` por cada esquema de la config. Cada partición se escribe
+    ordenada por el score del primer esquema para que las estadísticas de row group
+    permitan saltear bloques con el filtro de score mínimo. Solo ese esquema se beneficia:
+    los demás scores quedan desordenados dentro de cada row group, así que su filtro se
+    aplica fila por fila (resultado correcto, pero se leen todos los bloques de la partición).
+    """
+    import shutil
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+
+    cfg = cfg or read_scoring_config()
+    schemes = {n: compile_scheme(c, validate=False) for n, c in cfg["schemes"].items()}
+    metric_cols = sorted({k for s in schemes.values() for k in s.keys if k in df.columns})
+    cols = {
+        "project_name": df["project_name"].astype(str).to_numpy(),
+        "typology": (df["typology"].fillna("Sin tipología").astype(str).to_numpy()
+                     if "typology" in df.columns else np.full(len(df), "Sin tipología", dtype=object)),
+    }
+    for k in metric_cols:
+        cols[k] = pd.to_numeric(df[k], errors="coerce").to_numpy(dtype="float64")
+    for c, v in score_all_schemes(df, cfg).items():
+        cols[c] = v.to_numpy()
+    first = f"score_{next(iter(schemes))}" if schemes else None
+    out = pd.DataFrame(cols)
+    if first:
+        out = out.sort_values(["typology", first], ascending=[True, False], kind="stable")
+
+    path = _portfolio_store_path(name)
+    if path.exists():
+        shutil.rmtree(path)
+    ds.write_dataset(
+        pa.Table.from_pandas(out, preserve_index=False), path, format="parquet",
+        partitioning=_typology_partitioning(),
+        max_rows_per_group=row_group_size, min_rows_per_group=min(row_group_size, 1024),
+    )
+    meta = {
+        "name": name,
+        "rows": int(len(out)),
+        "metrics": metric_cols,
+        "typologies": sorted(out["typology"].unique().tolist()),
+        "schemes": {n: s.fingerprint for n, s in schemes.items()},
+        "written_at": pd.Timestamp.now().strftime("%Y-%m-%d %H:%M"),
+    }
+    (path / "_meta.json").write_text(json.dumps(meta, ensure_ascii=False, indent=2), encoding="utf-8")
+    return path
+
+def read_portfolio_store(name: str, scheme_name: str, scheme_cfg, typologies=None,
+                         min_score: float | None = None, with_metrics: bool = True) -> pd.DataFrame:
+    """
+    Lee un portfolio guardado aplicando los filtros como predicados de pushdown:
+    `typologies` poda particiones y `min_score` descarta row groups por estadísticas, lo que
+    solo poda bloques para el primer esquema de la config (el orden de escritura); para los
+    otros esquemas el mismo predicado filtra las filas ya leídas.
+    Devuelve project_name, typology, score (del esquema pedido) y, opcionalmente, las métricas.
+    Si el esquema cambió desde que se guardó (huella distinta) el score se recalcula.
+    """
+    import pyarrow.dataset as ds
+
+    scheme = compile_scheme(scheme_cfg, validate=False)
+    path = _portfolio_store_path(name)
+    meta = portfolio_store_meta(name)
+    dataset = ds.dataset(path, format="parquet", partitioning=_typology_partitioning(),
+                         exclude_invalid_files=True)
+    score_col = f"score_{scheme_name}"
+    fresh = meta.get("schemes", {}).get(scheme_name) == scheme.fingerprint
+    metric_cols = [k for k in scheme.keys if k in meta.get("metrics", [])]
+
+    expr = None
+    if typologies is not None:
+        expr = ds.field("typology").isin(list(typologies))
+    if fresh and min_score:
+        e = ds.field(score_col) >= float(min_score)
+        expr = e if expr is None else (expr & e)
+    columns = ["project_name", "typology"]
+    if fresh:
+        columns.append(score_col)
+    if with_metrics or not fresh:
+        columns += metric_cols
+    df = dataset.to_table(columns=columns, filter=expr).to_pandas()
+    if fresh:
+        df = df.rename(columns={score_col: "score"})
+    else:
+        df["score"] = compute_scores_batch(df, scheme)["score"]
+        if min_score:
+            df = df[df["score"] >= float(min_score)]
+        if not with_metrics:
+            df = df[["project_name", "typology", "score"]]
+    return df
+
+def label_tier(score: float):
+    return ("Platinum (demo)" if score>=85 else
+            "Gold (demo)" if score>=75 else
+            "Silver (demo)" if score>=65 else
+            "Bronze (demo)" if score>=50 else
+            "Starter (demo)")
+
+# ========================= REPORTE (HTML / PDF) =========================
+
+_SLUG_DROP_RX = re.compile(r"[^a-zA-Z0-9\s\-_/]")
+_SLUG_SPACE_RX = re.compile(r"\s+")
+
+def _slugify(text: str) -> str:
+    t = _SLUG_DROP_RX.sub("", text or "")
+    t = _SLUG_SPACE_RX.sub("-", t.strip())
+    return t.lower()[:80] or "sec"
+
+_REPORT_SECTION_KEYS = [
+    "Resumen Ejecutivo", "Alcance", "Contexto", "Revisión Energética",
+    "Línea de Base", "EnPIs", "Oportunidades", "Medidas", "Ahorros",
+    "Plan de Implementación", "Monitoreo", "Verificación", "M&V",
+    "Riesgos", "Recomendaciones", "Conclusiones"
+]
+# Todas las claves en una sola alternancia (las más largas primero): una búsqueda por línea
+_SECTION_KEY_RX = re.compile(
+    "|".join(re.escape(k) for k in sorted(_REPORT_SECTION_KEYS, key=len, reverse=True)), re.IGNORECASE)
+
+_MD_HEADING_RX = re.compile(r"(#{1,3})\s+(.*)")
+_MD_BULLET_RX = re.compile(r"[-*•]\s+(.*)")
+_MD_ORDERED_RX = re.compile(r"\d{1,3}[.)]\s+(.*)")
+_MD_TABLE_SEP_RX = re.compile(r"\|?(\s*:?-+:?\s*\|)*\s*:?-+:?\s*\|?")
+# Empieza con una clase de caracteres ([*`]) para que el motor salte directo a los candidatos
+_MD_INLINE_RX = re.compile(
+    r"[*`](?:(?<=\*)\*(?=\S)(.+?)(?<=\S)\*\*"                       # **negrita**
+    r"|(?<=`)([^`]+)`"                                              # `código`
+    r"|(?<=\*)(?<![\w*]\*)(?=[^\s*])([^*]+?)(?<=\S)\*(?![\w*]))"  # *cursiva*
+)
+_MD_CONTAINERS = ("ul", "ol", "table")
+
+def _md_inline(text: str) -> str:
+    """Texto de una línea → HTML escapado con **negrita**, *cursiva* y `código`."""
+    def sub(m):
+        bold, code, em = m.groups()
+        if code is not None:
+            return f"<code>{code}</code>"
+        return f"<em>{em}</em>" if em is not None else f"<strong>{bold}</strong>"
+    return _MD_INLINE_RX.sub(sub, _html_escape(text, quote=False))
+
+def _md_plain(text: str) -> str:
+    """Texto sin marcas inline (títulos del índice y anclas)."""
+    return _MD_INLINE_RX.sub(lambda m: next(g for g in m.groups() if g is not None), text)
+
+def _md_classify(line: str):
+    """Línea recortada y no vacía → (tipo de bloque, contenido)."""
+    m = _MD_HEADING_RX.match(line)
+    if m:
+        return ("h3" if len(m.group(1)) == 3 else "h2"), m.group(2).strip()
+    if line.startswith("|"):
+        if _MD_TABLE_SEP_RX.fullmatch(line):
+            return "table_sep", None
+        return "table", [c.strip() for c in line.strip("|").split("|")]
+    # línea corta que nombra una sección típica del informe → encabezado, también numerada
+    # ("1. Resumen Ejecutivo", "2) Línea de Base") o con viñeta, antes de tomarla como lista
+    if len(line) < 80 and _SECTION_KEY_RX.search(line):
+        m = _MD_BULLET_RX.match(line)
+        return "h2", m.group(1) if m else line
+    m = _MD_BULLET_RX.match(line)
+    if m:
+        return "ul", m.group(1)
+    m = _MD_ORDERED_RX.match(line)
+    if m:
+        return "ol", m.group(1)
+    return "p", line
+
+class ReportBlock:
+    """Bloque del documento: h2 / h3 / p (`text`), ul / ol (`items`) o table (`items` = filas)."""
+    __slots__ = ("kind", "text", "items", "header", "sid")
+
+    def __init__(self, kind, text="", items=None, header=False, sid=""):
+        self.kind = kind
+        self.text = text
+        self.items = items if items is not None else []
+        self.header = header
+        self.sid = sid
+
+    def __repr__(self):
+        return f"ReportBlock({self.kind!r}, {self.text or self.items!r})"
+
+def _md_block_html(b: ReportBlock, pdf: bool = False) -> str:
+    if b.kind in ("h2", "h3"):
+        return f'<{b.kind} id="{b.sid}">{_md_inline(b.text)}</{b.kind}>'
+    if b.kind in ("ul", "ol"):
+        return f"<{b.kind}>" + "".join(f"<li>{_md_inline(t)}</li>" for t in b.items) + f"</{b.kind}>"
+    if b.kind == "table":
+        width = max(len(r) for r in b.items)
+        rows = [r + [""] * (width - len(r)) for r in b.items]
+        head = ""
+        if b.header:
+            head = "<thead><tr>" + "".join(f"<th>{_md_inline(c)}</th>" for c in rows[0]) + "</tr></thead>"
+            rows = rows[1:]
+        body = "".join("<tr>" + "".join(f"<td>{_md_inline(c)}</td>" for c in r) + "</tr>" for r in rows)
+        # xhtml2pdf repite el encabezado en cada página con repeat="1"
+        repeat = ' repeat="1"' if pdf and b.header else ""
+        return f'<table class="md-table"{repeat}>{head}<tbody>{body}</tbody></table>'
+    return f"<p>{_md_inline(b.text)}</p>"
+
+class ReportDoc:
+    """
+    Árbol del reporte: lista de bloques armada en una sola pasada, línea por línea (add_line),
+    así el stream del modelo y el texto completo producen el mismo documento. El HTML de
+    pantalla, el del PDF y el índice salen del árbol, sin volver a leer el texto.
+    """
+    __slots__ = ("blocks", "open_block", "anchor_prefix", "_sids", "_html")
+
+    def __init__(self, anchor_prefix: str = ""):
+        self.blocks = []
+        self.anchor_prefix = anchor_prefix  # anclas únicas cuando varios sitios van en un mismo documento
+        self.open_block = None  # lista o tabla que todavía puede crecer
+        self._sids = {}
+        self._html = {}
+
+    def add_line(self, line: str):
+        line = line.strip()
+        if not line:
+            self.close()
+            return
+        kind, content = _md_classify(line)
+        cur = self.open_block
+        if kind == "table_sep":
+            # `|---|` tras la primera fila: esa fila es el encabezado; si no, se ignora
+            if cur is not None and cur.kind == "table" and len(cur.items) == 1:
+                cur.header = True
+            return
+        if cur is not None:
+            if cur.kind == kind and kind in _MD_CONTAINERS:
+                cur.items.append(content)
+                return
+            self.close()
+        if kind in _MD_CONTAINERS:
+            self.open_block = ReportBlock(kind, items=[content])
+        elif kind in ("h2", "h3"):
+            self.blocks.append(ReportBlock(kind, content, sid=self._anchor(content)))
+        else:
+            self.blocks.append(ReportBlock(kind, content))
+
+    def _anchor(self, title: str) -> str:
+        sid = self.anchor_prefix + _slugify(_md_plain(title))
+        n = self._sids[sid] = self._sids.get(sid, 0) + 1
+        return sid if n == 1 else f"{sid}-{n}"
+
+    def close(self):
+        if self.open_block is not None:
+            self.blocks.append(self.open_block)
+            self.open_block = None
+
+    @property
+    def toc(self) -> list:
+        """[(nivel, título, ancla)] de los encabezados."""
+        return [(b.kind, _md_plain(b.text), b.sid) for b in self.blocks if b.kind in ("h2", "h3")]
+
+    def html(self, pdf: bool = False) -> str:
+        """Cuerpo HTML (para pantalla o para xhtml2pdf); se convierte una vez por destino."""
+        if pdf not in self._html:
+            parts = [_md_block_html(b, pdf) for b in self.blocks]
+            if self.open_block is not None:
+                parts.append(_md_block_html(self.open_block, pdf))
+            self._html[pdf] = "\n".join(parts) if parts else "<p></p>"
+        return self._html[pdf]
+
+def parse_report_text(llm_text: str, anchor_prefix: str = "") -> ReportDoc:
+    doc = ReportDoc(anchor_prefix)
+    for raw in (llm_text or "").splitlines():
+        doc.add_line(raw)
+    doc.close()
+    return doc
+
+def _markdownish_to_html_and_toc(llm_text: str):
+    doc = parse_report_text(llm_text)
+    return doc.html(), doc.toc
+
+class ReportStreamRenderer:
+    """
+    Versión incremental de parse_report_text para el stream del modelo: cada fragmento se
+    acumula, las líneas ya terminadas entran al documento y los bloques cerrados se convierten
+    a HTML una sola vez. finish() devuelve el mismo ReportDoc que el texto completo.
+    """
+
+    def __init__(self):
+        self.doc = ReportDoc()
+        self.body_parts = []
+        self._chunks = []
+        self._pending = ""
+
+    def feed(self, delta: str):
+        if not delta:
+            return
+        self._chunks.append(delta)
+        lines = (self._pending + delta).splitlines(keepends=True)
+        # la última línea sigue abierta salvo que el fragmento termine en salto de línea; un "\r"
+        # final también espera al próximo fragmento (puede ser la mitad de un "\r\n")
+        last = lines[-1] if lines else ""
+        self._pending = lines.pop() if last and (last.splitlines()[0] == last or last.endswith("\r")) else ""
+        for raw in lines:
+            self.doc.add_line(raw)
+
+    @property
+    def text(self) -> str:
+        return "".join(self._chunks)
+
+    def preview_html(self) -> str:
+        """Cuerpo HTML hasta ahora; el bloque abierto y la línea en curso se muestran provisorios."""
+        for b in self.doc.blocks[len(self.body_parts):]:
+            self.body_parts.append(_md_block_html(b))
+        parts = list(self.body_parts)
+        if self.doc.open_block is not None:
+            parts.append(_md_block_html(self.doc.open_block))
+        pending = self._pending.strip()
+        if pending:
+            parts.append(f"<p>{_md_inline(pending)}</p>")
+        return "\n".join(parts)
+
+    def finish(self) -> ReportDoc:
+        if self._pending:
+            self.doc.add_line(self._pending)
+            self._pending = ""
+        self.doc.close()
+        return self.doc
+
+def _em_render_report_html(org: str, site: str, generated_at: str, llm_text: str,
+                           brand_color: str, logo_url: str, parsed: ReportDoc | None = None,
+                           body_html: str | None = None) -> str:
+    """
+    Reporte para pantalla. `parsed` = ReportDoc ya armado (p. ej. por el stream); `body_html`
+    reemplaza el cuerpo directamente (vista previa en vivo).
+    """
+    if body_html is None:
+        body_html = (parsed or parse_report_text(llm_text)).html()
+    org, site, generated_at = (_html_escape(str(v or "")) for v in (org, site, generated_at))
+    style = f"""
+    <style>
+      :root {{ --brand: {brand_color or '#0B8C6B'}; }}
+      html, body {{ background:#fff !important; color:#1b1f24; margin:0; padding:0; }}
+      body {{ font-family: Inter, system-ui, Segoe UI, Roboto, Arial, sans-serif; }}
+      .page {{ background:#fff; padding:24px; }}
+      .header {{ display:flex; align-items:center; gap:16px; border-bottom:3px solid var(--brand); padding-bottom:12px; margin-bottom:24px; }}
+      .badge {{ background: var(--brand); color:#fff; padding:4px 10px; border-radius:999px; font-size:12px; margin-left:auto; }}
+      .meta {{ color:#667085; font-size:12px; }}
+      .section h2 {{ color: var(--brand); border-bottom:1px solid #eaecef; padding-bottom:6px; }}
+      .prose p, .prose li {{ line-height:1.6; }}
+      .prose table {{ border-collapse:collapse; margin:8px 0 16px; }}
+      .prose th, .prose td {{ border:1px solid #eaecef; padding:4px 8px; text-align:left; }}
+      .prose th {{ background:#f6f8fa; }}
+    </style>
+    """
+    logo_html = f'<img src="{_html_escape(logo_url)}" alt="Logo" height="42"/>' if logo_url else ""
+    body = f"""
+    <div class="page">
+      <div class="header">
+        {logo_html}
+        <div>
+          <h1>Reporte de Gestión de la Energía (ISO 50001)</h1>
+          <div class="meta">{org} – {site} · Generado: {generated_at}</div>
+        </div>
+        <span class="badge">Green&nbsp;Score</span>
+      </div>
+      <div class="section prose">
+        {body_html}
+      </div>
+    </div>
+    """
+    return f"<!doctype html><html lang='es'><head><meta charset='utf-8'/><meta name='viewport' content='width=device-width,initial-scale=1'/><title>Reporte Energético – {org} / {site}</title>{style}</head><body>{body}</body></html>"
+
+# Plantillas Jinja2 del HTML A4 (xhtml2pdf): las comparten el reporte de un sitio y el
+# consolidado de varios sitios; se compilan una vez por proceso (_report_templates).
+_PDF_TEMPLATES = {
+    "style.html": """<style>
+  @page {
+    size: A4;
+    margin: 2cm;
+    @bottom-right {
+      content: "Página " counter(page) " de " counter(pages);
+      font-size: 9pt; color: #555;
+    }
+  }
+  body { background:#fff; color:#111; font-family: DejaVu Sans, Arial, sans-serif; font-size:12pt; }
+  h1 { color:{{ brand }}; font-size:22pt; margin:0 0 6pt 0; }
+  h2 { color:{{ brand }}; font-size:15pt; border-bottom:1px solid #ccc; padding-bottom:2pt; margin-top:14pt; }
+  h3 { color:#222; font-size:12.5pt; margin-top:10pt; }
+  p  { line-height:1.4; margin:0 0 8pt 0; }
+  ul, ol { margin:0 0 8pt 0; }
+  table { margin:4pt 0 10pt 0; }
+  th, td { border:0.5pt solid #ccc; padding:3pt 5pt; text-align:left; vertical-align:top; }
+  th { background:#f2f2f2; }
+  a  { color:{{ brand }}; text-decoration:none; }
+  .cover { text-align:center; padding-top:120pt; }
+  .cover .title { font-size:28pt; color:{{ brand }}; margin-top:10pt; }
+  .meta { color:#555; font-size:11pt; margin-top:6pt; }
+  .watermark {
+    position: fixed; top: 35%; left: 10%;
+    transform: rotate(-20deg);
+    font-size: 72pt; color: #e6f2ef;
+    z-index: 0;
+  }
+  .section { position: relative; z-index: 1; }
+  .badge { float:right; background:{{ brand }}; color:#fff; padding:2pt 6pt; border-radius:12pt; font-size:9pt; }
+  .headerline { border-bottom:2pt solid {{ brand }}; padding-bottom:6pt; margin-bottom:12pt; }
+  .toc-site td { border:none; padding:1pt 0; }
+  @media print { .no-print { display:none; } }
+</style>""",
+    "macros.html": """{% macro cover(subtitle, generated_at, logo_url, anchor="") %}
+<div class="watermark">GreenScore</div>
+<div class="cover"{% if anchor %} id="{{ anchor }}"{% endif %}>
+  {% if logo_url %}<img src="{{ logo_url }}" alt="Logo" style="height:64pt;vertical-align:middle;margin-right:10pt;"/>{% endif %}
+  <div class="title">Reporte de Gestión de la Energía (ISO 50001)</div>
+  <div class="meta" style="margin-top:18pt;">{{ subtitle }}</div>
+  <div class="meta">Generado: {{ generated_at }}</div>
+  <div class="meta" style="margin-top:24pt;"><span class="badge">Green&nbsp;Score</span></div>
+</div>
+<pdf:nextpage/>
+{% endmacro %}
+{% macro toc_entries(toc) %}
+{% for level, title, sid in toc %}
+<div style="margin-left:{{ '0' if level == 'h2' else '12' }}pt;">• <a href="#{{ sid }}">{{ title }}</a></div>
+{% endfor %}
+{% endmacro %}
+{% macro site_section(s) %}
+<div class="section">
+  <div class="headerline"><h1>Contenido</h1></div>
+  <h2>Índice</h2>
+  {% if s.toc %}{{ toc_entries(s.toc) }}{% else %}<p>(No se detectaron encabezados en el texto del informe)</p>{% endif %}
+</div>
+<pdf:nextpage/>
+<div class="section">
+  <div class="headerline"><h1>Informe</h1></div>
+  {{ s.body_html|safe }}
+</div>
+{% endmacro %}""",
+    "report.html": """{% import "macros.html" as m %}<!doctype html><html><head><meta charset='utf-8'/>{% include "style.html" %}</head><body>
+{{ m.cover(s.org ~ " – " ~ s.site, generated_at, logo_url, s.anchor) }}
+{{ m.site_section(s) }}
+</body></html>""",
+    # consolidado: portada y el índice global; con `sections` también el reporte de cada sitio
+    "batch.html": """{% import "macros.html" as m %}<!doctype html><html><head><meta charset='utf-8'/>{% include "style.html" %}</head><body>
+{{ m.cover(title, generated_at, logo_url) }}
+<div class="section">
+  <div class="headerline"><h1>Contenido</h1></div>
+  <table class="toc-site">
+  {% for s in sites %}
+    <tr><td>{{ loop.index }}. <a href="#{{ s.anchor }}">{{ s.site }}</a>{% if s.org %} <span class="meta">· {{ s.org }}</span>{% endif %}</td>
+        <td style="text-align:right;">{{ s.start_page or "" }}</td></tr>
+  {% endfor %}
+  </table>
+</div>
+{% if sections %}
+<pdf:nextpage/>
+{% for s in sites %}
+{{ m.cover(s.org ~ " – " ~ s.site, generated_at, logo_url, s.anchor) }}
+{{ m.site_section(s) }}
+{% if not loop.last %}<pdf:nextpage/>{% endif %}
+{% endfor %}
+{% endif %}
+</body></html>""",
+}
+
+@functools.lru_cache(maxsize=1)
+def _report_templates():
+    """Entorno Jinja2 con las plantillas del PDF ya compiladas (una vez por proceso)."""
+    import jinja2
+    env = jinja2.Environment(loader=jinja2.DictLoader(_PDF_TEMPLATES), autoescape=True,
+                             trim_blocks=True, lstrip_blocks=True)
+    return {name: env.get_template(name) for name in ("report.html", "batch.html")}
+
+def _report_section(org: str, site: str, doc: ReportDoc, anchor: str = "") -> dict:
+    return {"org": org or "", "site": site or "", "anchor": anchor, "toc": doc.toc, "body_html": doc.html(pdf=True)}
+
+def _em_render_report_pdf_html(org: str, site: str, generated_at: str, llm_text: str,
+                               brand_color: str, logo_url: str, parsed: ReportDoc | None = None) -> str:
+    doc = parsed or parse_report_text(llm_text)
+    return _report_templates()["report.html"].render(
+        s=_report_section(org, site, doc), generated_at=generated_at, logo_url=logo_url,
+        brand=brand_color or "#0B8C6B")
+
+def _em_html_to_pdf_bytes(html: str) -> bytes | None:
+    try:
+        from xhtml2pdf import pisa
+        out = BytesIO()
+        if not html.lower().strip().startswith("<!doctype"):
+            html = "<!doctype html><html><head><meta charset='utf-8'></head><body>" + html + "</body></html>"
+        pisa.CreatePDF(src=html, dest=out, encoding="utf-8")
+        return out.getvalue()
+    except Exception:
+        return None
+
+# ========================= COMPACTACIÓN DEL DATASET (REPORTE) =========================
+
+REPORT_TOKEN_BUDGET = int(os.getenv("GREENSCORE_REPORT_TOKEN_BUDGET", "3000"))
+
+# Niveles de compactación, de menos a más agresivo:
+# (meses recientes, anomalías, largo máx. de textos, ítems máx. por lista)
+_COMPACT_LEVELS = [(24, 10, 600, 30), (12, 6, 300, 15), (6, 3, 150, 8), (0, 3, 80, 5), (0, 0, 40, 3)]
+
+# Aproximación a un tokenizador BPE: palabras en trozos de ≤6 letras, números de a 3 dígitos
+# (como o200k) y cada signo suelto cuenta uno.
+_TOKEN_RX = re.compile(r"[^\W\d_]{1,6}|\d{1,3}|\S")
+
+def estimate_tokens(text: str) -> int:
+    """Estimación determinística (y algo conservadora) de tokens de un texto, sin tokenizador."""
+    return len(_TOKEN_RX.findall(text or ""))
+
+def _round_sig(obj, sig: int = 4):
+    """Floats a `sig` cifras significativas (NaN/inf → None), recorriendo dicts y listas."""
+    if isinstance(obj, np.generic):
+        obj = obj.item()
+    if isinstance(obj, float):
+        return float(f"{obj:.{sig}g}") if np.isfinite(obj) else None
+    if isinstance(obj, dict):
+        return {k: _round_sig(v, sig) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return [_round_sig(v, sig) for v in obj]
+    return obj
+
+def _trim_value(obj, max_chars: int, max_items: int):
+    """Textos recortados a `max_chars` y listas a `max_items` (+ cuántos se omitieron); sin vacíos."""
+    if isinstance(obj, str):
+        return obj if len(obj) <= max_chars else obj[:max_chars - 1].rstrip() + "…"
+    if isinstance(obj, dict):
+        out = {k: _trim_value(v, max_chars, max_items) for k, v in obj.items()}
+        return {k: v for k, v in out.items() if not (v is None or (isinstance(v, (str, list, dict)) and not v))}
+    if isinstance(obj, (list, tuple)):
+        items = [_trim_value(v, max_chars, max_items) for v in obj[:max_items]]
+        if len(obj) > max_items:
+            items.append(f"(+{len(obj) - max_items} más)")
+        return items
+    return obj
+
+def _monthly_digest(series: list, recent: int, n_anomalies: int, min_dev_pct: float = 15.0) -> dict:
+    """
+    Serie mensual → estadísticas de tamaño acotado: totales de los últimos años, perfil estacional (kWh
+    promedio por mes calendario), tendencia últimos 12 vs. 12 anteriores, los meses más
+    anómalos contra la mediana de su mes calendario y los últimos `recent` meses.
+    """
+    m = pd.DataFrame(series)
+    if m.empty or "month" not in m.columns:
+        return {}
+    m = m.sort_values("month", ignore_index=True)
+    for c in ("kwh", "cost", "demand_kw"):
+        m[c] = pd.to_numeric(m[c], errors="coerce") if c in m.columns else np.nan
+    m["year"] = m["month"].str[:4]
+    m["cal"] = m["month"].str[5:7]
+    kwh = m["kwh"]
+    out = {
+        "months": int(len(m)), "first": m["month"].iloc[0], "last": m["month"].iloc[-1],
+        "kwh_mean": kwh.mean(), "kwh_min": kwh.min(), "kwh_max": kwh.max(), "kwh_std": kwh.std(),
+    }
+    annual = m.groupby("year", sort=True).agg(months=("kwh", "size"), kwh=("kwh", "sum"),
+                                             cost=("cost", "sum"), peak_demand_kw=("demand_kw", "max"))
+    annual = annual.tail(max(recent // 2, 3))  # años más recientes; las estadísticas cubren toda la serie
+    out["annual"] = [{"year": y, **r} for y, r in zip(annual.index, annual.to_dict("records"))]
+    if len(m) >= 12:
+        out["seasonal_kwh_mean"] = m.groupby("cal", sort=True)["kwh"].mean().to_dict()
+    if len(m) >= 24:
+        last, prev = kwh.iloc[-12:].sum(), kwh.iloc[-24:-12].sum()
+        out["last12_vs_prev12_pct"] = (last / prev - 1) * 100 if prev else None
+    if n_anomalies:
+        # esperado = mediana del mismo mes calendario (si hay ≥2 años) o mediana general
+        by_cal = m.groupby("cal")["kwh"]
+        expected = by_cal.transform("median").where(by_cal.transform("count") >= 2, kwh.median())
+        dev = (kwh / expected - 1) * 100
+        cand = m.assign(expected=expected, dev=dev, absdev=dev.abs())
+        cand = cand[cand["absdev"] >= min_dev_pct].sort_values(["absdev", "month"], ascending=[False, True])
+        out["anomalies"] = [{"month": r.month, "kwh": r.kwh, "expected_kwh": r.expected, "deviation_pct": r.dev}
+                            for r in cand.head(n_anomalies).itertuples()]
+    if recent:
+        out["recent"] = m[["month", "kwh", "cost"]].tail(recent).to_dict("records")
+    return out
+
+@traced("report.compact")
+def compact_report_dataset(dataset: dict, token_budget: int | None = None):
+    """
+    Resumen compacto y determinístico del dataset del sitio para el prompt del reporte: sin
+    `preview_rows` ni la serie mensual completa (van estadísticas mensuales y anomalías),
+    evidencias como conteos por tipo, textos y listas recortados y números a 4 cifras.
+    Se aplica el nivel menos agresivo de _COMPACT_LEVELS que entra en `token_budget`
+    (REPORT_TOKEN_BUDGET por defecto). Devuelve (dataset_compacto, info) con la estimación de
+    tokens antes y después.
+    """
+    budget = REPORT_TOKEN_BUDGET if token_budget is None else int(token_budget)
+    full_tokens = estimate_tokens(json.dumps(dataset, ensure_ascii=False, default=str))
+    summary = (dataset.get("invoices") or {}).get("summary") or {}
+    evidence = {}
+    for f in dict.fromkeys(dataset.get("evidence_files") or []):
+        kind = str(f).split(":", 1)[0]
+        evidence[kind] = evidence.get(kind, 0) + 1
+    rest = {k: v for k, v in dataset.items() if k not in ("invoices", "evidence_files")}
+
+    for level, (recent, n_anomalies, max_chars, max_items) in enumerate(_COMPACT_LEVELS):
+        compact = _trim_value(rest, max_chars, max_items)
+        compact["evidence_counts"] = dict(sorted(evidence.items()))
+        compact["invoices"] = _trim_value(_round_sig({
+            "metrics": summary.get("metrics"), "period": summary.get("period"), "notes": summary.get("notes"),
+            "monthly": _monthly_digest(summary.get("monthly_series") or [], recent, n_anomalies),
+        }), max_chars, max(max_items, recent, 12))
+        compact = _round_sig(compact)
+        tokens = estimate_tokens(json.dumps(compact, ensure_ascii=False, sort_keys=True, default=str))
+        if tokens <= budget:
+            break
+    return compact, {"tokens": tokens, "tokens_full": full_tokens, "budget": budget,
+                     "level": level, "fits": tokens <= budget}
+
+# ========================= OPENAI (reporte y OCR/parse) =========================
+
+def _openai_client():
+    from openai import OpenAI
+    api_key = os.getenv("OPENAI_API_KEY")
+    if not api_key:
+        raise RuntimeError("Falta OPENAI_API_KEY en Secrets/entorno.")
+    return OpenAI(api_key=api_key)
+
+_REPORT_DEPTH = {
+    1: "Resumen ejecutivo muy sintético, no exceder 300 palabras.",
+    2: "Resumen breve + hallazgos clave (≈500 palabras).",
+    3: "Informe estándar con secciones completas y cifras básicas (≈900 palabras).",
+    4: "Informe amplio con justificación técnica y tablas en texto (≈1400 palabras).",
+    5: "Informe técnico exhaustivo, supuestos, riesgos, fórmulas simples y M&V detallada (≈2000 palabras)."
+}
+
+_REPORT_SYSTEM_PROMPT = (
+    "Eres consultor sénior en gestión de la energía bajo ISO 50001. "
+    "Redacta un informe institucional en español con tono profesional y claro. "
+    "DEBES usar los valores de línea de base y EnPIs provistos en dataset.derived "
+    "(kWh/año equivalente, $/kWh, kWh/m²·año, kWh/usuario·año) como referencia numérica. "
+    "Cita explícitamente la línea de base con su período (dataset.derived.baseline.period_start → period_end) "
+    "y construye EnPIs a partir de esos valores. Si existe dataset.derived.regression, describe el modelo "
+    "(coeficientes, R², CV(RMSE)) y usa los EnPIs normalizados por clima para M&V. "
+    "Si faltan, indícalo como limitación de datos. "
+    "Incluye estas secciones (con encabezados explícitos): "
+    "Resumen Ejecutivo; Alcance y Contexto; Revisión Energética; "
+    "Línea de Base y EnPIs; Oportunidades y Medidas; "
+    "Estimación de Ahorros (kWh/año, %, costo, payback simple); "
+    "Plan de Implementación; Monitoreo y Verificación (M&V); "
+    "Riesgos y Recomendaciones."
+)
+
+def _em_report_messages(dataset: dict, detail_level: int = 3, token_budget: int | None = None) -> list[dict]:
+    """Mensajes del reporte; el dataset va compactado (compact_report_dataset) salvo con `token_budget=0`."""
+    guidance = _REPORT_DEPTH.get(int(detail_level), _REPORT_DEPTH[3])
+    if token_budget != 0:
+        dataset, info = compact_report_dataset(dataset, token_budget)
+        trace_count("report.prompt_tokens", info["tokens"])
+    user = (
+        f"PARÁMETROS DE REDACCIÓN: {guidance}\n\n"
+        f"DATOS (JSON):\n{json.dumps(dataset, ensure_ascii=False)}"
+    )
+    return [{"role": "system", "content": _REPORT_SYSTEM_PROMPT}, {"role": "user", "content": user}]
+
+def _em_report_error_text(e: Exception) -> str:
+    return (f"AVISO: No fue posible llamar a OpenAI ({e}). "
+            "Revisá el modelo, la versión del SDK y la clave.")
+
+@traced("report.llm")
+def _em_openai_report(dataset: dict, brand_color: str, logo_url: str,
+                      model: str = "gpt-4o-mini", detail_level: int = 3,
+                      temperature: float = 0.2, client=None, token_budget: int | None = None) -> str:
+    try:
+        client = client or _openai_client()
+        out = client.chat.completions.create(
+            model=model,
+            temperature=float(temperature),
+            messages=_em_report_messages(dataset, detail_level, token_budget),
+        )
+        return out.choices[0].message.content
+    except Exception as e:
+        diagnose("report.llm_failed", _em_report_error_text(e), model=model)
+        return _em_report_error_text(e)
+
+def _em_openai_report_stream(dataset: dict, model: str = "gpt-4o-mini", detail_level: int = 3,
+                             temperature: float = 0.2, client=None, token_budget: int | None = None):
+    """
+    Igual que _em_openai_report pero con `stream=True`: genera los fragmentos de texto a
+    medida que llegan. Un error (también a mitad del stream) se devuelve como texto de AVISO.
+    """
+    sent = False
+    try:
+        client = client or _openai_client()
+        stream = client.chat.completions.create(
+            model=model,
+            temperature=float(temperature),
+            messages=_em_report_messages(dataset, detail_level, token_budget),
+            stream=True,
+        )
+        for chunk in stream:
+            delta = chunk.choices[0].delta.content if chunk.choices else None
+            if delta:
+                sent = True
+                yield delta
+    except Exception as e:
+        diagnose("report.llm_failed", _em_report_error_text(e), model=model)
+        yield ("\n\n" if sent else "") + _em_report_error_text(e)
+
+def _em_build_report(dataset: dict, llm_text: str, brand_color: str, logo_url: str,
+                     generated_at: str | None = None, with_pdf: bool = True, parsed=None) -> dict:
+    """
+    HTML de pantalla, HTML A4 y PDF (None si xhtml2pdf no está) a partir del texto del reporte.
+    El texto se parsea una sola vez (o llega ya parseado en `parsed`, de
+    ReportStreamRenderer.finish) y los dos HTML salen del mismo ReportDoc.
+    """
+    site = dataset.get("site") or {}
+    kw = dict(org=site.get("organization", ""), site=site.get("site_name", ""),
+              generated_at=generated_at or pd.Timestamp.now().strftime("%Y-%m-%d %H:%M"),
+              llm_text=llm_text, brand_color=brand_color, logo_url=logo_url,
+              parsed=parsed or parse_report_text(llm_text))
+    with trace_span("report.render"):
+        html = _em_render_report_html(**kw)
+        pdf_html = _em_render_report_pdf_html(**kw)
+    with trace_span("report.pdf"):
+        pdf_bytes = _em_html_to_pdf_bytes(pdf_html) if with_pdf else None
+    return {"text": llm_text, "html": html, "pdf_html": pdf_html, "pdf_bytes": pdf_bytes,
+            "generated_at": kw["generated_at"]}
+
+# --------- REPORTE CONSOLIDADO (VARIOS SITIOS) ---------
+
+def _xhtml2pdf_available() -> bool:
+    import importlib.util
+    return importlib.util.find_spec("xhtml2pdf") is not None
+
+def _batch_site_render(item: dict, generated_at: str, brand_color: str, logo_url: str, with_pdf: bool) -> dict:
+    """Worker: texto de un sitio → sección del consolidado, su HTML A4 y (si se pide) su PDF."""
+    doc = parse_report_text(item["text"], anchor_prefix=item["anchor"] + "-")
+    section = _report_section(item["org"], item["site"], doc, item["anchor"])
+    pdf_html = _report_templates()["report.html"].render(
+        s=section, generated_at=generated_at, logo_url=logo_url, brand=brand_color)
+    pdf_bytes = _em_html_to_pdf_bytes(pdf_html) if with_pdf else None
+    return {"section": section, "pdf_html": pdf_html, "pdf_bytes": pdf_bytes,
+            "pages": _pdf_page_count(pdf_bytes) if pdf_bytes else 0}
+
+def _merge_pdfs(parts: list) -> bytes | None:
+    """Une PDFs con pypdfium2 (None si no está instalado)."""
+    try:
+        import pypdfium2 as pdfium
+    except ImportError:
+        return None
+    out = pdfium.PdfDocument.new()
+    try:
+        for data in parts:
+            src = pdfium.PdfDocument(data)
+            try:
+                out.import_pages(src)
+            finally:
+                src.close()
+        buf = BytesIO()
+        out.save(buf)
+        return buf.getvalue()
+    finally:
+        out.close()
+
+@traced("report.batch")
+def build_batch_report(items: list, brand_color: str = "#0B8C6B", logo_url: str = "", title: str = "",
+                       generated_at: str | None = None, with_pdf: bool = True,
+                       max_workers: int | None = None) -> dict:
+    """
+    Reporte consolidado de varios sitios a partir de [(dataset, texto del reporte)]: las
+    plantillas se compilan una vez, cada sitio se parsea y renderiza por separado (con PDF,
+    en el pool de procesos: xhtml2pdf es lo caro) y después se arma:
+
+    - pdf_html: HTML A4 único con portada, índice global (enlaces a cada sitio) y los sitios.
+    - pdf_bytes: PDF combinado = portada + índice global con la página de inicio de cada
+      sitio + los PDF por sitio unidos con pypdfium2 (sin pypdfium2, pdf_html por xhtml2pdf).
+      None si xhtml2pdf no está.
+    - zip_bytes: un PDF por sitio (o su HTML A4 para imprimir si no hay PDF).
+    - sites: [{site, org, file, pages, start_page}].
+    """
+    import zipfile
+    generated_at = generated_at or pd.Timestamp.now().strftime("%Y-%m-%d %H:%M")
+    brand = brand_color or "#0B8C6B"
+    with_pdf = with_pdf and _xhtml2pdf_available()
+    jobs, used = [], {}
+    for dataset, text in items:
+        meta = dataset.get("site") or {}
+        site = meta.get("site_name") or "Site"
+        slug = _slugify(site)
+        n = used[slug] = used.get(slug, 0) + 1
+        key = slug if n == 1 else f"{slug}-{n}"
+        jobs.append({"site": site, "org": meta.get("organization", ""), "anchor": f"site-{key}",
+                     "file": f"energy_report_{key}", "text": text or ""})
+
+    workers = min(max_workers or os.cpu_count() or 1, len(jobs))
+    args = ([generated_at] * len(jobs), [brand] * len(jobs), [logo_url] * len(jobs), [with_pdf] * len(jobs))
+    with trace_span("report.batch.sites"):
+        if with_pdf and workers > 1:
+            # pool de procesos compartido (sin redimensionarlo); cada worker compila las plantillas una vez
+            results = _pool_map(_batch_site_render, jobs, *args, max_workers=workers)
+        else:
+            results = list(map(_batch_site_render, jobs, *args))
+
+    sites = [{"site": j["site"], "org": j["org"], "file": j["file"] + (".pdf" if r["pdf_bytes"] else ".html"),
+              "pages": r["pages"], "start_page": None} for j, r in zip(jobs, results)]
+    batch = _report_templates()["batch.html"]
+    ctx = {"title": title or f"Portfolio · {len(jobs)} sitios", "generated_at": generated_at,
+           "logo_url": logo_url, "brand": brand}
+    with trace_span("report.batch.html"):
+        pdf_html = batch.render(sites=[r["section"] for r in results], sections=True, **ctx)
+
+    pdf_bytes = None
+    if with_pdf and all(r["pdf_bytes"] for r in results):
+        with trace_span("report.batch.pdf"):
+            # índice con números de página: se re-renderiza si cambia su propia cantidad de páginas
+            head_pages, head = 0, None
+            for _ in range(3):
+                start = head_pages + 1
+                for s in sites:
+                    s["start_page"] = start
+                    start += s["pages"]
+                toc = [{**r["section"], "start_page": s["start_page"]} for r, s in zip(results, sites)]
+                head = _em_html_to_pdf_bytes(batch.render(sites=toc, sections=False, **ctx))
+                pages = _pdf_page_count(head) if head else 0
+                if pages == head_pages or not head:
+                    break
+                head_pages = pages
+            pdf_bytes = _merge_pdfs([head] + [r["pdf_bytes"] for r in results]) if head else None
+        if pdf_bytes is None:
+            for s in sites:
+                s["start_page"] = None
+            pdf_bytes = _em_html_to_pdf_bytes(pdf_html)
+
+    with trace_span("report.batch.zip"):
+        buf = BytesIO()
+        with zipfile.ZipFile(buf, "w", zipfile.ZIP_DEFLATED) as zf:
+            for s, r in zip(sites, results):
+                zf.writestr(s["file"], r["pdf_bytes"] or r["pdf_html"].encode("utf-8"))
+    return {"pdf_html": pdf_html, "pdf_bytes": pdf_bytes, "zip_bytes": buf.getvalue(), "sites": sites,
+            "generated_at": generated_at}
+
+# --------- REPORTES EN SEGUNDO PLANO (COLA DE JOBS) ---------
+
+class ReportJob:
+    """
+    Un reporte generándose en un hilo: estado (queued → running → done / error / cancelled),
+    texto parcial que crece a medida que llega el stream del modelo (ya convertido a HTML línea
+    por línea) y, al terminar, el resultado de _em_build_report. Se lee desde la UI sin
+    bloquear (polling).
+    """
+
+    def __init__(self, job_id: str, site: str, params: dict, page: dict | None = None):
+        self.id = job_id
+        self.site = site
+        self.params = params
+        self.page = page or {}  # org, site, brand_color, logo_url para la vista previa
+        self.prompt = {}  # estimación de tokens del dataset enviado (compact_report_dataset)
+        self.cache_key = None
+        self.force = False
+        self.cached = False
+        self.diagnostics = []
+        self.status = "queued"
+        self.error = None
+        self.result = None
+        self.created_at = time.time()
+        self.started_at = None
+        self.first_content_at = None
+        self.finished_at = None
+        self._renderer = ReportStreamRenderer()
+        self._lock = threading.Lock()
+        self._cancel = threading.Event()
+
+    def append(self, delta: str):
+        with self._lock:
+            if self.first_content_at is None:
+                self.first_content_at = time.time()
+            self._renderer.feed(delta)
+
+    @property
+    def text(self) -> str:
+        with self._lock:
+            return self._renderer.text
+
+    def preview_html(self) -> str:
+        with self._lock:
+            return self._renderer.preview_html()
+
+    def preview_page(self) -> str:
+        """Reporte de pantalla con lo recibido hasta ahora (vista previa en vivo)."""
+        generated_at = pd.Timestamp.fromtimestamp(self.created_at).strftime("%Y-%m-%d %H:%M")
+        return _em_render_report_html(llm_text="", generated_at=generated_at,
+                                      body_html=self.preview_html(), **self.page)
+
+    @property
+    def first_content_s(self) -> float | None:
+        """Segundos hasta el primer fragmento del modelo (tiempo hasta ver contenido)."""
+        if self.first_content_at is None or self.started_at is None:
+            return None
+        return self.first_content_at - self.started_at
+
+    @property
+    def done(self) -> bool:
+        return self.status in ("done", "error", "cancelled")
+
+    @property
+    def elapsed_s(self) -> float:
+        if self.started_at is None:
+            return 0.0
+        return (self.finished_at or time.time()) - self.started_at
+
+    def cancel(self):
+        self._cancel.set()
+
+    def to_dict(self) -> dict:
+        return {"id": self.id, "site": self.site, "status": self.status, "error": self.error,
+                "elapsed_s": self.elapsed_s, "first_content_s": self.first_content_s,
+                "chars": len(self.text), "cached": self.cached, "prompt_tokens": self.prompt.get("tokens"),
+                **self.params}
+
+class ReportJobQueue:
+    """
+    Registro local de jobs de reporte con un pool de hilos acotado (la llamada al modelo es
+    I/O): submit() devuelve el id al instante y el texto parcial queda disponible en el job.
+    Se guardan como mucho `max_jobs` jobs; los terminados más viejos se descartan primero.
+    `client` permite usar un stub local en lugar de OpenAI. Con `cache` (ReportCache) un
+    reporte ya generado para el mismo dataset y parámetros sale de disco sin llamar al modelo,
+    salvo que se pida `force=True`. El dataset se compacta una sola vez al encolar (el modelo
+    recibe el resumen, el render usa el dataset completo) y la clave de caché sale del resumen.
+    """
+
+    def __init__(self, max_workers: int = 4, max_jobs: int = 200, client=None, cache: "ReportCache | None" = None):
+        self.max_workers = max_workers
+        self.max_jobs = max_jobs
+        self.client = client
+        self.cache = cache
+        self._jobs = {}
+        self._lock = threading.Lock()
+        self._pool = None
+
+    def submit(self, dataset: dict, model: str = "gpt-4o-mini", detail_level: int = 3,
+               temperature: float = 0.2, brand_color: str = "#0B8C6B", logo_url: str = "",
+               with_pdf: bool = True, client=None, force: bool = False,
+               token_budget: int | None = None) -> str:
+        import uuid
+        from concurrent.futures import ThreadPoolExecutor
+        meta = dataset.get("site") or {}
+        site = meta.get("site_name") or "Site"
+        job = ReportJob(uuid.uuid4().hex[:12], site, {
+            "model": model, "detail_level": int(detail_level), "temperature": float(temperature),
+        }, page={"org": meta.get("organization", ""), "site": site,
+                 "brand_color": brand_color, "logo_url": logo_url})
+        render = {"brand_color": brand_color, "logo_url": logo_url, "with_pdf": with_pdf}
+        if token_budget == 0:
+            prompt = dataset
+            job.prompt = {"tokens": estimate_tokens(json.dumps(dataset, ensure_ascii=False, default=str))}
+        else:
+            prompt, job.prompt = compact_report_dataset(dataset, token_budget)
+        if self.cache is not None:
+            job.cache_key = self.cache.report_key(prompt, model, detail_level, temperature)
+            job.force = bool(force)
+        with self._lock:
+            if self._pool is None:
+                self._pool = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="greenscore-report")
+            self._jobs[job.id] = job
+            self._prune()
+            self._pool.submit(self._run, job, dataset, prompt, render, client or self.client)
+        return job.id
+
+    def get(self, job_id: str) -> ReportJob | None:
+        return self._jobs.get(job_id)
+
+    def jobs(self, ids=None) -> list[ReportJob]:
+        with self._lock:
+            jobs = list(self._jobs.values())
+        return jobs if ids is None else [j for j in jobs if j.id in set(ids)]
+
+    def cancel(self, job_id: str) -> bool:
+        job = self._jobs.get(job_id)
+        if job is None or job.done:
+            return False
+        job.cancel()
+        return True
+
+    def _prune(self):
+        extra = len(self._jobs) - self.max_jobs
+        if extra > 0:
+            old = sorted((j for j in self._jobs.values() if j.done), key=lambda j: j.created_at)[:extra]
+            for j in old:
+                del self._jobs[j.id]
+
+    def _run(self, job: ReportJob, dataset: dict, prompt: dict, render: dict, client):
+        if job._cancel.is_set():
+            job.status = "cancelled"
+            return
+        job.status = "running"
+        job.started_at = time.time()
+        try:
+            text = self.cache.get(job.cache_key) if job.cache_key and not job.force else None
+            if text is not None:
+                job.cached = True
+                job.append(text)
+            else:
+                with collecting_diagnostics() as diags:
+                    for delta in _em_openai_report_stream(prompt, client=client, token_budget=0, **job.params):
+                        if job._cancel.is_set():
+                            job.status = "cancelled"
+                            return
+                        job.append(delta)
+                job.diagnostics = diags.items
+                if job.cache_key and not diags.items:
+                    self.cache.put(job.cache_key, job.text, {"site": job.site, **job.params})
+            with job._lock:
+                parsed = job._renderer.finish()
+            job.result = _em_build_report(dataset, job.text, parsed=parsed, **render)
+            job.status = "done"
+        except Exception as e:
+            job.error = str(e)
+            job.status = "error"
+        finally:
+            job.finished_at = time.time()
+
+_REPORT_QUEUE = None
+
+def report_queue() -> ReportJobQueue:
+    """Cola de reportes del proceso (compartida entre reruns, con report_cache()); $GREENSCORE_REPORT_WORKERS hilos."""
+    global _REPORT_QUEUE
+    if _REPORT_QUEUE is None:
+        _REPORT_QUEUE = ReportJobQueue(max_workers=int(os.getenv("GREENSCORE_REPORT_WORKERS", "4")),
+                                       cache=report_cache())
+    return _REPORT_QUEUE
+
+# --------- CACHE DE OCR / PARSE (por contenido) ---------
+
+_OCR_PROMPT = (
+    "Extrae datos de la factura de energía. Devuelve JSON con la clave 'rows' (lista). "
+    "Cada elemento debe tener: year_month (YYYY-MM), kwh (número), cost (número), "
+    "demand_kw (número o null), currency (texto breve, p.ej. ARS/USD). "
+    "Si ves varias facturas o meses en la imagen, devolvé varias filas. "
+    "No incluyas comentarios fuera del JSON."
+)
+_TEXT_PARSE_INSTRUCTION = (
+    "A partir del texto de una factura(s) de energía, devolvé JSON válido con una lista 'rows' "
+    "de registros mensuales: year_month (YYYY-MM), kwh (número), cost (número), "
+    "demand_kw (número o null), currency (texto). No incluyas comentarios fuera del JSON."
+)
+# subir la versión si cambia el post-proceso de las filas (el texto del prompt ya entra en la clave)
+INVOICE_PARSE_PROMPT_VERSION = "v1"
+
+class InvoiceParseCache:
+    """
+    Cache en disco de filas de facturas ya interpretadas por el modelo (OCR o texto).
+    Clave = sha256(tipo, modelo, versión/prompt, bytes de la imagen preprocesada o texto).
+    Un archivo JSON por entrada; se guarda la lista `rows` tal como la devolvió el modelo,
+    así `_source` siempre refleja el nombre del archivo actual. Se expulsa por tamaño total
+    (LRU según mtime, que se actualiza en cada acierto).
+    """
+
+    def __init__(self, root: Path, max_bytes: int = 200 * 1024 * 1024):
+        self.root = Path(root)
+        self.max_bytes = int(max_bytes)
+        self.hits = self.misses = 0
+
+    @staticmethod
+    def key(kind: str, payload: bytes, model: str, prompt: str) -> str:
+        h = hashlib.sha256()
+        for part in (kind, model, INVOICE_PARSE_PROMPT_VERSION, prompt):
+            h.update(part.encode("utf-8")); h.update(b"\0")
+        h.update(payload)
+        return h.hexdigest()
+
+    def _path(self, key: str) -> Path:
+        return self.root / key[:2] / f"{key}.json"
+
+    def get(self, key: str):
+        p = self._path(key)
+        try:
+            entry = json.loads(p.read_text(encoding="utf-8"))
+            os.utime(p)  # marca de uso para LRU
+        except (OSError, ValueError):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return entry.get("rows")
+
+    def put(self, key: str, rows: list, meta: dict | None = None):
+        p = self._path(key)
+        try:
+            p.parent.mkdir(parents=True, exist_ok=True)
+            tmp = p.with_suffix(f".{os.getpid()}.{threading.get_ident()}.tmp")
+            tmp.write_text(json.dumps({"rows": rows, "meta": meta or {}}, ensure_ascii=False), encoding="utf-8")
+            os.replace(tmp, p)
+            self.evict()
+        except OSError:
+            pass
+
+    def _files(self):
+        out = []
+        for p in self.root.glob("*/*.json"):
+            try:
+                stt = p.stat()
+            except OSError:
+                continue
+            out.append((p, stt.st_size, stt.st_mtime))
+        return out
+
+    def evict(self):
+        files = self._files()
+        total = sum(sz for _, sz, _ in files)
+        if total <= self.max_bytes:
+            return
+        for p, sz, _ in sorted(files, key=lambda f: f[2]):
+            try:
+                p.unlink()
+            except OSError:
+                continue
+            total -= sz
+            if total <= self.max_bytes:
+                break
+
+    def stats(self) -> dict:
+        files = self._files()
+        return {"entries": len(files), "bytes": sum(sz for _, sz, _ in files),
+                "max_bytes": self.max_bytes, "hits": self.hits, "misses": self.misses}
+
+    def entries(self) -> pd.DataFrame:
+        """Listado para inspección: clave, tipo, archivo de origen, modelo, filas, tamaño, último uso."""
+        recs = []
+        for p, sz, mt in self._files():
+            try:
+                entry = json.loads(p.read_text(encoding="utf-8"))
+            except (OSError, ValueError):
+                continue
+            meta = entry.get("meta", {})
+            recs.append({"key": p.stem, "kind": meta.get("kind"), "filename": meta.get("filename"),
+                         "model": meta.get("model"), "rows": len(entry.get("rows") or []),
+                         "bytes": sz, "last_used": pd.Timestamp(mt, unit="s")})
+        return pd.DataFrame(recs).sort_values("last_used", ascending=False) if recs else pd.DataFrame(recs)
+
+    def clear(self):
+        for p, _, _ in self._files():
+            try:
+                p.unlink()
+            except OSError:
+                pass
+        self.hits = self.misses = 0
+
+_INVOICE_CACHE = None
+
+def invoice_parse_cache() -> InvoiceParseCache:
+    """Cache de proceso; ubicación en $GREENSCORE_CACHE_DIR (por defecto .cache/)."""
+    global _INVOICE_CACHE
+    if _INVOICE_CACHE is None:
+        root = Path(os.getenv("GREENSCORE_CACHE_DIR", ".cache")) / "invoice_parse"
+        _INVOICE_CACHE = InvoiceParseCache(root)
+    return _INVOICE_CACHE
+
+# --------- CACHE DE REPORTES (por dataset y parámetros) ---------
+
+class ReportCache(InvoiceParseCache):
+    """
+    Cache en disco del texto de reportes ya generados. Clave = sha256 del dataset canónico
+    (JSON con claves ordenadas) + modelo, nivel de detalle, temperatura y prompt. Se guarda
+    solo el texto: HTML y PDF se vuelven a armar al instante con el color y el logo actuales.
+    Las entradas vencen a los `ttl_s` segundos y se expulsan por tamaño total (LRU).
+    """
+
+    def __init__(self, root: Path, max_bytes: int = 50 * 1024 * 1024, ttl_s: float = 30 * 86400):
+        super().__init__(root, max_bytes)
+        self.ttl_s = float(ttl_s)
+
+    @staticmethod
+    def fingerprint(dataset: dict) -> str:
+        canon = json.dumps(dataset, sort_keys=True, ensure_ascii=False, separators=(",", ":"), default=str)
+        return hashlib.sha256(canon.encode("utf-8")).hexdigest()
+
+    @classmethod
+    def report_key(cls, dataset: dict, model: str, detail_level: int, temperature: float) -> str:
+        h = hashlib.sha256()
+        for part in (cls.fingerprint(dataset), model, str(int(detail_level)), f"{float(temperature):.2f}",
+                     _REPORT_SYSTEM_PROMPT, _REPORT_DEPTH.get(int(detail_level), "")):
+            h.update(part.encode("utf-8")); h.update(b"\0")
+        return h.hexdigest()
+
+    def get(self, key: str):
+        p = self._path(key)
+        try:
+            entry = json.loads(p.read_text(encoding="utf-8"))
+            if time.time() - float(entry.get("created_at", 0)) > self.ttl_s:
+                p.unlink()
+                raise ValueError("vencida")
+            os.utime(p)
+        except (OSError, ValueError):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return entry.get("text")
+
+    def put(self, key: str, text: str, meta: dict | None = None):
+        p = self._path(key)
+        try:
+            p.parent.mkdir(parents=True, exist_ok=True)
+            tmp = p.with_suffix(f".{os.getpid()}.{threading.get_ident()}.tmp")
+            tmp.write_text(json.dumps({"text": text, "created_at": time.time(), "meta": meta or {}},
+                                      ensure_ascii=False), encoding="utf-8")
+            os.replace(tmp, p)
+            self.evict()
+        except OSError:
+            pass
+
+    def entries(self) -> pd.DataFrame:
+        recs = []
+        for p, sz, mt in self._files():
+            try:
+                entry = json.loads(p.read_text(encoding="utf-8"))
+            except (OSError, ValueError):
+                continue
+            meta = entry.get("meta", {})
+            recs.append({"key": p.stem, "site": meta.get("site"), "model": meta.get("model"),
+                         "detail_level": meta.get("detail_level"), "temperature": meta.get("temperature"),
+                         "chars": len(entry.get("text") or ""), "bytes": sz,
+                         "created_at": pd.Timestamp(entry.get("created_at", 0), unit="s"),
+                         "last_used": pd.Timestamp(mt, unit="s")})
+        return pd.DataFrame(recs).sort_values("last_used", ascending=False) if recs else pd.DataFrame(recs)
+
+_REPORT_CACHE = None
+
+def report_cache() -> ReportCache:
+    """Cache de reportes del proceso en $GREENSCORE_CACHE_DIR/report (TTL en $GREENSCORE_REPORT_TTL_DAYS)."""
+    global _REPORT_CACHE
+    if _REPORT_CACHE is None:
+        root = Path(os.getenv("GREENSCORE_CACHE_DIR", ".cache")) / "report"
+        _REPORT_CACHE = ReportCache(root, ttl_s=float(os.getenv("GREENSCORE_REPORT_TTL_DAYS", "30")) * 86400)
+    return _REPORT_CACHE
+
+# --------- OCR IMAGEN (ROBUSTO) ---------
+
+def _ocr_preprocess_image(img) -> bytes:
+    """
+    Resize<=1200px, grises, autocontraste y umbral suave → PNG.
+    `img` puede ser bytes de imagen o una PIL.Image (p.ej. una página ya rasterizada en
+    grises al tamaño final por _iter_pdf_pages, que así no se decodifica de nuevo).
+    """
+    from PIL import Image, ImageOps
+    with (Image.open(BytesIO(img)) if isinstance(img, (bytes, bytearray)) else img) as im:
+        im = im.convert("L")
+        max_side = 1200
+        w, h = im.size
+        scale = min(max_side / max(w, h), 1.0)
+        if scale < 1.0:
+            im = im.resize((int(w*scale), int(h*scale)), Image.LANCZOS)
+        im = ImageOps.autocontrast(im)
+        # umbral suave: mejora contraste pero evita blanco/negro agresivo
+        im = ImageOps.invert(ImageOps.invert(im).point(lambda p: 255 if p > 200 else (0 if p < 30 else p)))
+        buf = BytesIO()
+        im.save(buf, format="PNG", optimize=True)
+        return buf.getvalue()
+
+def _llm_rows_to_df(rows: list, filename: str, parse_path: str = "llm") -> pd.DataFrame:
+    """
+    Filas JSON del modelo (year_month, kwh, cost, demand_kw, currency) → columnas normalizadas.
+    `parse_path` queda en `_parse_path` para saber qué camino produjo cada fila.
+    """
+    recs = []
+    for r in rows:
+        ym = str(r.get("year_month") or "").strip()
+        dt = pd.to_datetime(ym + "-01", errors="coerce")
+        recs.append({
+            "_year_month": dt if pd.notna(dt) else pd.NaT,
+            "_kwh": float(r.get("kwh") or 0),
+            "_cost": float(r.get("cost") or 0),
+            "_demand_kw": float(r.get("demand_kw")) if r.get("demand_kw") not in (None, "") else None,
+            "_currency": (str(r.get("currency") or "").strip() or None),
+            "_source": filename,
+            "_parse_path": parse_path
+        })
+    return pd.DataFrame(recs)
+
+@traced("ocr.image")
+def _ocr_image_invoice_rows(file_bytes: bytes, filename: str, model: str = "gpt-4o-mini",
+                            client=None, timeout: float | None = None, use_cache: bool = True):
+    """
+    Núcleo del OCR sin llamadas a Streamlit (apto para hilos de trabajo).
+    Devuelve (DataFrame, aviso | None). `client` permite inyectar un cliente compatible
+    con OpenAI (p.ej. un stub local); `timeout` se aplica a cada request.
+    Con `use_cache`, una imagen ya interpretada (mismo preprocesado/modelo/prompt) no llama a la API.
+    """
+    import base64
+
+    with trace_span("ocr.preprocess", file=filename):
+        pre = _ocr_preprocess_image(file_bytes)
+    cache = invoice_parse_cache() if use_cache else None
+    ckey = InvoiceParseCache.key("ocr", pre, model, _OCR_PROMPT) if cache else None
+    if cache:
+        rows = cache.get(ckey)
+        if rows:
+            trace_count("cache.hits")
+            return _llm_rows_to_df(rows, filename, "ocr_cache"), None
+
+    if client is None:
+        try:
+            client = _openai_client()
+        except Exception as e:
+            return pd.DataFrame(), f"OCR no disponible: {e}"
+
+    b64 = base64.b64encode(pre).decode("utf-8")
+    image_url = f"data:image/png;base64,{b64}"
+
+    prompt = _OCR_PROMPT
+    extra = {"timeout": timeout} if timeout else {}
+
+    delays = [0.5, 1.0, 2.0]
+    last_raw = ""
+    for attempt, delay in enumerate([0.0] + delays):
+        if delay:
+            time.sleep(delay)
+            trace_count("api.retries")
+        trace_count("api.calls")
+        trace_count("api.bytes_sent", len(image_url) + len(prompt))
+        try:
+            with trace_span("ocr.attempt", file=filename, attempt=attempt):
+                out = client.chat.completions.create(
+                    model=model,
+                    temperature=0.0,
+                    response_format={"type": "json_object"},
+                    messages=[
+                        {"role": "system", "content": "Sos un extractor de datos que siempre responde JSON válido."},
+                        {"role": "user", "content": [
+                            {"type": "text", "text": prompt},
+                            {"type": "image_url", "image_url": {"url": image_url}}
+                        ]}
+                    ],
+                    **extra
+                )
+            raw = out.choices[0].message.content or "{}"
+            last_raw = raw
+            data = json.loads(raw)
+            df = _llm_rows_to_df(data.get("rows", []), filename, "ocr")
+            if not df.empty:
+                if cache:
+                    cache.put(ckey, data.get("rows", []), {"kind": "ocr", "filename": filename, "model": model})
+                return df, None
+        except Exception:
+            continue
+
+    try:
+        Path("/tmp/last_ocr_raw.json").write_text(last_raw, encoding="utf-8")
+    except Exception:
+        pass
+    return pd.DataFrame(), f"No se pudo OCR {filename}: respuesta no JSON. Se guardó /tmp/last_ocr_raw.json para depurar."
+
+def _ocr_image_invoice_with_openai(file_bytes: bytes, filename: str, model: str = "gpt-4o-mini"):
+    """
+    OCR de una imagen (PNG/JPG) con OpenAI Vision → filas mensuales.
+    Preprocesa (resize<=1200px, grises, contraste/umbral), fuerza JSON estricto y hace retries.
+    Guarda /tmp/last_ocr_raw.json si falla el parseo.
+    """
+    df, warn = _ocr_image_invoice_rows(file_bytes, filename, model=model)
+    if warn:
+        diagnose("ocr.failed", warn, file=filename)
+    return df
+
+@traced("ocr.pipeline")
+def run_ocr_pipeline(jobs, model: str = "gpt-4o-mini", max_concurrency: int = 4,
+                     timeout: float | None = 60.0, client=None, progress=None, total: int | None = None):
+    """
+    OCR en paralelo con concurrencia acotada. `jobs` es un iterable (puede ser un generador)
+    de (imagen, nombre) en el orden deseado (archivo y página); la imagen puede ser bytes
+    o una PIL.Image ya rasterizada. Los jobs se consumen de a poco (como mucho
+    2×concurrencia en vuelo), así un PDF largo no se materializa entero en memoria.
+    `progress(hechos, total | None, nombre)` se invoca desde el hilo que llama (seguro para Streamlit).
+    Devuelve (lista de DataFrames en el orden de `jobs`, lista de avisos).
+    """
+    from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+    if total is None and hasattr(jobs, "__len__"):
+        total = len(jobs)
+    it = iter(jobs)
+    first = next(it, None)
+    if first is None:
+        return [], []
+    if client is None:
+        try:
+            client = _openai_client()  # un solo cliente (thread-safe) para todos los hilos
+        except Exception:
+            client = None  # los aciertos de cache igual se resuelven; el resto avisa
+
+    results, warnings, names = [], [], []
+    max_workers = max(1, int(max_concurrency))
+    pending = {}
+    done = 0
+    with ThreadPoolExecutor(max_workers=max_workers) as ex:
+        def submit(job):
+            img, name = job[0], job[1]
+            i = len(results)
+            results.append(pd.DataFrame()); warnings.append(None); names.append(name)
+            # copy_context: los spans de los hilos van a la traza activa del que llama
+            pending[ex.submit(contextvars.copy_context().run, _ocr_image_invoice_rows,
+                              img, name, model, client, timeout)] = i
+
+        submit(first)
+        exhausted = False
+        while pending:
+            while not exhausted and len(pending) < 2 * max_workers:
+                job = next(it, None)
+                if job is None:
+                    exhausted = True
+                else:
+                    submit(job)
+            finished, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for fut in finished:
+                i = pending.pop(fut)
+                try:
+                    results[i], warnings[i] = fut.result()
+                except Exception as e:
+                    warnings[i] = f"No se pudo OCR {names[i]}: {e}"
+                done += 1
+                if progress:
+                    progress(done, total, names[i])
+    return results, list(dict.fromkeys(w for w in warnings if w))
+
+@traced("llm.parse_text")
+def _parse_invoice_text_blocks_with_llm(raw_text: str, filename: str, model: str = "gpt-4o-mini") -> pd.DataFrame:
+    """
+    Convierte texto crudo (PDF con texto) a filas mensuales. JSON estricto + retries.
+    """
+    if not (raw_text or "").strip():
+        return pd.DataFrame()
+    text = raw_text[:16000]  # trunc seguridad
+    cache = invoice_parse_cache()
+    ckey = InvoiceParseCache.key("text", text.encode("utf-8"), model, _TEXT_PARSE_INSTRUCTION)
+    rows = cache.get(ckey)
+    if rows:
+        trace_count("cache.hits")
+        return _llm_rows_to_df(rows, filename, "llm_cache")
+
+    try:
+        client = _openai_client()
+    except Exception as e:
+        diagnose("llm.disabled", f"Parser LLM deshabilitado: {e}", file=filename)
+        return pd.DataFrame()
+
+    instruction = _TEXT_PARSE_INSTRUCTION
+
+    delays = [0.5, 1.0, 2.0]
+    last_raw = ""
+    for attempt, delay in enumerate([0.0] + delays):
+        if delay:
+            time.sleep(delay)
+            trace_count("api.retries")
+        trace_count("api.calls")
+        trace_count("api.bytes_sent", len(instruction) + len(text.encode("utf-8")))
+        try:
+            with trace_span("llm.attempt", file=filename, attempt=attempt):
+                out = client.chat.completions.create(
+                    model=model,
+                    temperature=0.0,
+                    response_format={"type": "json_object"},
+                    messages=[
+                        {"role": "system", "content": "Sos un extractor de datos de facturas que siempre responde JSON válido."},
+                        {"role": "user", "content": f"{instruction}\n\nTEXTO (truncado):\n{text}"}
+                    ]
+                )
+            raw = out.choices[0].message.content or "{}"
+            last_raw = raw
+            data = json.loads(raw)
+            df = _llm_rows_to_df(data.get("rows", []), filename, "llm")
+            if not df.empty:
+                cache.put(ckey, data.get("rows", []), {"kind": "text", "filename": filename, "model": model})
+                return df
+        except Exception:
+            continue
+
+    try:
+        Path("/tmp/last_ocr_raw.json").write_text(last_raw, encoding="utf-8")
+    except Exception:
+        pass
+    diagnose("llm.invalid_json",
+             f"No se pudo interpretar texto de PDF {filename}: respuesta no JSON. Se guardó /tmp/last_ocr_raw.json.",
+             file=filename)
+    return pd.DataFrame()
+# --------- PDF: TEXTO + RENDER A IMAGEN (pypdfium2) ---------
+
+@traced("pdf.extract_text")
+def _extract_text_from_pdf_simple(file_obj) -> str:
+    try:
+        import PyPDF2
+    except ImportError:
+        diagnose("dependency.missing", "PyPDF2 no está instalado: no se extrae texto de los PDF.",
+                 level="info", package="PyPDF2")
+        return ""
+    try:
+        reader = PyPDF2.PdfReader(file_obj)
+        chunks = []
+        for page in reader.pages:
+            try:
+                chunks.append(page.extract_text() or "")
+            except Exception:
+                continue
+        return "\n".join(chunks).strip()
+    except Exception:
+        return ""
+
+def _parse_page_range(spec: str, n_pages: int) -> list[int]:
+    """'1-3, 5, 8-' → índices 0-based dentro de [0, n_pages). Vacío = todas las páginas."""
+    spec = (spec or "").strip()
+    if not spec:
+        return list(range(n_pages))
+    out = []
+    for part in spec.split(","):
+        part = part.strip()
+        if not part:
+            continue
+        a, sep, b = part.partition("-")
+        try:
+            start = int(a) if a.strip() else 1
+            end = (int(b) if b.strip() else n_pages) if sep else start
+        except ValueError:
+            continue
+        out.extend(i - 1 for i in range(max(start, 1), min(end, n_pages) + 1))
+    return list(dict.fromkeys(out))
+
+def _iter_pdf_pages(file_bytes: bytes, dpi: int = 200, pages: str | None = None, max_side: int = 1200):
+    """
+    Generador de páginas de un PDF: (índice, PIL.Image en grises) de a una por vez.
+    Renderiza directo en escala de grises al tamaño final del OCR (lado mayor <= max_side),
+    sin pasar por PNG. `pages` acepta un rango tipo '2-4,6' para saltear portada/condiciones.
+    Si pypdfium2 no está o el PDF no se puede abrir, no produce páginas.
+    """
+    try:
+        import pypdfium2 as pdfium
+    except Exception:
+        return
+    try:
+        pdf = pdfium.PdfDocument(file_bytes)
+    except Exception:
+        return
+    try:
+        for i in _parse_page_range(pages, len(pdf)):
+            try:
+                with trace_span("pdf.rasterize", page=i + 1):
+                    page = pdf[i]
+                    try:
+                        w, h = page.get_size()  # puntos (1/72")
+                        scale = dpi / 72
+                        if max(w, h) * scale > max_side:
+                            scale = max_side / max(w, h)
+                        im = page.render(scale=scale, grayscale=True).to_pil()
+                    finally:
+                        page.close()
+            except Exception:
+                continue
+            yield i, (im if im.mode == "L" else im.convert("L"))
+    finally:
+        pdf.close()
+
+def _pdf_page_count(file_bytes: bytes) -> int:
+    try:
+        import pypdfium2 as pdfium
+        pdf = pdfium.PdfDocument(file_bytes)
+    except Exception:
+        return 0
+    try:
+        return len(pdf)
+    finally:
+        pdf.close()
+
+def _pdf_ocr_jobs(file_bytes: bytes, name: str, dpi: int, pages: str | None = None):
+    """Jobs de OCR (imagen, nombre) de un PDF, rasterizando cada página recién cuando se pide."""
+    for j, im in _iter_pdf_pages(file_bytes, dpi=dpi, pages=pages):
+        yield im, f"{name}#p{j+1}.png"
+
+# --------- PARSER LOCAL DE FACTURAS (PLANTILLAS POR DISTRIBUIDORA) ---------
+
+INVOICE_TEMPLATES_DIR = Path("config/invoice_templates")
+
+_MONTHS = {
+    "enero": 1, "febrero": 2, "marzo": 3, "abril": 4, "mayo": 5, "junio": 6, "julio": 7,
+    "agosto": 8, "septiembre": 9, "setiembre": 9, "octubre": 10, "noviembre": 11, "diciembre": 12,
+    "january": 1, "february": 2, "march": 3, "april": 4, "may": 5, "june": 6, "july": 7,
+    "august": 8, "september": 9, "october": 10, "november": 11, "december": 12,
+    "ene": 1, "feb": 2, "mar": 3, "abr": 4, "jun": 6, "jul": 7, "ago": 8, "sep": 9, "set": 9,
+    "oct": 10, "nov": 11, "dic": 12, "jan": 1, "apr": 4, "aug": 8, "dec": 12,
+}
+
+@functools.lru_cache(maxsize=8)
+def load_invoice_templates(root: str | None = None) -> list[dict]:
+    """Plantillas JSON de `config/invoice_templates/` con sus regex ya compiladas."""
+    base = Path(root) if root else INVOICE_TEMPLATES_DIR
+    out = []
+    for p in sorted(base.glob("*.json")) if base.exists() else []:
+        try:
+            tpl = json.loads(p.read_text(encoding="utf-8"))
+            tpl["name"] = tpl.get("name") or p.stem
+            tpl["_fields"] = {
+                k: [re.compile(rx, re.IGNORECASE) for rx in (v if isinstance(v, list) else [v])]
+                for k, v in (tpl.get("fields") or {}).items()
+            }
+            tpl["_match"] = [m.lower() for m in tpl.get("match", [])]
+            out.append(tpl)
+        except (OSError, ValueError, re.error):
+            continue
+    return out
+
+def _parse_local_number(s: str, decimal: str | None = None) -> float | None:
+    """'1.234,56' / '1,234.56' / '1234' → float, según el separador decimal de la plantilla."""
+    s = (s or "").strip().rstrip(".,")
+    if not s:
+        return None
+    if decimal is None:
+        # auto: el último separador es el decimal si le siguen 1–2 dígitos
+        m = re.search(r"[.,](\d{1,2})$", s)
+        decimal = s[m.start()] if m else ("," if "." in s else ".")
+    thousands = "." if decimal == "," else ","
+    try:
+        return float(s.replace(thousands, "").replace(decimal, "."))
+    except ValueError:
+        return None
+
+def _parse_local_year_month(s: str, date_order: str = "dmy"):
+    s = (s or "").strip().lower()
+    m = re.fullmatch(r"(\d{1,2})/(\d{1,2})/(\d{4})", s)
+    if m:
+        a, b, y = int(m.group(1)), int(m.group(2)), int(m.group(3))
+        month = a if date_order == "mdy" else b
+    elif re.fullmatch(r"\d{1,2}/\d{4}", s):
+        month, y = (int(x) for x in s.split("/"))
+    elif re.fullmatch(r"\d{4}-\d{2}", s):
+        y, month = (int(x) for x in s.split("-"))
+    else:
+        m = re.fullmatch(r"([a-záéíóú]+)\s+(?:de\s+)?(\d{4})", s)
+        if not m or m.group(1) not in _MONTHS:
+            return pd.NaT
+        month, y = _MONTHS[m.group(1)], int(m.group(2))
+    if not (1 <= month <= 12 and 1990 <= y <= 2100):
+        return pd.NaT
+    return pd.Timestamp(year=y, month=month, day=1)
+
+def _apply_invoice_template_block(text: str, tpl: dict):
+    """Extrae una fila de un bloque de texto (una factura). Devuelve (fila, confianza 0–1)."""
+    found = {}
+    for field, patterns in tpl["_fields"].items():
+        for rx in patterns:
+            m = rx.search(text)
+            if m:
+                found[field] = (m.group(1) if m.groups() else m.group(0)).strip()
+                break
+    ym = _parse_local_year_month(found.get("year_month", ""), tpl.get("date_order", "dmy"))
+    kwh = _parse_local_number(found.get("kwh", ""), tpl.get("decimal"))
+    cost = _parse_local_number(found.get("cost", ""), tpl.get("decimal"))
+    dem = _parse_local_number(found.get("demand_kw", ""), tpl.get("decimal"))
+    # confianza = campos obligatorios válidos (período, kWh > 0, costo >= 0)
+    checks = [pd.notna(ym), kwh is not None and kwh > 0, cost is not None and cost >= 0]
+    row = {
+        "_year_month": ym,
+        "_kwh": float(kwh or 0),
+        "_cost": float(cost or 0),
+        "_demand_kw": dem,
+        "_currency": (found.get("currency") or (tpl.get("defaults") or {}).get("currency") or "").upper() or None,
+    }
+    return row, sum(checks) / len(checks)
+
+def _apply_invoice_template(text: str, tpl: dict):
+    """
+    Extrae las filas de un texto con una plantilla. Devuelve (filas, confianza 0–1).
+    Un PDF puede traer varias facturas: el texto se parte en bloques en cada coincidencia de
+    período (finditer) y cada bloque da su fila; la confianza es la del peor bloque, así un
+    bloque incompleto manda el archivo al LLM en lugar de perder meses.
+    """
+    starts = []
+    for rx in tpl["_fields"].get("year_month", []):
+        starts = [m.start() for m in rx.finditer(text)]
+        if starts:
+            break
+    if len(starts) <= 1:
+        row, conf = _apply_invoice_template_block(text, tpl)
+        return [row], conf
+    bounds = [0] + starts[1:] + [len(text)]
+    rows, confs = [], []
+    for a, b in zip(bounds, bounds[1:]):
+        row, conf = _apply_invoice_template_block(text[a:b], tpl)
+        rows.append(row)
+        confs.append(conf)
+    # el mismo período repetido en un bloque (p. ej. encabezado y pie) no es otra factura
+    if len({r["_year_month"] for r in rows}) < len(rows):
+        confs.append(0.0)
+    return rows, min(confs)
+
+@traced("template.parse")
+def _parse_invoice_text_local(raw_text: str, filename: str, templates: list | None = None,
+                              min_confidence: float = 1.0):
+    """
+    Intenta interpretar el texto de una factura con las plantillas locales (regex), sin API.
+    Devuelve (DataFrame, info) donde info = {"template", "confidence"}. Si ninguna plantilla
+    alcanza `min_confidence` el DataFrame viene vacío y corresponde usar el LLM.
+    """
+    text = raw_text or ""
+    low = text.lower()
+    best = (None, 0.0, None)
+    for tpl in (load_invoice_templates() if templates is None else templates):
+        if tpl["_match"] and not all(k in low for k in tpl["_match"]):
+            continue
+        rows, conf = _apply_invoice_template(text, tpl)
+        if conf > best[1]:
+            best = (tpl["name"], conf, rows)
+    name, conf, rows = best
+    info = {"template": name, "confidence": conf, "rows": len(rows or [])}
+    if rows is None or conf < min_confidence:
+        return pd.DataFrame(), info
+    return pd.DataFrame(rows).assign(_source=filename, _parse_path=f"template:{name}"), info
+
+# ========================= RESUMEN / BASELINE / ENPI =========================
+
+@traced("summarize_invoices")
+def _em_summarize_invoices(inv_df: pd.DataFrame, total_area_m2: float, users_count: int,
+                           baseline_start: str | None, baseline_end: str | None):
+    result = {"monthly_series": [], "metrics": {}, "period": {"start": None, "end": None}, "notes": []}
+    if inv_df is None or inv_df.empty or "_year_month" not in inv_df.columns:
+        result["notes"].append("No hay datos tabulares de facturas (o no se detectó período).")
+        return result
+
+    df = inv_df.dropna(subset=["_year_month"])
+    if df.empty:
+        result["notes"].append("No se pudo interpretar el período de facturación.")
+        return result
+
+    grp = df.groupby("_year_month", as_index=False).agg(
+        kwh=("_kwh","sum"),
+        cost=("_cost","sum"),
+        demand_kw=("_demand_kw","max")
+    ).sort_values("_year_month")
+    return _em_summarize_monthly(grp, total_area_m2, users_count, baseline_start, baseline_end)
+
+@traced("summarize_monthly")
+def _em_summarize_monthly(grp: pd.DataFrame, total_area_m2: float, users_count: int,
+                          baseline_start: str | None, baseline_end: str | None):
+    """Resumen a partir de la serie mensual ya agregada (_year_month, kwh, cost, demand_kw)."""
+    result = {"monthly_series": [], "metrics": {}, "period": {"start": None, "end": None}, "notes": []}
+    if grp is None or grp.empty:
+        result["notes"].append("No hay datos tabulares de facturas (o no se detectó período).")
+        return result
+
+    result["monthly_series"] = [
+        # NULL del ledger (mes sin dato de kWh/costo) → 0 en la serie, igual que la baseline
+        {"month": d.strftime("%Y-%m"), "kwh": float(k) if pd.notna(k) else 0.0,
+         "cost": float(c) if pd.notna(c) else 0.0, "demand_kw": float(dk) if pd.notna(dk) else None}
+        for d,k,c,dk in zip(grp["_year_month"], grp["kwh"], grp["cost"], grp["demand_kw"])
+    ]
+
+    total_kwh = float(grp["kwh"].fillna(0).sum())
+    total_cost = float(grp["cost"].fillna(0).sum())
+    months = int(grp.shape[0])
+    unit_cost = (total_cost / total_kwh) if total_kwh > 0 else None
+
+    factor = 12 / months if months and months < 12 else 1.0
+    kwh_year_equiv = total_kwh * factor
+    kwh_per_m2_yr = (kwh_year_equiv / total_area_m2) if total_area_m2 and total_area_m2 > 0 else None
+    kwh_per_user_yr = (kwh_year_equiv / users_count) if users_count and users_count > 0 else None
+
+    result["metrics"] = {
+        "total_kwh": total_kwh, "total_cost": total_cost, "unit_cost": unit_cost,
+        "months": months, "kwh_year_equiv": kwh_year_equiv,
+        "kwh_per_m2_yr": kwh_per_m2_yr, "kwh_per_user_yr": kwh_per_user_yr
+    }
+
+    start = grp["_year_month"].min()
+    end = grp["_year_month"].max()
+    result["period"] = {
+        "start": start.strftime("%Y-%m") if pd.notna(start) else None,
+        "end": end.strftime("%Y-%m") if pd.notna(end) else None,
+        "baseline_start": str(baseline_start) if baseline_start else None,
+        "baseline_end": str(baseline_end) if baseline_end else None
+    }
+
+    if months < 6:
+        result["notes"].append("Menos de 6 meses de datos: la anualización puede ser poco representativa.")
+    if total_kwh == 0:
+        result["notes"].append("kWh total = 0 (revisar extracción/columnas).")
+    return result
+
+def _em_compute_baseline_from_invoices(invoices_summary: dict, total_area_m2: float, users_count: int,
+                                       regression: dict | None = None):
+    res = {"baseline": {}, "enpi": {}, "notas": []}
+    if not invoices_summary or "metrics" not in invoices_summary:
+        res["notas"].append("No hay métricas de facturas para baseline/EnPI.")
+        return res
+    m = invoices_summary.get("metrics", {})
+    p = invoices_summary.get("period", {})
+    total_kwh = m.get("total_kwh") or 0.0
+    kwh_year_equiv = m.get("kwh_year_equiv") or total_kwh
+    unit_cost = m.get("unit_cost")
+    kwh_per_m2_yr = m.get("kwh_per_m2_yr")
+    kwh_per_user_yr = m.get("kwh_per_user_yr")
+    if (not kwh_per_m2_yr) and total_area_m2:
+        kwh_per_m2_yr = (kwh_year_equiv / total_area_m2) if total_area_m2 > 0 else None
+    if (not kwh_per_user_yr) and users_count:
+        kwh_per_user_yr = (kwh_year_equiv / users_count) if users_count > 0 else None
+    res["baseline"] = {
+        "period_start": p.get("start"),
+        "period_end": p.get("end"),
+        "kwh_year_equiv": kwh_year_equiv,
+        "unit_cost": unit_cost
+    }
+    res["enpi"] = {
+        "kwh_per_m2_yr": kwh_per_m2_yr,
+        "kwh_per_user_yr": kwh_per_user_yr,
+        "cost_per_kwh": unit_cost
+    }
+    notes = invoices_summary.get("notes", []) or invoices_summary.get("notas", [])
+    res["notas"].extend(notes)
+
+    # Baseline por regresión con grados-día (fila de fit_energy_baselines), si hay modelo válido
+    if regression and regression.get("model"):
+        def _num(v):
+            return float(v) if v is not None and pd.notna(v) else None
+        norm = _num(regression.get("kwh_year_normalized"))
+        res["regression"] = {
+            "model": regression["model"],
+            "months": int(regression.get("n_months") or 0),
+            "coefficients": {
+                "base_kwh_per_day": _num(regression.get("base_kwh_per_day")),
+                "kwh_per_hdd": _num(regression.get("kwh_per_hdd")),
+                "kwh_per_cdd": _num(regression.get("kwh_per_cdd")),
+            },
+            "r2": _num(regression.get("r2")),
+            "cv_rmse": _num(regression.get("cv_rmse")),
+            "nmbe": _num(regression.get("nmbe")),
+            "reporting": {
+                "months": int(regression.get("reporting_months") or 0),
+                "expected_kwh": _num(regression.get("reporting_expected_kwh")),
+                "actual_kwh": _num(regression.get("reporting_actual_kwh")),
+                "savings_kwh": _num(regression.get("savings_kwh")),
+                "performance_ratio": _num(regression.get("performance_ratio")),
+            },
+        }
+        res["baseline"]["method"] = "regression:" + regression["model"]
+        res["baseline"]["kwh_year_normalized"] = norm
+        if norm is not None:
+            res["enpi"]["kwh_per_m2_yr_normalized"] = (norm / total_area_m2) if total_area_m2 and total_area_m2 > 0 else None
+            res["enpi"]["kwh_per_user_yr_normalized"] = (norm / users_count) if users_count and users_count > 0 else None
+        res["enpi"]["performance_ratio"] = res["regression"]["reporting"]["performance_ratio"]
+        cv = res["regression"]["cv_rmse"]
+        if cv is not None and cv > 0.15:
+            res["notas"].append(f"CV(RMSE) del baseline {cv:.1%} > 15% (umbral mensual ASHRAE Guideline 14).")
+    else:
+        res["baseline"]["method"] = "annualized"
+    return res
+
+# ========================= LEDGER PERSISTENTE (SQLITE) =========================
+
+LEDGER_COLUMNS = ["_year_month", "_kwh", "_cost", "_demand_kw", "_currency", "_source", "_parse_path"]
+SITE_META_COLUMNS = ["site", "organization", "building_type", "area_m2", "users_count",
+                     "baseline_start", "baseline_end", "climate_zone", "visitors_per_day"]
+
+class EnergyLedger:
+    """
+    Ledger de facturas persistente en SQLite, una fila por (sitio, mes, archivo de origen).
+    Las altas son upserts idempotentes (volver a cargar el mismo archivo no duplica) y
+    cuestan O(filas nuevas); las consultas por sitio y rango de meses usan la clave primaria.
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with self._connect() as con:
+            con.execute("PRAGMA journal_mode=WAL")
+            con.execute("""
+                CREATE TABLE IF NOT EXISTS invoices (
+                    site TEXT NOT NULL,
+                    year_month TEXT NOT NULL,
+                    source TEXT NOT NULL,
+                    kwh REAL, cost REAL, demand_kw REAL,
+                    currency TEXT, parse_path TEXT,
+                    updated_at TEXT,
+                    PRIMARY KEY (site, year_month, source)
+                ) WITHOUT ROWID
+            """)
+            con.execute("CREATE INDEX IF NOT EXISTS ix_invoices_month ON invoices (year_month, site)")
+            con.execute("""
+                CREATE TABLE IF NOT EXISTS sites (
+                    site TEXT PRIMARY KEY,
+                    organization TEXT, building_type TEXT,
+                    area_m2 REAL, users_count INTEGER,
+                    baseline_start TEXT, baseline_end TEXT,
+                    updated_at TEXT
+                )
+            """)
+            # Columnas agregadas después de la primera versión del esquema
+            have = {r[1] for r in con.execute("PRAGMA table_info(sites)")}
+            for col, typ in [("climate_zone", "TEXT"), ("visitors_per_day", "INTEGER")]:
+                if col not in have:
+                    con.execute(f"ALTER TABLE sites ADD COLUMN {col} {typ}")
+
+    def _connect(self):
+        import sqlite3
+        return sqlite3.connect(self.path, timeout=30)
+
+    @traced("ledger.upsert")
+    def upsert(self, inv_df: pd.DataFrame, site: str | None = None) -> int:
+        """
+        Inserta/actualiza filas normalizadas (_year_month, _kwh, …) de un sitio, o de varios
+        en una sola transacción si `site` es None y el DataFrame trae la columna `_site`.
+        Filas del mismo mes y archivo se consolidan antes (kWh y costo suman, demanda = máx),
+        igual que lo hace luego _em_summarize_invoices. Un mes en el que ningún valor de kWh o
+        costo se pudo leer queda en NULL a propósito (dato faltante, no consumo cero); los
+        resúmenes lo tratan como 0. Devuelve la cantidad de claves escritas.
+        """
+        if inv_df is None or inv_df.empty or "_year_month" not in inv_df.columns:
+            return 0
+        if site is None and "_site" not in inv_df.columns:
+            raise ValueError("upsert sin `site` requiere la columna `_site`.")
+        df = pd.DataFrame({
+            "site": inv_df["_site"].astype(str) if site is None else site,
+            "year_month": pd.to_datetime(inv_df["_year_month"], errors="coerce"),
+            "source": inv_df["_source"].astype(str) if "_source" in inv_df.columns else "",
+            "kwh": pd.to_numeric(inv_df.get("_kwh"), errors="coerce") if "_kwh" in inv_df.columns else np.nan,
+            "cost": pd.to_numeric(inv_df.get("_cost"), errors="coerce") if "_cost" in inv_df.columns else np.nan,
+            "demand_kw": pd.to_numeric(inv_df.get("_demand_kw"), errors="coerce") if "_demand_kw" in inv_df.columns else np.nan,
+            "currency": inv_df["_currency"] if "_currency" in inv_df.columns else None,
+            "parse_path": inv_df["_parse_path"] if "_parse_path" in inv_df.columns else None,
+        }).dropna(subset=["year_month"])
+        if df.empty:
+            return 0
+        df["year_month"] = df["year_month"].dt.to_period("M").dt.to_timestamp().dt.strftime("%Y-%m-%d")
+        g = df.groupby(["site", "year_month", "source"], sort=False)
+        grp = pd.concat([
+            g[["kwh", "cost"]].sum(min_count=1),  # sin ningún valor → NULL (no 0)
+            g["demand_kw"].max(),
+            g[["currency", "parse_path"]].first(),
+        ], axis=1).reset_index()
+        now = pd.Timestamp.now().strftime("%Y-%m-%d %H:%M:%S")
+        grp = grp.astype(object).where(grp.notna(), None)
+        rows = [(*r, now) for r in grp[["site", "year_month", "source", "kwh", "cost", "demand_kw",
+                                        "currency", "parse_path"]].itertuples(index=False)]
+        with self._connect() as con:
+            con.executemany("""
+                INSERT INTO invoices (site, year_month, source, kwh, cost, demand_kw, currency, parse_path, updated_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT (site, year_month, source) DO UPDATE SET
+                    kwh=excluded.kwh, cost=excluded.cost, demand_kw=excluded.demand_kw,
+                    currency=excluded.currency, parse_path=excluded.parse_path, updated_at=excluded.updated_at
+            """, rows)
+        return len(rows)
+
+    @staticmethod
+    def _where(site=None, sites=None, start=None, end=None):
+        clauses, params = [], []
+        if site is not None:
+            clauses.append("site = ?"); params.append(site)
+        if sites is not None:
+            sites = list(sites)
+            clauses.append(f"site IN ({','.join('?' * len(sites))})" if sites else "0")
+            params.extend(sites)
+        if start is not None:
+            clauses.append("year_month >= ?"); params.append(pd.Timestamp(start).strftime("%Y-%m-01"))
+        if end is not None:
+            clauses.append("year_month <= ?"); params.append(pd.Timestamp(end).strftime("%Y-%m-01"))
+        return (" WHERE " + " AND ".join(clauses)) if clauses else "", params
+
+    @traced("ledger.query")
+    def query(self, site: str | None = None, start=None, end=None, sites=None,
+              with_site: bool = False) -> pd.DataFrame:
+        """Filas del ledger con las columnas normalizadas (_year_month, _kwh, …), ordenadas por mes."""
+        where, params = self._where(site, sites, start, end)
+        with self._connect() as con:
+            df = pd.read_sql_query(
+                "SELECT site, year_month, kwh, cost, demand_kw, currency, source, parse_path "
+                f"FROM invoices{where} ORDER BY site, year_month, source", con, params=params)
+        df["year_month"] = pd.to_datetime(df["year_month"], format="%Y-%m-%d")
+        df = df.rename(columns={"year_month": "_year_month", "kwh": "_kwh", "cost": "_cost",
+                                "demand_kw": "_demand_kw", "currency": "_currency",
+                                "source": "_source", "parse_path": "_parse_path", "site": "_site"})
+        return df if with_site else df.drop(columns=["_site"])
+
+    def monthly(self, site: str | None = None, start=None, end=None, sites=None,
+                by_site: bool = False) -> pd.DataFrame:
+        """Serie mensual agregada en SQL (kwh y cost suman, demand_kw = máx) lista para resumir."""
+        where, params = self._where(site, sites, start, end)
+        keys = "site, year_month" if by_site else "year_month"
+        with self._connect() as con:
+            df = pd.read_sql_query(
+                f"SELECT {keys}, SUM(kwh) AS kwh, SUM(cost) AS cost, MAX(demand_kw) AS demand_kw "
+                f"FROM invoices{where} GROUP BY {keys} ORDER BY {keys}", con, params=params)
+        df["year_month"] = pd.to_datetime(df["year_month"], format="%Y-%m-%d")
+        return df.rename(columns={"year_month": "_year_month", "site": "_site"})
+
+    @traced("ledger.summarize")
+    def summarize(self, site: str, total_area_m2: float, users_count: int,
+                  baseline_start=None, baseline_end=None, start=None, end=None) -> dict:
+        """Resumen de _em_summarize_invoices calculado directo sobre el rango pedido del ledger."""
+        return _em_summarize_monthly(self.monthly(site, start, end), total_area_m2, users_count,
+                                     baseline_start, baseline_end)
+
+    def sites(self) -> list[str]:
+        with self._connect() as con:
+            return [r[0] for r in con.execute("SELECT DISTINCT site FROM invoices ORDER BY site")]
+
+    def upsert_sites(self, meta: pd.DataFrame) -> int:
+        """Alta/actualización de metadatos por sitio (columnas de SITE_META_COLUMNS; `site` obligatoria)."""
+        if meta is None or meta.empty:
+            return 0
+        df = meta.reindex(columns=SITE_META_COLUMNS).dropna(subset=["site"])
+        for c in ("baseline_start", "baseline_end"):
+            d = pd.to_datetime(df[c], errors="coerce")
+            df[c] = d.dt.strftime("%Y-%m-%d").where(d.notna(), None)
+        df["area_m2"] = pd.to_numeric(df["area_m2"], errors="coerce")
+        df["users_count"] = pd.to_numeric(df["users_count"], errors="coerce")
+        df["visitors_per_day"] = pd.to_numeric(df["visitors_per_day"], errors="coerce")
+        now = pd.Timestamp.now().strftime("%Y-%m-%d %H:%M:%S")
+        df = df.astype(object).where(df.notna(), None)
+        rows = [(*r, now) for r in df.itertuples(index=False)]
+        with self._connect() as con:
+            con.executemany(f"""
+                INSERT OR REPLACE INTO sites ({', '.join(SITE_META_COLUMNS)}, updated_at)
+                VALUES ({', '.join('?' * (len(SITE_META_COLUMNS) + 1))})
+            """, rows)
+        return len(rows)
+
+    def site_meta(self, sites=None) -> pd.DataFrame:
+        """Metadatos por sitio (área, usuarios, tipología, ventana de baseline)."""
+        where, params = self._where(sites=sites)
+        with self._connect() as con:
+            df = pd.read_sql_query(f"SELECT {', '.join(SITE_META_COLUMNS)} FROM sites{where} ORDER BY site",
+                                   con, params=params)
+        for c in ("baseline_start", "baseline_end"):
+            df[c] = pd.to_datetime(df[c], format="%Y-%m-%d")
+        return df
+
+    def delete_site(self, site: str) -> int:
+        with self._connect() as con:
+            con.execute("DELETE FROM sites WHERE site = ?", (site,))
+            return con.execute("DELETE FROM invoices WHERE site = ?", (site,)).rowcount
+
+_ENERGY_LEDGER = None
+
+def energy_ledger() -> EnergyLedger:
+    """Ledger del proceso; ubicación en $GREENSCORE_LEDGER_PATH (por defecto data/energy_ledger.sqlite)."""
+    global _ENERGY_LEDGER
+    if _ENERGY_LEDGER is None:
+        _ENERGY_LEDGER = EnergyLedger(os.getenv("GREENSCORE_LEDGER_PATH", "data/energy_ledger.sqlite"))
+    return _ENERGY_LEDGER
+
+# ========================= PORTFOLIO ENERGÉTICO MULTI-SITIO =========================
+
+def _annualize_kwh(kwh, months):
+    """kWh anual equivalente con la misma regla que _em_summarize_monthly (escala a 12 si hay < 12 meses)."""
+    months = np.asarray(months, dtype="float64")
+    with np.errstate(divide="ignore", invalid="ignore"):
+        factor = np.where((months > 0) & (months < 12), 12 / months, 1.0)
+    return np.asarray(kwh, dtype="float64") * factor
+
+def _safe_ratio(num, den):
+    num = np.asarray(num, dtype="float64")
+    den = np.asarray(den, dtype="float64")
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return np.where(den > 0, num / den, np.nan)
+
+def energy_portfolio(ledger: EnergyLedger | None = None, sites=None, start=None, end=None,
+                     meta: pd.DataFrame | None = None, degree_days: pd.DataFrame | None = None) -> pd.DataFrame:
+    """
+    KPIs de todos los sitios del ledger en una sola pasada vectorizada sobre la serie mensual
+    por sitio (agregada en SQL), con las mismas reglas que _em_summarize_monthly y
+    _em_compute_baseline_from_invoices: EUI (kWh/m²·año), kWh/usuario·año y $/kWh, baseline
+    anualizado en la ventana de cada sitio, variación del período posterior, ranking y
+    benchmark contra la mediana de su tipología. Con grados-día (los de load_degree_days() si no
+    se pasan) se suman las columnas del baseline por regresión de fit_energy_baselines.
+    """
+    ledger = ledger or energy_ledger()
+    m = monthly = ledger.monthly(start=start, end=end, sites=sites, by_site=True)
+    if m.empty:
+        return pd.DataFrame(columns=["site"])
+    meta = ledger.site_meta(sites) if meta is None else meta.reindex(columns=SITE_META_COLUMNS)
+    meta = meta.drop_duplicates("site", keep="last").set_index("site")
+
+    ym = m["_year_month"]
+    def _site_month(col):
+        d = pd.to_datetime(meta[col]).dt.to_period("M").dt.to_timestamp()
+        return pd.Series(d.reindex(m["_site"]).to_numpy(dtype="datetime64[ns]"), index=m.index)
+    bs = _site_month("baseline_start")
+    be = _site_month("baseline_end")
+    has_window = bs.notna() | be.notna()
+    in_base = has_window & (bs.isna() | (ym >= bs)) & (be.isna() | (ym <= be))
+    after_base = be.notna() & (ym > be)
+    m = m.assign(
+        kwh=m["kwh"].fillna(0.0), cost=m["cost"].fillna(0.0),
+        base_month=in_base, rep_month=after_base,
+    )
+    m["kwh_base"] = m["kwh"].where(in_base, 0.0)
+    m["kwh_rep"] = m["kwh"].where(after_base, 0.0)
+
+    pf = m.groupby("_site", sort=True).agg(
+        total_kwh=("kwh", "sum"), total_cost=("cost", "sum"), months=("_year_month", "size"),
+        start=("_year_month", "min"), end=("_year_month", "max"), peak_demand_kw=("demand_kw", "max"),
+        baseline_kwh=("kwh_base", "sum"), baseline_months=("base_month", "sum"),
+        reporting_kwh=("kwh_rep", "sum"), reporting_months=("rep_month", "sum"),
+    )
+    pf = pf.join(meta[["organization", "building_type", "area_m2", "users_count",
+                       "baseline_start", "baseline_end"]], how="left")
+    pf.index.name = "site"
+
+    pf["kwh_year_equiv"] = _annualize_kwh(pf["total_kwh"], pf["months"])
+    pf["unit_cost"] = _safe_ratio(pf["total_cost"], pf["total_kwh"])
+    pf["kwh_per_m2_yr"] = _safe_ratio(pf["kwh_year_equiv"], pf["area_m2"])
+    pf["kwh_per_user_yr"] = _safe_ratio(pf["kwh_year_equiv"], pf["users_count"])
+
+    # Sin ventana de baseline se usa todo el período (igual que _em_compute_baseline_from_invoices)
+    windowed = pf["baseline_start"].notna() | pf["baseline_end"].notna()
+    base_equiv = np.where(pf["baseline_months"] > 0,
+                          _annualize_kwh(pf["baseline_kwh"], pf["baseline_months"]), np.nan)
+    pf["baseline_kwh_year_equiv"] = np.where(windowed, base_equiv, pf["kwh_year_equiv"])
+    pf["reporting_kwh_year_equiv"] = np.where(pf["reporting_months"] > 0,
+                                              _annualize_kwh(pf["reporting_kwh"], pf["reporting_months"]), np.nan)
+    pf["kwh_change_pct"] = (_safe_ratio(pf["reporting_kwh_year_equiv"], pf["baseline_kwh_year_equiv"]) - 1) * 100
+
+    pf["building_type"] = pf["building_type"].fillna("Sin tipología")
+    by_tp = pf.groupby("building_type")["kwh_per_m2_yr"]
+    pf["eui_rank"] = pf["kwh_per_m2_yr"].rank(method="min").astype("Int64")
+    pf["typology_median_eui"] = by_tp.transform("median")
+    pf["eui_vs_typology"] = pf["kwh_per_m2_yr"] / pf["typology_median_eui"]
+    pf["typology_pct_rank"] = by_tp.rank(pct=True)
+
+    dd = load_degree_days() if degree_days is None else degree_days
+    if dd is not None and not dd.empty:
+        fits = fit_energy_baselines(monthly, dd, meta.reset_index()).set_index("site")
+        pf = pf.join(fits[["model", "cv_rmse", "kwh_year_normalized", "performance_ratio"]]
+                     .rename(columns={"model": "regression_model"}))
+        pf["kwh_per_m2_yr_normalized"] = _safe_ratio(pf["kwh_year_normalized"], pf["area_m2"])
+    return pf.reset_index().sort_values(["eui_rank", "site"], na_position="last", ignore_index=True)
+
+def energy_typology_benchmark(pf: pd.DataFrame) -> pd.DataFrame:
+    """Benchmark por tipología: EUI ponderada por área, cuartiles de EUI y $/kWh del grupo."""
+    if pf is None or pf.empty:
+        return pd.DataFrame(columns=["building_type"])
+    with_area = pf["area_m2"].fillna(0) > 0
+    df = pf.assign(
+        _kwh_eq_area=pf["kwh_year_equiv"].where(with_area, 0.0),
+        _area=pf["area_m2"].where(with_area, 0.0),
+    )
+    g = df.groupby("building_type", sort=True)
+    out = g.agg(
+        sites=("site", "size"), area_m2=("_area", "sum"), kwh_year_equiv=("kwh_year_equiv", "sum"),
+        total_kwh=("total_kwh", "sum"), total_cost=("total_cost", "sum"), _kwh_eq_area=("_kwh_eq_area", "sum"),
+        eui_median=("kwh_per_m2_yr", "median"),
+        eui_p25=("kwh_per_m2_yr", lambda s: s.quantile(0.25)),
+        eui_p75=("kwh_per_m2_yr", lambda s: s.quantile(0.75)),
+    )
+    out["eui_weighted"] = _safe_ratio(out["_kwh_eq_area"], out["area_m2"])
+    out["unit_cost"] = _safe_ratio(out["total_cost"], out["total_kwh"])
+    return out.drop(columns=["_kwh_eq_area"]).reset_index()
+
+# ========================= BASELINE POR REGRESIÓN (GRADOS-DÍA) =========================
+
+DEGREE_DAYS_PATH = Path(os.getenv("GREENSCORE_DEGREE_DAYS", "data/degree_days.csv"))
+
+_DEGREE_DAYS_COLUMNS = {
+    "month":    ["month","mes","year_month","_year_month","periodo","period","date","fecha"],
+    "hdd":      ["hdd","gdc","heating_degree_days","grados_dia_calefaccion"],
+    "cdd":      ["cdd","gdr","cooling_degree_days","grados_dia_refrigeracion"],
+    "location": ["location","station","estacion","climate_zone","zona","zone"],
+}
+
+# Modelos candidatos: columnas de [días, HDD, CDD]; la carga base entra como kWh/día
+_BASELINE_MODELS = {"base": (0,), "hdd": (0, 1), "cdd": (0, 2), "hdd+cdd": (0, 1, 2)}
+
+def parse_degree_days(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Grados-día mensuales (location, _year_month, hdd, cdd) desde un CSV mensual o diario.
+    Sin columna de ubicación se usa una única serie para todos los sitios.
+    """
+    cols = {}
+    for c in df.columns:
+        cols.setdefault(str(c).lower().strip(), c)
+    pick = {role: next((cols[k] for k in cands if k in cols), None) for role, cands in _DEGREE_DAYS_COLUMNS.items()}
+    if pick["month"] is None or (pick["hdd"] is None and pick["cdd"] is None):
+        raise ValueError("El archivo de grados-día necesita una columna de mes/fecha y HDD y/o CDD.")
+    ts = _parse_invoice_dates(df[pick["month"]], _detect_invoice_date_format(df[pick["month"]]))
+    out = pd.DataFrame({
+        "location": df[pick["location"]].astype(str).str.strip() if pick["location"] is not None else "",
+        "_year_month": ts.to_numpy(dtype="datetime64[ns]").astype("datetime64[M]").astype("datetime64[ns]"),
+        "hdd": pd.to_numeric(df[pick["hdd"]], errors="coerce") if pick["hdd"] is not None else 0.0,
+        "cdd": pd.to_numeric(df[pick["cdd"]], errors="coerce") if pick["cdd"] is not None else 0.0,
+    }).dropna(subset=["_year_month"])
+    # Datos diarios → totales mensuales
+    return out.groupby(["location", "_year_month"], as_index=False, sort=True)[["hdd", "cdd"]].sum(min_count=1)
+
+@functools.lru_cache(maxsize=8)
+def _read_degree_days(path: str, mtime: float) -> pd.DataFrame:
+    return parse_degree_days(pd.read_csv(path))
+
+def load_degree_days(path=None) -> pd.DataFrame | None:
+    """Grados-día del CSV local ($GREENSCORE_DEGREE_DAYS, por defecto data/degree_days.csv) o None."""
+    p = Path(path or DEGREE_DAYS_PATH)
+    if not p.exists():
+        return None
+    return _read_degree_days(str(p), p.stat().st_mtime)
+
+def _degree_day_normals(dd: pd.DataFrame) -> pd.DataFrame:
+    """Año típico por ubicación: promedio de HDD/CDD de cada mes calendario (12 filas por ubicación)."""
+    d = dd.assign(cal_month=dd["_year_month"].dt.month)
+    normals = d.groupby(["location", "cal_month"])[["hdd", "cdd"]].mean()
+    full = normals.groupby(level="location").size() == 12
+    return normals[normals.index.get_level_values("location").isin(full[full].index)]
+
+@traced("baseline.regression")
+def fit_energy_baselines(monthly: pd.DataFrame, degree_days: pd.DataFrame | None,
+                         meta: pd.DataFrame | None = None, min_months: int = 6) -> pd.DataFrame:
+    """
+    Baseline por regresión estilo IPMVP para todos los sitios a la vez: kWh_mes = a·días + b·HDD + c·CDD
+    ajustado por mínimos cuadrados en lote (ecuaciones normales apiladas, una por sitio) sobre los
+    meses de la ventana de baseline de cada sitio (o todo el histórico si no hay ventana).
+
+    Para cada sitio se ajustan los modelos base / hdd / cdd / hdd+cdd y se elige el de menor
+    CV(RMSE) entre los que tienen coeficientes climáticos no negativos y al menos `min_months`
+    meses (y p + 2). Devuelve una fila por sitio con coeficientes, R², CV(RMSE), NMBE, consumo
+    normalizado a un año típico de grados-día y desempeño del período posterior al baseline
+    (esperado vs. real). La ocupación es constante por sitio, así que no entra al ajuste: se usa
+    para normalizar los EnPIs en _em_compute_baseline_from_invoices.
+    """
+    cols_out = ["site", "model", "n_months", "base_kwh_per_day", "kwh_per_hdd", "kwh_per_cdd",
+                "r2", "cv_rmse", "nmbe", "kwh_year_normalized", "reporting_months",
+                "reporting_expected_kwh", "reporting_actual_kwh", "savings_kwh", "performance_ratio"]
+    if monthly is None or monthly.empty or degree_days is None or degree_days.empty:
+        return pd.DataFrame(columns=cols_out)
+
+    m = monthly.dropna(subset=["kwh"]).copy()
+    if "_site" not in m.columns:
+        m["_site"] = ""
+    meta = (meta if meta is not None else pd.DataFrame(columns=SITE_META_COLUMNS)).reindex(columns=SITE_META_COLUMNS)
+    meta = meta.drop_duplicates("site", keep="last").set_index("site")
+
+    # Ubicación de grados-día por sitio: su zona climática si el archivo trae varias, si no la única serie
+    locations = set(degree_days["location"].unique())
+    if locations == {""}:
+        m["location"] = ""
+    else:
+        m["location"] = meta["climate_zone"].astype("string").str.strip().reindex(m["_site"]).to_numpy()
+    m = m.merge(degree_days, on=["location", "_year_month"], how="left")
+
+    def _site_month(col):
+        d = pd.to_datetime(meta[col]).dt.to_period("M").dt.to_timestamp()
+        return pd.Series(d.reindex(m["_site"]).to_numpy(dtype="datetime64[ns]"), index=m.index)
+    bs, be = _site_month("baseline_start"), _site_month("baseline_end")
+    ym = m["_year_month"]
+    has_dd = m["hdd"].notna() & m["cdd"].notna()
+    m["_base"] = (bs.isna() | (ym >= bs)) & (be.isna() | (ym <= be)) & has_dd
+    m["_rep"] = be.notna() & (ym > be) & has_dd
+
+    # Matrices apiladas (sitio × mes) con relleno; los pesos 0/1 marcan los meses que cuentan
+    m = m.sort_values(["_site", "_year_month"], ignore_index=True)
+    sites, site_idx = np.unique(m["_site"].to_numpy(dtype=object), return_inverse=True)
+    pos = m.groupby("_site", sort=True).cumcount().to_numpy()
+    S, T = len(sites), int(pos.max()) + 1
+    X = np.zeros((S, T, 3))
+    y = np.zeros((S, T))
+    w = np.zeros((S, T))
+    wr = np.zeros((S, T))
+    X[site_idx, pos, 0] = m["_year_month"].dt.days_in_month.to_numpy(dtype="float64")
+    X[site_idx, pos, 1] = m["hdd"].fillna(0).to_numpy()
+    X[site_idx, pos, 2] = m["cdd"].fillna(0).to_numpy()
+    y[site_idx, pos] = m["kwh"].to_numpy(dtype="float64")
+    w[site_idx, pos] = m["_base"].to_numpy(dtype="float64")
+    wr[site_idx, pos] = m["_rep"].to_numpy(dtype="float64")
+
+    n = w.sum(axis=1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        ybar = (w * y).sum(axis=1) / n
+        sst = (w * (y - ybar[:, None]) ** 2).sum(axis=1)
+
+    best_cv = np.full(S, np.inf)
+    best = {"model": np.full(S, None, dtype=object), "beta": np.full((S, 3), np.nan),
+            "cv": np.full(S, np.nan), "r2": np.full(S, np.nan), "nmbe": np.full(S, np.nan)}
+    for name, idx in _BASELINE_MODELS.items():
+        Xm = X[:, :, idx]
+        p = len(idx)
+        xtx = np.einsum("stp,stq,st->spq", Xm, Xm, w)
+        xty = np.einsum("stp,st,st->sp", Xm, y, w)
+        beta = np.einsum("spq,sq->sp", np.linalg.pinv(xtx), xty)
+        resid = y - np.einsum("stp,sp->st", Xm, beta)
+        sse = (w * resid ** 2).sum(axis=1)
+        dof = n - p
+        with np.errstate(divide="ignore", invalid="ignore"):
+            cv = np.sqrt(sse / dof) / ybar
+            r2 = np.where(sst > 0, 1 - sse / sst, np.nan)
+            nmbe = (w * resid).sum(axis=1) / (dof * ybar)
+        # Cada regresor climático debe tener variación real en el baseline y pendiente ≥ 0
+        weather_ok = np.ones(S, dtype=bool)
+        for j, col in enumerate(idx):
+            if col > 0:
+                weather_ok &= (beta[:, j] >= 0) & ((w * X[:, :, col]).sum(axis=1) > 0)
+        valid = (n >= max(min_months, p + 2)) & weather_ok & np.isfinite(cv) & (ybar > 0)
+        take = valid & (cv < best_cv)
+        best_cv = np.where(take, cv, best_cv)
+        full_beta = np.zeros((S, 3))
+        full_beta[:, list(idx)] = beta
+        best["model"][take] = name
+        best["beta"][take] = full_beta[take]
+        best["cv"][take], best["r2"][take], best["nmbe"][take] = cv[take], r2[take], nmbe[take]
+
+    beta = best["beta"]
+    pred = np.einsum("stp,sp->st", X, np.nan_to_num(beta))
+    rep_exp = (wr * pred).sum(axis=1)
+    rep_act = (wr * y).sum(axis=1)
+    rep_n = wr.sum(axis=1)
+
+    out = pd.DataFrame({
+        "site": sites, "model": best["model"], "n_months": n.astype(int),
+        "base_kwh_per_day": beta[:, 0], "kwh_per_hdd": beta[:, 1], "kwh_per_cdd": beta[:, 2],
+        "r2": best["r2"], "cv_rmse": best["cv"], "nmbe": best["nmbe"],
+        "reporting_months": rep_n.astype(int),
+        "reporting_expected_kwh": np.where((rep_n > 0) & np.isfinite(beta[:, 0]), rep_exp, np.nan),
+        "reporting_actual_kwh": np.where(rep_n > 0, rep_act, np.nan),
+    })
+    out["savings_kwh"] = out["reporting_expected_kwh"] - out["reporting_actual_kwh"]
+    out["performance_ratio"] = _safe_ratio(out["reporting_actual_kwh"], out["reporting_expected_kwh"])
+
+    # Consumo normalizado: el modelo evaluado sobre el año típico de grados-día de su ubicación
+    normals = _degree_day_normals(degree_days)
+    if not normals.empty:
+        loc = m.groupby("_site", sort=True)["location"].first().reindex(sites)
+        nd = normals.reset_index()
+        nd["days"] = pd.to_datetime({"year": 2001, "month": nd["cal_month"], "day": 1}).dt.days_in_month
+        year = nd.groupby("location").agg(days=("days", "sum"), hdd=("hdd", "sum"), cdd=("cdd", "sum"))
+        yr = year.reindex(loc.to_numpy())
+        out["kwh_year_normalized"] = (beta[:, 0] * yr["days"].to_numpy() + beta[:, 1] * yr["hdd"].to_numpy()
+                                      + beta[:, 2] * yr["cdd"].to_numpy())
+    else:
+        out["kwh_year_normalized"] = np.nan
+    return out[cols_out]
+
+def energy_baselines(ledger: EnergyLedger | None = None, sites=None, degree_days=None, **kw) -> pd.DataFrame:
+    """fit_energy_baselines sobre la serie mensual por sitio del ledger y sus metadatos."""
+    ledger = ledger or energy_ledger()
+    dd = load_degree_days() if degree_days is None else degree_days
+    return fit_energy_baselines(ledger.monthly(sites=sites, by_site=True), dd, ledger.site_meta(sites), **kw)
+
+# ========================= HELPERS DE CARGA =========================
+
+_INVOICE_COLUMN_CANDIDATES = {
+    "date": ["fecha","date","periodo","period","billing_period","mes","month"],
+    "kwh":  ["kwh","consumo_kwh","consumption_kwh","energy_kwh","active_energy_kwh"],
+    "cost": ["costo","cost","importe","monto","amount","total"],
+    "dem":  ["demanda_kw","kw","peak_kw","dem_kw"],
+    "curr": ["moneda","currency"],
+}
+
+# Formatos explícitos que se prueban sobre una muestra; con formato fijo el parseo es de una pasada
+_INVOICE_DATE_FORMATS = [
+    "%Y-%m-%d", "%d/%m/%Y", "%d-%m-%Y", "%d.%m.%Y", "%Y/%m/%d", "%d/%m/%y",
+    "%Y-%m-%d %H:%M:%S", "%Y-%m-%d %H:%M", "%Y-%m-%dT%H:%M:%S", "%Y-%m-%dT%H:%M",
+    "%d/%m/%Y %H:%M:%S", "%d/%m/%Y %H:%M", "%d-%m-%Y %H:%M",
+    "%Y-%m", "%m/%Y", "%m-%Y", "%Y%m",
+]
+
+_INVOICE_MAPPING_CACHE: dict = {}
+_INVOICE_MAPPING_CACHE_MAX = 256
+
+def _invoice_header_signature(df: pd.DataFrame) -> tuple:
+    return tuple((str(c), str(t)) for c, t in df.dtypes.items())
+
+def _detect_invoice_date_format(col: pd.Series, sample_size: int = 500) -> str | None:
+    """
+    Formato de fecha detectado sobre una muestra de valores no nulos: "datetime" si la columna
+    ya es fecha, el formato explícito que parsea toda la muestra, o None (parseo genérico dayfirst).
+    """
+    if pd.api.types.is_datetime64_any_dtype(col):
+        return "datetime"
+    sample = col.dropna()
+    sample = sample.iloc[:: max(1, len(sample) // sample_size)]
+    if sample.empty:
+        return None
+    for fmt in _INVOICE_DATE_FORMATS:
+        if _parse_invoice_dates(sample, fmt).notna().all():
+            return fmt
+    return None
+
+def _parse_invoice_dates(col: pd.Series, fmt: str | None) -> pd.Series:
+    """Parseo de una sola pasada con el formato detectado; sin formato, el genérico dayfirst + YYYY-MM."""
+    if fmt == "datetime":
+        d = col
+    elif fmt:
+        # strptime vectorizado de Arrow: pandas sólo tiene camino rápido para ISO
+        import pyarrow as pa
+        import pyarrow.compute as pc
+        if pd.api.types.is_string_dtype(col) and not pd.api.types.is_object_dtype(col):
+            arr = pa.array(col.array)  # columna str respaldada por Arrow: sin copia
+        else:
+            arr = pa.array(col.astype(str).to_numpy(dtype=object), type=pa.string())
+        arr = pc.utf8_trim_whitespace(arr.cast(pa.string()))
+        d = pd.Series(pc.strptime(arr, format=fmt, unit="s", error_is_null=True)
+                      .to_numpy(zero_copy_only=False).astype("datetime64[ns]"), index=col.index)
+        if col.hasnans:
+            d[col.isna().to_numpy()] = pd.NaT
+    else:
+        try: d = pd.to_datetime(col, dayfirst=True, errors="coerce")
+        except Exception: d = pd.to_datetime(col, errors="coerce")
+        m = d.isna() & col.astype(str).str.match(r"^\d{4}-\d{2}$")
+        if m.any():
+            d = d.copy()
+            d[m] = pd.to_datetime(col[m].astype(str) + "-01", errors="coerce")
+    if getattr(d.dt, "tz", None) is not None:
+        d = d.dt.tz_localize(None)
+    return d
+
+def _invoice_table_mapping(df: pd.DataFrame) -> dict:
+    """
+    Mapeo de columnas (fecha, kWh, costo, demanda, moneda) y formato de fecha, cacheado por la
+    firma del encabezado: exportaciones repetidas de la misma distribuidora no vuelven a detectar.
+    Devuelve una copia: el llamador puede modificarla sin tocar la entrada cacheada.
+    """
+    sig = _invoice_header_signature(df)
+    mapping = _INVOICE_MAPPING_CACHE.get(sig)
+    if mapping is not None:
+        return dict(mapping)
+    cols = {}
+    for c in df.columns:
+        cols.setdefault(str(c).lower().strip(), c)
+    mapping = {role: next((cols[k] for k in cands if k in cols), None)
+               for role, cands in _INVOICE_COLUMN_CANDIDATES.items()}
+    mapping["date_format"] = _detect_invoice_date_format(df[mapping["date"]]) if mapping["date"] is not None else None
+    if len(_INVOICE_MAPPING_CACHE) >= _INVOICE_MAPPING_CACHE_MAX:
+        _INVOICE_MAPPING_CACHE.pop(next(iter(_INVOICE_MAPPING_CACHE)))
+    _INVOICE_MAPPING_CACHE[sig] = mapping
+    return dict(mapping)
+
+def _remember_invoice_date_format(df: pd.DataFrame, fmt: str | None) -> None:
+    """Actualiza el formato de fecha cacheado para la firma de `df` (si sigue en la caché)."""
+    cached = _INVOICE_MAPPING_CACHE.get(_invoice_header_signature(df))
+    if cached is not None:
+        cached["date_format"] = fmt
+
+@traced("normalize_table")
+def _normalize_invoice_table(df: pd.DataFrame, source_name: str) -> pd.DataFrame:
+    """
+    Tabla normalizada (columnas de LEDGER_COLUMNS) sin modificar `df`: sólo se leen las
+    columnas mapeadas y las fechas se parsean una vez con el formato detectado en una muestra.
+    """
+    mapping = _invoice_table_mapping(df)
+    n = len(df)
+    out = {}
+    c_date = mapping["date"]
+    if c_date is not None:
+        col = df[c_date]
+        d = _parse_invoice_dates(col, mapping["date_format"])
+        if mapping["date_format"] not in (None, "datetime"):
+            failed = d.isna() & col.notna()
+            if failed.sum() * 2 > col.notna().sum():
+                # Misma cabecera pero otro formato de fecha (p. ej. otra distribuidora): re-detectar
+                # y guardarlo, porque las próximas exportaciones suelen venir igual que esta
+                mapping["date_format"] = _detect_invoice_date_format(col)
+                _remember_invoice_date_format(df, mapping["date_format"])
+                d = _parse_invoice_dates(col, mapping["date_format"])
+                failed = d.isna() & col.notna()
+            if failed.any():
+                # Filas sueltas fuera del formato detectado: parseo genérico sólo para esas
+                d = d.copy()
+                d[failed] = _parse_invoice_dates(col[failed], None)
+        out["_year_month"] = pd.Series(d.to_numpy(dtype="datetime64[ns]").astype("datetime64[M]")
+                                       .astype("datetime64[ns]"), index=df.index)
+    else:
+        out["_year_month"] = pd.Series(pd.NaT, index=df.index, dtype="datetime64[ns]")
+
+    for role, dst in [("kwh", "_kwh"), ("cost", "_cost"), ("dem", "_demand_kw")]:
+        src = mapping[role]
+        out[dst] = pd.to_numeric(df[src], errors="coerce") if src is not None else pd.Series([None] * n, index=df.index, dtype=object)
+
+    out["_currency"] = df[mapping["curr"]].astype(str) if mapping["curr"] is not None else pd.Series([None] * n, index=df.index, dtype=object)
+    out["_source"] = source_name
+    out["_parse_path"] = "table"
+    return pd.DataFrame(out, index=df.index)
+
+# ========================= MEDICIÓN POR INTERVALOS (AMI) =========================
+
+_INTERVAL_COLUMN_CANDIDATES = {
+    "ts":    ["timestamp","datetime","fecha_hora","interval_start","interval_end","read_time",
+              "hora","time","fecha","date"],
+    "kwh":   ["kwh","energy_kwh","active_energy_kwh","consumo_kwh","consumption_kwh","kwh_del"],
+    "kw":    ["kw","demand_kw","demanda_kw","power_kw","potencia_kw","peak_kw"],
+    "meter": ["meter","meter_id","medidor","id_medidor","channel","canal","site","sitio"],
+}
+
+def _interval_columns(header) -> dict:
+    cols = {}
+    for c in header:
+        cols.setdefault(str(c).lower().strip(), c)
+    mapping = {role: next((cols[k] for k in cands if k in cols), None)
+               for role, cands in _INTERVAL_COLUMN_CANDIDATES.items()}
+    if mapping["ts"] is None:
+        raise ValueError("No se encontró la columna de fecha/hora del intervalo.")
+    if mapping["kwh"] is None and mapping["kw"] is None:
+        raise ValueError("Se necesita una columna de kWh o de kW por intervalo.")
+    return mapping
+
+def _iter_interval_chunks(source, columns: list, chunksize: int, dtype: dict | None = None):
+    """Bloques de `columns` desde un CSV o Parquet (ruta o archivo subido) sin leer el archivo entero."""
+    name = str(getattr(source, "name", source)).lower()
+    if name.endswith(".parquet") or name.endswith(".pq"):
+        import pyarrow.parquet as pq
+        pf = pq.ParquetFile(source)
+        for batch in pf.iter_batches(batch_size=chunksize, columns=columns):
+            yield batch.to_pandas()
+    else:
+        if hasattr(source, "seek"):
+            source.seek(0)
+        yield from pd.read_csv(source, usecols=columns, chunksize=chunksize, dtype=dtype)
+
+def _interval_header(source) -> list:
+    name = str(getattr(source, "name", source)).lower()
+    if name.endswith(".parquet") or name.endswith(".pq"):
+        import pyarrow.parquet as pq
+        return list(pq.ParquetFile(source).schema_arrow.names)
+    if hasattr(source, "seek"):
+        source.seek(0)
+    header = list(pd.read_csv(source, nrows=0).columns)
+    if hasattr(source, "seek"):
+        source.seek(0)
+    return header
+
+def _infer_interval_minutes(ts: pd.Series, meter: pd.Series | None) -> float:
+    """Paso típico entre lecturas (mediana de las diferencias positivas dentro de cada medidor)."""
+    df = pd.DataFrame({"ts": ts.to_numpy(), "m": meter.to_numpy() if meter is not None else 0}).dropna()
+    df = df.sort_values(["m", "ts"])
+    d = df.groupby("m", sort=False)["ts"].diff().dt.total_seconds()
+    d = d[d > 0]
+    return float(d.median() / 60) if not d.empty else 60.0
+
+@traced("interval.rollup")
+def rollup_interval_meter(source, site: str | None = None, by_meter: bool = False,
+                          interval_minutes: float | None = None, chunksize: int = 500_000,
+                          source_name: str | None = None):
+    """
+    Lee lecturas de medidor por intervalo (15 min / horarias, CSV o Parquet) por bloques y
+    las agrega al vuelo a nivel (medidor, mes): kWh, pico de demanda, intervalos y horas
+    cubiertas. Sólo se guardan parciales por bloque, nunca la serie cruda.
+
+    Sin columna de kW el pico se deriva de los kWh del intervalo (kWh × 60 / minutos); sin kWh,
+    la energía sale de kW × horas del intervalo. Con `by_meter=False` los medidores se suman en
+    `site` y la demanda es la suma de picos por medidor (no coincidente, cota superior).
+
+    Devuelve (rollup, info): el rollup trae las columnas del ledger (_year_month, _kwh,
+    _demand_kw, …), `_site`, `_intervals`, `_hours` y `_load_factor` (kWh / (pico × horas)).
+    """
+    source_name = source_name or Path(str(getattr(source, "name", source))).name
+    mapping = _interval_columns(_interval_header(source))
+    c_ts, c_kwh, c_kw, c_meter = mapping["ts"], mapping["kwh"], mapping["kw"], mapping["meter"]
+    columns = [c for c in (c_ts, c_kwh, c_kw, c_meter) if c is not None]
+
+    parts = []
+    fmt = None
+    rows = chunks = 0
+    dtype = {c_meter: "category"} if c_meter is not None else None
+    for chunk in _iter_interval_chunks(source, columns, chunksize, dtype):
+        chunks += 1
+        rows += len(chunk)
+        if chunks == 1:
+            fmt = _detect_invoice_date_format(chunk[c_ts])
+        ts = _parse_invoice_dates(chunk[c_ts], fmt)
+        meter = chunk[c_meter].astype("category") if c_meter is not None else None
+        if interval_minutes is None:
+            interval_minutes = _infer_interval_minutes(ts, meter)
+        hours = interval_minutes / 60
+        kwh = pd.to_numeric(chunk[c_kwh], errors="coerce") if c_kwh is not None else None
+        kw = pd.to_numeric(chunk[c_kw], errors="coerce") if c_kw is not None else None
+        if kwh is None:
+            kwh = kw * hours
+        if kw is None:
+            kw = kwh / hours
+        part = pd.DataFrame({
+            "meter": meter.array if meter is not None else "",
+            "_year_month": ts.to_numpy(dtype="datetime64[ns]").astype("datetime64[M]").astype("datetime64[ns]"),
+            "kwh": kwh.to_numpy(), "kw": kw.to_numpy(),
+        }).dropna(subset=["_year_month"])
+        parts.append(part.groupby(["meter", "_year_month"], sort=False, observed=True, dropna=False).agg(
+            kwh=("kwh", "sum"), kw=("kw", "max"), n=("kwh", "size")))
+
+    info = {"rows": rows, "chunks": chunks, "interval_minutes": interval_minutes,
+            "columns": mapping, "date_format": fmt, "source": source_name}
+    if not parts:
+        info["meters"] = 0
+        return pd.DataFrame(columns=LEDGER_COLUMNS + ["_site", "_intervals", "_hours", "_load_factor"]), info
+
+    # Un mes puede quedar partido entre bloques: se combinan los parciales
+    per_meter = pd.concat(parts).groupby(level=["meter", "_year_month"], sort=True).agg(
+        kwh=("kwh", "sum"), kw=("kw", "max"), n=("n", "sum")).reset_index()
+    info["meters"] = int(per_meter["meter"].nunique())
+    site = site or "Site"
+    if by_meter:
+        per_meter["_site"] = (site + " · " + per_meter["meter"]) if c_meter is not None else site
+        roll = per_meter
+    else:
+        roll = per_meter.groupby("_year_month", as_index=False, sort=True).agg(
+            kwh=("kwh", "sum"), kw=("kw", "sum"), n=("n", "sum"))
+        roll["_site"] = site
+    hrs = roll["n"] * (interval_minutes / 60)
+    if not by_meter:
+        # horas cubiertas del sitio = intervalos del mes / medidores que reportaron ese mes
+        hrs = hrs / per_meter.groupby("_year_month")["meter"].nunique().reindex(roll["_year_month"]).to_numpy()
+    out = pd.DataFrame({
+        "_site": roll["_site"],
+        "_year_month": roll["_year_month"],
+        "_kwh": roll["kwh"],
+        "_cost": np.nan,
+        "_demand_kw": roll["kw"],
+        "_currency": None,
+        "_source": source_name,
+        "_parse_path": "interval",
+        "_intervals": roll["n"].astype("int64"),
+        "_hours": hrs.to_numpy(),
+    })
+    out["_load_factor"] = _safe_ratio(out["_kwh"], out["_demand_kw"] * out["_hours"])
+    return out, info
@@ -0,0 +1,21 @@
+"""Subcomando `score` de greenscore_cli."""
+import pandas as pd
+
+import greenscore_cli as cli
+
+
+def test_files_with_different_columns_fill_missing_metrics_with_zero(tmp_path, capsys):
+    cfg_metrics = {k for c in cli.ge.read_scoring_config()["schemes"].values() for k in c["metrics"]}
+    full = tmp_path / "completo.csv"
+    pd.DataFrame([{"project_name": "A", **{k: 100 for k in cfg_metrics}}]).to_csv(full, index=False)
+    partial = tmp_path / "parcial.csv"
+    pd.DataFrame([{"project_name": "B", "energy_saving_pct": 0}]).to_csv(partial, index=False)
+
+    alone = cli.main(["score", str(partial), "--workers", "1", "--out", str(tmp_path / "solo.csv")])
+    both = cli.main(["score", str(full), str(partial), "--workers", "1", "--out", str(tmp_path / "juntos.csv")])
+
+    scores = [c for c in alone.columns if c.startswith("score_")]
+    b = both[both["project_name"] == "B"].reset_index(drop=True)
+    pd.testing.assert_frame_equal(b[scores], alone[scores])
+    assert (alone[scores] == 0).all().all()
+    assert "parcial.csv no tiene" in capsys.readouterr().err
@@ -0,0 +1,23 @@
+"""EnergyLedger: persistencia y resúmenes mensuales."""
+import json
+
+import numpy as np
+import pandas as pd
+
+import greenscore_engine as ge
+
+
+def test_month_without_values_is_null_in_ledger_and_zero_in_summary(tmp_path):
+    led = ge.EnergyLedger(str(tmp_path / "ledger.sqlite"))
+    led.upsert(pd.DataFrame({
+        "_year_month": pd.to_datetime(["2024-01-01", "2024-02-01"]),
+        "_kwh": [100.0, np.nan], "_cost": [10.0, np.nan], "_source": "a.csv",
+    }), site="S")
+
+    stored = led.monthly("S")
+    assert stored["kwh"].isna().sum() == 1
+
+    series = led.summarize("S", 100, 10)["monthly_series"]
+    assert [(m["kwh"], m["cost"]) for m in series] == [(100.0, 10.0), (0.0, 0.0)]
+    json.dumps(series, allow_nan=False)
+
@@ -0,0 +1,17 @@
+"""Normalización de tablas de facturas (CSV/Excel)."""
+import pandas as pd
+
+import greenscore_engine as ge
+
+
+def test_invoice_mapping_cache_returns_copies_and_keeps_redetected_format():
+    ge._INVOICE_MAPPING_CACHE.clear()
+    iso = pd.DataFrame({"fecha": ["2024-01-15", "2024-02-15"], "kwh": [1.0, 2.0]})
+    dmy = pd.DataFrame({"fecha": ["15/03/2024", "15/04/2024"], "kwh": [3.0, 4.0]})
+
+    ge._invoice_table_mapping(iso)["date_format"] = "otro"
+    assert ge._invoice_table_mapping(iso)["date_format"] == "%Y-%m-%d"
+
+    out = ge._normalize_invoice_table(dmy, "b.csv")
+    assert out["_year_month"].dt.strftime("%Y-%m").tolist() == ["2024-03", "2024-04"]
+    assert ge._invoice_table_mapping(dmy)["date_format"] == "%d/%m/%Y"
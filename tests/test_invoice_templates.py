@@ -0,0 +1,28 @@
+"""Plantillas locales de facturas (greenscore_engine._parse_invoice_text_local)."""
+import greenscore_engine as ge
+
+BILL_JAN = "Factura\nPeríodo: 01/2024\nConsumo: 1.234 kWh\nTotal a pagar: $ 45.678,90\n"
+BILL_FEB = "Factura\nPeríodo: 02/2024\nConsumo: 1.100 kWh\nTotal a pagar: $ 40.000,00\n"
+
+
+def test_single_bill():
+    df, info = ge._parse_invoice_text_local(BILL_JAN, "enero.pdf")
+    assert info["template"] == "generico_es" and info["confidence"] == 1.0
+    assert df["_year_month"].dt.strftime("%Y-%m").tolist() == ["2024-01"]
+    assert df["_kwh"].tolist() == [1234.0]
+
+
+def test_multiple_bills_in_one_file():
+    df, info = ge._parse_invoice_text_local(BILL_JAN + "\n" + BILL_FEB, "bimestre.pdf")
+    assert info["confidence"] == 1.0 and info["rows"] == 2
+    assert df["_year_month"].dt.strftime("%Y-%m").tolist() == ["2024-01", "2024-02"]
+    assert df["_kwh"].tolist() == [1234.0, 1100.0]
+    assert df["_cost"].tolist() == [45678.9, 40000.0]
+    assert (df["_source"] == "bimestre.pdf").all()
+
+
+def test_incomplete_bill_block_goes_to_llm():
+    # el segundo período no trae consumo: mejor el LLM que perder o inventar un mes
+    text = BILL_JAN + "\nFactura\nPeríodo: 02/2024\nTotal a pagar: $ 40.000,00\n"
+    df, info = ge._parse_invoice_text_local(text, "incompleta.pdf")
+    assert df.empty and info["confidence"] < 1.0
@@ -0,0 +1,26 @@
+"""Scoring multi-esquema en el pool de procesos compartido (score_all_schemes)."""
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+import greenscore_engine as ge
+
+
+def _portfolio(n: int, cfg: dict) -> pd.DataFrame:
+    rng = np.random.default_rng(0)
+    keys = sorted({k for c in cfg["schemes"].values() for k in c["metrics"]})
+    return pd.DataFrame({k: rng.uniform(0, 100, n) for k in keys})
+
+
+def test_concurrent_calls_with_different_worker_counts_share_the_pool():
+    cfg = ge.read_scoring_config()
+    df = _portfolio(4_000, cfg)
+    serial = ge.score_all_schemes(df, cfg, max_workers=1, shard_rows=500)
+    with ThreadPoolExecutor(max_workers=3) as ex:
+        outs = list(ex.map(lambda w: ge.score_all_schemes(df, cfg, max_workers=w, shard_rows=500), [2, 3, 4]))
+    pool = ge._process_pool()
+    for out in outs:
+        pd.testing.assert_frame_equal(out, serial)
+    # el pool no se recrea ni se achica entre llamadas
+    assert ge._process_pool() is pool
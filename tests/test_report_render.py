@@ -0,0 +1,46 @@
+"""Conversión del texto del reporte (parse_report_text / ReportStreamRenderer)."""
+import random
+
+import greenscore_engine as ge
+
+NUMBERED = """1. Resumen Ejecutivo
+El sitio consume **1.234 kWh** por mes.
+2. Línea de Base y EnPIs
+- kWh/m² anual
+- kWh por usuario
+1) Oportunidades y Medidas
+| Medida | Ahorro |
+|---|---|
+| LED | 12 % |
+3. Revisar el tablero general
+"""
+
+
+def test_numbered_section_headings_go_to_toc():
+    doc = ge.parse_report_text(NUMBERED)
+    assert [(level, title) for level, title, _ in doc.toc] == [
+        ("h2", "1. Resumen Ejecutivo"),
+        ("h2", "2. Línea de Base y EnPIs"),
+        ("h2", "1) Oportunidades y Medidas"),
+    ]
+    html = doc.html()
+    assert "<ul><li>kWh/m² anual</li><li>kWh por usuario</li></ul>" in html
+    assert "<ol><li>Revisar el tablero general</li></ol>" in html
+
+
+def _streamed(text: str, cuts: list) -> ge.ReportDoc:
+    r = ge.ReportStreamRenderer()
+    for a, b in zip([0] + cuts, cuts + [len(text)]):
+        r.feed(text[a:b])
+    return r.finish()
+
+
+def test_stream_matches_full_parse_with_crlf():
+    text = NUMBERED.replace("\n", "\r\n") * 3
+    ref = ge.parse_report_text(text)
+    # cortes justo después de cada "\r" (el "\n" llega en el fragmento siguiente)
+    cr_cuts = [i + 1 for i, c in enumerate(text) if c == "\r"]
+    rng = random.Random(0)
+    for cuts in [cr_cuts] + [sorted(rng.sample(range(1, len(text)), 25)) for _ in range(50)]:
+        doc = _streamed(text, cuts)
+        assert doc.html() == ref.html() and doc.toc == ref.toc